@@ -4,9 +4,11 @@ import json
 import logging
 import datetime
 import random
+import math
 import celery
 import re
 import requests
+from collections import defaultdict
 from celery.decorators import task
 from celery.signals import task_postrun, task_prerun, task_failure, worker_process_init
 from celery import group, chain, chord
@@ -14,19 +16,23 @@ from celery import current_app as celery_app
 from celery import Task
 from celery.signals import task_sent
 from celery.utils import uuid
-from eventlet import timeout
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
 from sqlalchemy.orm.exc import FlushError
 from sqlalchemy.exc import IntegrityError, DataError, InvalidRequestError
 
 from totalimpactwebapp import db
 from totalimpact.tiredis import REDIS_MAIN_DATABASE_NUMBER
 from totalimpact import tiredis, default_settings
-from totalimpact.providers.provider import ProviderFactory, ProviderError, ProviderTimeout
+from totalimpact.providers.provider import ProviderFactory, ProviderError, ProviderTimeout, ProviderRateLimitError
 
 from totalimpactwebapp.profile import Profile
 
 from totalimpactwebapp.product import add_product_embed_markup
 from totalimpactwebapp.product import Product
+from totalimpactwebapp.product import get_products_from_tiids
+from totalimpactwebapp.product_summary import mark_product_summaries_stale
+from totalimpactwebapp.product_summary import update_product_summary
 from totalimpactwebapp.product import put_aliases_in_product
 from totalimpactwebapp.product import put_biblio_in_product
 from totalimpactwebapp.product import put_snap_in_product
@@ -48,8 +54,22 @@ import rate_limit
 logger = logging.getLogger("ti.core_tasks")
 myredis = tiredis.from_url(os.getenv("REDIS_URL"), db=REDIS_MAIN_DATABASE_NUMBER)
 
-rate = rate_limit.RateLimiter(redis_url=os.getenv("REDIS_URL"), redis_db=REDIS_MAIN_DATABASE_NUMBER)
-rate.add_condition({'requests':25, 'seconds':1})
+rate = rate_limit.TokenBucketRateLimiter(
+    quotas=rate_limit.quotas_from_provider_config(default_settings.PROVIDERS),
+    redis_url=os.getenv("REDIS_URL"), 
+    redis_db=REDIS_MAIN_DATABASE_NUMBER)
+
+# longest wait for the rate limiter before a provider group gives up, see wait_for_rate_limit
+MAX_INLINE_RATE_LIMIT_WAIT_SECONDS = 5
+
+PROVIDER_TIMEOUT_SECONDS = 120
+
+# tiids refreshed per refresh_tiids_batch task
+REFRESH_TIIDS_PER_TASK = int(os.getenv("REFRESH_TIIDS_PER_TASK", 25))
+if REFRESH_TIIDS_PER_TASK < 1:
+    raise ValueError(u"REFRESH_TIIDS_PER_TASK must be at least 1, not {n}".format(
+        n=REFRESH_TIIDS_PER_TASK))
+BATCH_PROVIDER_CONCURRENCY = int(os.getenv("BATCH_PROVIDER_CONCURRENCY", 10))
 
 
 # from https://github.com/celery/celery/issues/1671#issuecomment-47247074
@@ -97,6 +117,13 @@ class ClearDbSessionTask(Task):
             failure_message = u"exc={exc}, args={args}, kwargs={kwargs}, time={time}, einfo={einfo}".format(
                 time=datetime.datetime.utcnow(), exc=exc, args=args, kwargs=kwargs, einfo=einfo)
             after_refresh_complete(tiid, failure_message=failure_message)
+        elif task_id.startswith("task-batch"):
+            (profile_id, tiids) = args[0:2]
+            failure_message = u"exc={exc}, time={time}, einfo={einfo}".format(
+                time=datetime.datetime.utcnow(), exc=exc, einfo=einfo)
+            for tiid in tiids:
+                mark_product_refresh_complete(tiid, failure_message=failure_message)
+            tiids_refresh_finished(profile_id, tiids)
 
 
 
@@ -109,7 +136,7 @@ def provider_method_wrapper(tiid, provider, method_name):
     product = Product.query.get(tiid)
 
     if not product:
-        logger.warning(u"Empty product in provider_run for tiid {tiid}".format(
+        logger.warning(u"Empty product in provider_method_wrapper for tiid {tiid}".format(
            tiid=tiid))
         return None
 
@@ -127,6 +154,8 @@ def provider_method_wrapper(tiid, provider, method_name):
         method_response = method(input_alias_tuples)
     except ProviderError, e:
         method_response = None
+        if isinstance(e, ProviderRateLimitError):
+            rate.penalize(provider_name, e.retry_after)
 
         logger.info(u"{:20}: **ProviderError {tiid} {method_name} {provider_name}, Exception type {exception_type} {exception_arguments}".format(
             worker_name, 
@@ -148,6 +177,49 @@ def provider_method_wrapper(tiid, provider, method_name):
     return tiid
 
 
+def provider_batch_method_wrapper(tiids, provider, method_name):
+    # like provider_method_wrapper, but for many tiids in one provider *_batch call
+
+    products = get_products_from_tiids(tiids, ignore_order=True, load=["alias_rows", "biblio_rows"])
+    if not products:
+        logger.warning(u"Empty products in provider_batch_method_wrapper for tiids {tiids}".format(
+           tiids=tiids))
+        return None
+
+    provider_name = provider.provider_name
+    worker_name = provider_name+"_worker"
+    input_alias_tuples_list = [product.aliases_for_providers for product in products]
+
+    try:
+        method_responses = getattr(provider, method_name+"_batch")(input_alias_tuples_list)
+    except ProviderError, e:
+        if isinstance(e, ProviderRateLimitError):
+            rate.penalize(provider_name, e.retry_after)
+        logger.info(u"{:20}: **ProviderError in batch of {num} {method_name} {provider_name}, retrying one by one. Exception type {exception_type} {exception_arguments}".format(
+            worker_name, 
+            num=len(products), 
+            provider_name=provider_name.upper(), 
+            method_name=method_name.upper(), 
+            exception_type=type(e).__name__, 
+            exception_arguments=e.args))
+
+        # so one bad product doesn't lose the whole batch
+        method_responses = []
+        for input_alias_tuples in input_alias_tuples_list:
+            try:
+                method_responses.append(getattr(provider, method_name)(input_alias_tuples))
+            except ProviderRateLimitError, e:
+                rate.penalize(provider_name, e.retry_after)
+                method_responses.append(None)
+            except ProviderError:
+                method_responses.append(None)
+
+    for (product, method_response) in zip(products, method_responses):
+        add_to_database_if_nonzero(product, method_response, method_name, provider_name)
+
+    return tiids
+
+
 
 
 
@@ -173,6 +245,8 @@ def add_to_database_if_nonzero(
             logger.warning(u"ack, supposed to save something i don't know about: " + str(new_content))
 
     if updated_product:
+        # rebuilt when the refresh is done, see mark_product_refresh_complete
+        mark_product_summaries_stale([updated_product.tiid])
         updated_product.last_refresh_finished = datetime.datetime.utcnow()
         db.session.merge(updated_product)
         commit(db)
@@ -213,56 +287,7 @@ def sniffer(genre, host, item_aliases, provider_config=default_settings.PROVIDER
 
 
 
-@task(priority=0)
-def chain_dummy(first_arg, **kwargs):
-    if isinstance(first_arg, list):
-        response = first_arg[0]
-    else:
-        response = first_arg
-
-    return response
-
-
-@task(base=ClearDbSessionTask)
-def provider_run(tiid, method_name, provider_name):
-
-    provider = ProviderFactory.get_provider(provider_name)
-
-    # logger.info(u"in provider_run for {provider}".format(
-    #    provider=provider.provider_name))
-
-    (success, estimated_wait_seconds) = rate.acquire(provider_name, block=False)
-    if not success:
-        logger.warning(u"RATE LIMIT HIT in provider_run for {provider} {method_name} {tiid}, retrying".format(
-           provider=provider.provider_name, method_name=method_name, tiid=tiid))
-
-        # add up to random 3 seconds to spread it out
-        estimated_wait_seconds += random.random() * 3
-        provider_run.retry(args=[tiid, method_name, provider_name],
-                countdown=estimated_wait_seconds, 
-                max_retries=10)
-
-    timeout_seconds = 120
-    try:
-        with timeout.Timeout(timeout_seconds):
-            response = provider_method_wrapper(tiid, provider, method_name)
-
-    except timeout.Timeout:
-        msg = u"TIMEOUT in provider_run for {provider} {method_name} {tiid} after {timeout_seconds} seconds".format(
-           provider=provider.provider_name, method_name=method_name, tiid=tiid, timeout_seconds=timeout_seconds)
-        # logger.warning(msg)  # message is written elsewhere
-        raise ProviderTimeout(msg)
-
-    return tiid
-
-
-
-@task(base=ClearDbSessionTask)
-def done_all_refreshes(profile_id):   
-    print "\n\n-------> done all refreshes", profile_id, "\n\n\n---------------\n\n\n"
-
-    profile = Profile.query.get(profile_id)
-
+def finish_profile_refresh(profile):
     save_profile_refresh_status(profile, RefreshStatus.states["CRUNCHING"])
 
     logger.info(u"deduplicating for {url_slug}".format(
@@ -275,124 +300,217 @@ def done_all_refreshes(profile_id):
 
     save_profile_refresh_status(profile, RefreshStatus.states["ALL_DONE"])
 
-    return
 
+@task(base=ClearDbSessionTask)
+def done_all_refreshes(profile_id):   
+    print "\n\n-------> done all refreshes", profile_id, "\n\n\n---------------\n\n\n"
 
-@task(priority=0, base=ClearDbSessionTask)
-def after_refresh_complete(tiid, failure_message=None):
-    # logger.info(u"here in after_refresh_complete with {tiid}".format(
-    #     tiid=tiid))
+    profile = Profile.query.get(profile_id)
+    finish_profile_refresh(profile)
+
+    return
 
+
+def mark_product_refresh_complete(tiid, failure_message=None, provider_errors=None):
     product = Product.query.get(tiid)
 
     if not product:
-        logger.warning(u"Empty product in after_refresh_complete for tiid {tiid}".format(
+        logger.warning(u"Empty product in mark_product_refresh_complete for tiid {tiid}".format(
            tiid=tiid))
         return None
 
     product.embed_markup = product.get_embed_markup() 
-    product.set_refresh_status(myredis, failure_message)  #need commit after this
+    product.set_refresh_status(myredis, failure_message, provider_errors)  #need commit after this
     db.session.merge(product)
     commit(db)
 
-    sleep_seconds = random.random() * 10
-    logger.info(u"Sleeping {sleep_seconds}s in after_refresh_complete for {tiid} before checking done refreshes".format(
-       sleep_seconds=sleep_seconds, tiid=tiid))
-    time.sleep(sleep_seconds)
+    try:
+        update_product_summary(product)
+    except Exception, e:
+        # it's still marked stale, so it gets rebuilt when the profile is next viewed
+        logger.exception(u"couldn't update product summary for {tiid}: {e}".format(
+           tiid=tiid, e=e))
+        db.session.rollback()
+    return product
 
-    profile = Profile.query.get(product.profile_id)
+
+def finish_profile_refresh_if_done(profile_id):
+    # checks every product, so only used for refreshes that weren't counted in redis
+    profile = Profile.query.get(profile_id)
 
     if not profile:
-        print "\n\n-------> no profile after done all refreshes?!?", product.profile_id, "\n\n\n---------------\n\n\n"
+        print "\n\n-------> no profile after done all refreshes?!?", profile_id, "\n\n\n---------------\n\n\n"
         return None
 
     refresh_status = profile.get_refresh_status()
 
     if refresh_status.is_done_refreshing and refresh_status.refresh_state == "progress bar":
-        print "\n\n-------> done all refreshes", product.profile_id, "\n\n\n---------------\n\n\n"
+        print "\n\n-------> done all refreshes", profile_id, "\n\n\n---------------\n\n\n"
 
-        logger.info(u"just_finished_profile_refresh for {tiid}, now deduping etc".format(
-           tiid=tiid))
+        logger.info(u"just_finished_profile_refresh for {url_slug}, now deduping etc".format(
+           url_slug=profile.url_slug))
+        finish_profile_refresh(profile)
 
-        save_profile_refresh_status(profile, RefreshStatus.states["CRUNCHING"])
 
-        logger.info(u"deduplicating for {url_slug}".format(
-            url_slug=profile.url_slug))
-        deleted_tiids = profile.remove_duplicates()
+def tiids_refresh_finished(profile_id, tiids):
+    # counts the tiids off the profile's refresh; whoever finishes the last one
+    # does the end-of-refresh work, exactly once
+    is_last_results = [myredis.finish_profile_refresh_tiid(profile_id, tiid) for tiid in tiids]
 
-        logger.info(u"parse_and_save_tweets for {url_slug}".format(
-            url_slug=profile.url_slug))
-        profile.parse_and_save_tweets()
+    if True in is_last_results:
+        profile = Profile.query.get(profile_id)
+        if not profile:
+            print "\n\n-------> no profile after done all refreshes?!?", profile_id, "\n\n\n---------------\n\n\n"
+            return None
 
-        save_profile_refresh_status(profile, RefreshStatus.states["ALL_DONE"])
+        print "\n\n-------> done all refreshes", profile_id, "\n\n\n---------------\n\n\n"
+        logger.info(u"just_finished_profile_refresh for {url_slug}, now deduping etc".format(
+           url_slug=profile.url_slug))
+        finish_profile_refresh(profile)
 
+    elif None in is_last_results:
+        # started before refreshes were counted, or the count expired
+        finish_profile_refresh_if_done(profile_id)
 
 
-@task(base=ClearDbSessionTask)
-def get_refresh_tiid_pipeline(tiid, task_priority):   
-
-    product = Product.query.get(tiid)
+@task(priority=0, base=ClearDbSessionTask)
+def after_refresh_complete(tiid, failure_message=None):
+    # logger.info(u"here in after_refresh_complete with {tiid}".format(
+    #     tiid=tiid))
 
+    product = mark_product_refresh_complete(tiid, failure_message)
     if not product:
-        logger.warning(u"Empty product in get_refresh_tiid_pipeline for tiid {tiid}".format(
-           tiid=tiid))
         return None
 
-    pipeline = sniffer(product.genre, product.host, product.aliases_for_providers)
-    chain_list = []
-    task_ids = []
-    for step_config in pipeline:
-        group_list = []
-        for (method_name, provider_name) in step_config:
-            if not chain_list:
-                # pass the tiid in to the first one in the whole chain
-                new_task = provider_run.si(tiid, method_name, provider_name).set(priority=3, queue="core_"+task_priority) #don't start new ones till done
-            else:
-                new_task = provider_run.si(tiid, method_name, provider_name).set(priority=0, queue="core_"+task_priority)
-            uuid_bit = uuid().split("-")[0]
+    tiids_refresh_finished(product.profile_id, [tiid])
+
+
+
+def refresh_rounds(pipelines):
+    """ Splits the sniffer pipelines of many tiids into rounds, so each 
+        provider method can run for all the tiids that need it at once.
+        Returns a list of rounds, each a dict of 
+        (method_name, provider_name): [tiids].  Every tiid's steps stay in 
+        sniffer order: all its aliases steps in turn, then biblio, then metrics. """
+    rounds = []
+    for method_name in ["aliases", "biblio", "metrics"]:
+        steps_by_tiid = {}
+        for (tiid, pipeline) in pipelines.iteritems():
+            steps_by_tiid[tiid] = [step for step in pipeline if step and step[0][0]==method_name]
+
+        num_rounds = max([len(steps) for steps in steps_by_tiid.values()] + [0])
+        for i in range(num_rounds):
+            round_groups = defaultdict(list)
+            for (tiid, steps) in steps_by_tiid.iteritems():
+                if i < len(steps):
+                    for method_and_provider in steps[i]:
+                        round_groups[method_and_provider].append(tiid)
+            rounds.append(dict(round_groups))
+    return rounds
+
+
+def wait_for_rate_limit(provider_name):
+    # short waits for the rate limiter happen right here.  a longer one, like
+    # after the upstream sent a Retry-After, gives up on the group instead of 
+    # holding a pool thread past its timeout.
+    (success, estimated_wait_seconds) = rate.acquire(provider_name, block=False)
+    while not success:
+        if estimated_wait_seconds > MAX_INLINE_RATE_LIMIT_WAIT_SECONDS:
+            raise ProviderRateLimitError(u"RATE LIMIT HIT for {provider}, {wait:.1f} seconds to wait".format(
+                provider=provider_name, wait=estimated_wait_seconds))
+        time.sleep(estimated_wait_seconds)
+        (success, estimated_wait_seconds) = rate.acquire(provider_name, block=False)
 
-            # code above counts on this format of task id, starting with task-provider
-            new_task_id = "task-provider-{tiid}-{method_name}-{provider_name}-{uuid}".format(
-                tiid=tiid, method_name=method_name, provider_name=provider_name, uuid=uuid_bit)
 
-            group_list.append(new_task.set(task_id=new_task_id))
-            task_ids.append(new_task_id)
-        if group_list:
-            chain_list.append(group(group_list))
-            dummy_name = "DUMMY_{method_name}_{provider_name}".format(
-                method_name=method_name, provider_name=provider_name)
-            chain_list.append(chain_dummy.si(tiid, dummy=dummy_name).set(queue="core_"+task_priority))
+def run_provider_batch(tiids, method_name, provider_name):
+    # runs one provider method for many tiids, waiting for the rate limiter
+    # rather than retrying a task.  timed out by run_refresh_rounds.
+    provider = ProviderFactory.get_provider(provider_name)
+    num_upstream_calls = int(math.ceil(float(len(tiids)) / provider.max_batch_size))
+    for i in range(num_upstream_calls):
+        wait_for_rate_limit(provider_name)
 
-    # do this before we kick off the tasks to make sure they are there before tasks finish
-    myredis.set_provider_task_ids(tiid, task_ids)
+    try:
+        provider_batch_method_wrapper(tiids, provider, method_name)
+    finally:
+        db.session.remove()  # each thread has its own session
 
-    new_task = after_refresh_complete.si(tiid).set(priority=0, queue="core_"+task_priority)
-    uuid_bit = uuid().split("-")[0]
-    new_task_id = "task-after-{tiid}-DONE-{uuid}".format(
-        tiid=tiid, uuid=uuid_bit)
-    chain_list.append(new_task.set(task_id=new_task_id))
 
-    workflow = chain(chain_list)
+def run_refresh_rounds(rounds, provider_pool):
+    # the (method, provider) groups within a round run in parallel.
+    # returns a dict of tiid: {"method:provider": error} for what went wrong
+    provider_errors = defaultdict(dict)
 
-    # see http://stackoverflow.com/questions/18872854/getting-task-id-inside-a-celery-task
-    # workflow_tasks_task.task_id, 
-    # logger.info(u"before apply_async for tiid {tiid}, get_refresh_tiid_pipeline id {task_id}".format(
-    #     tiid=tiid, task_id=get_refresh_tiid_pipeline.request.id))
+    def run_group(group):
+        ((method_name, provider_name), tiids) = group
+        step_name = u"{method_name}:{provider_name}".format(
+            method_name=method_name, provider_name=provider_name)
+        try:
+            run_provider_batch(tiids, method_name, provider_name)
+        except Exception, e:
+            logger.info(u"Exception in refresh_tiids_batch for {step_name} on {num} tiids: {exception_type} {exception_arguments}".format(
+                step_name=step_name, num=len(tiids),
+                exception_type=type(e).__name__, exception_arguments=e.args))
+            return (tiids, step_name, repr(e))
+        return None
 
-    workflow_apply_async = workflow.apply_async(queue="core_"+task_priority)  
+    for round_groups in rounds:
+        groups = round_groups.items()
+        results = [provider_pool.apply_async(run_group, (group, )) for group in groups]
+
+        # every group in the round gets PROVIDER_TIMEOUT_SECONDS from when the
+        # round started.  a blocking call can't be interrupted in its thread, so 
+        # a group that runs over is left behind and counted as an error.
+        deadline = time.time() + PROVIDER_TIMEOUT_SECONDS
+        for (group, result) in zip(groups, results):
+            try:
+                error = result.get(max(0, deadline - time.time()))
+            except TimeoutError:
+                ((method_name, provider_name), tiids) = group
+                step_name = u"{method_name}:{provider_name}".format(
+                    method_name=method_name, provider_name=provider_name)
+                msg = u"TIMEOUT in refresh_tiids_batch for {step_name} on {num} tiids after {timeout_seconds} seconds".format(
+                    step_name=step_name, num=len(tiids), timeout_seconds=PROVIDER_TIMEOUT_SECONDS)
+                logger.warning(msg)
+                error = (tiids, step_name, repr(ProviderTimeout(msg)))
+
+            if error:
+                (tiids, step_name, message) = error
+                for tiid in tiids:
+                    provider_errors[tiid][step_name] = message
+
+    return provider_errors
 
-    workflow_tasks = workflow.tasks
-    workflow_trackable_task = workflow_tasks[-1]  # see http://blog.cesarcd.com/2014/04/tracking-status-of-celery-chain.html
-    workflow_trackable_id = workflow_trackable_task.id
 
-    # see http://stackoverflow.com/questions/18872854/getting-task-id-inside-a-celery-task
-    # workflow_tasks_task.task_id, 
-    # logger.info(u"task id for tiid {tiid}, refresh_tiids id {task_id}, workflow_trackable_id {workflow_trackable_id} task_ids={task_ids}".format(
-    #     tiid=tiid, task_id=get_refresh_tiid_pipeline.request.id, workflow_trackable_id=workflow_trackable_id, task_ids=task_ids))
+@task(base=ClearDbSessionTask)
+def refresh_tiids_batch(profile_id, tiids):
+    # refreshes a chunk of a profile's tiids in one task, instead of a chain of tasks per tiid
+    products = get_products_from_tiids(tiids, ignore_order=True, load=["alias_rows", "biblio_rows"])
+    pipelines = {}
+    for product in products:
+        pipelines[product.tiid] = sniffer(product.genre, product.host, product.aliases_for_providers)
+    db.session.remove()
+
+    if not pipelines:
+        logger.warning(u"No products in refresh_tiids_batch for tiids {tiids}".format(
+           tiids=tiids))
+        tiids_refresh_finished(profile_id, tiids)
+        return None
 
-    return workflow
+    provider_pool = ThreadPool(BATCH_PROVIDER_CONCURRENCY)
+    try:
+        provider_errors = run_refresh_rounds(refresh_rounds(pipelines), provider_pool)
+    finally:
+        # not close and join, which would wait on any group that timed out
+        provider_pool.terminate()
 
+    for tiid in pipelines:
+        mark_product_refresh_complete(tiid, provider_errors=provider_errors.get(tiid, {}))
+        myredis.clear_provider_task_ids(tiid)
 
+    # tiids we didn't find products for are counted as done too
+    tiids_refresh_finished(profile_id, tiids)
+    return tiids
 
 
 
@@ -412,21 +530,18 @@ def put_on_celery_queue(profile_id, tiids, task_priority="high"):
     else:
         priority_number = 9
 
-    refresh_all_tiids_tasks = []
-
-    for tiid in tiids:
-        refresh_a_tiid_tasks = get_refresh_tiid_pipeline(tiid, task_priority)
-        # refresh_all_tiids_tasks.append(group(refresh_a_tiid_tasks))
-
-    # if refresh_all_tiids_tasks:
-        # end_task = done_all_refreshes.si(profile_id).set(priority=priority_number, queue="core_"+task_priority)
-        # chain_list = group(refresh_all_tiids_tasks) | end_task
-
-        # chain_list = group(refresh_all_tiids_tasks)
-        # logger.info(u"in put_on_celery_queue, chain_list={chain_list}".format(
-        #     chain_list=chain_list))
-        # chain_list_apply_async = chain_list.apply_async(queue="core_"+task_priority)
-
+    for i in range(0, len(tiids), REFRESH_TIIDS_PER_TASK):
+        tiids_chunk = tiids[i:i+REFRESH_TIIDS_PER_TASK]
+        uuid_bit = uuid().split("-")[0]
+
+        # on_failure counts on this format of task id, starting with task-batch
+        new_task_id = "task-batch-{profile_id}-{uuid}".format(
+            profile_id=profile_id, uuid=uuid_bit)
+        refresh_tiids_batch.apply_async(
+            args=[profile_id, tiids_chunk], 
+            task_id=new_task_id,
+            priority=priority_number, 
+            queue="core_"+task_priority)
 
     logger.info(u"after apply_async in put_on_celery_queue for {profile_id}".format(
         profile_id=profile_id))
@@ -8,6 +8,9 @@ from totalimpactwebapp.pinboard import Pinboard
 from totalimpactwebapp.reference_set import save_all_reference_set_lists
 from totalimpactwebapp.reference_set import RefsetBuilder
 from totalimpactwebapp.product_deets import populate_product_deets
+from totalimpactwebapp.product_summary import mark_product_summaries_stale
+from totalimpactwebapp.product_markup import bump_markup_generation
+from totalimpactwebapp.response_cache import invalidate_cached_responses
 from totalimpactwebapp.drip_email import log_drip_email
 from totalimpactwebapp.tweeter import Tweeter
 from totalimpactwebapp.tweeter import get_and_save_tweeter_followers
@@ -22,7 +25,8 @@ from totalimpactwebapp import ti_queues
 from db_backup_to_s3 import upload_to_s3
 import tasks
 
-from sqlalchemy import and_, or_, func, between
+from sqlalchemy import and_, or_, func, between, tuple_
+from sqlalchemy.orm import class_mapper
 import datetime
 import os
 import requests
@@ -36,6 +40,8 @@ import csv
 import urllib
 import hashlib
 import json
+import redis
+import multiprocessing
 
 # logger is set below, in main
 
@@ -53,78 +59,109 @@ except ImportError:
     pass
 
 
-def page_query(q):
-    offset = 0
-    while True:
-        r = False
-        for elem in q.limit(50).offset(offset):
-           r = True
-           yield elem
-        offset += 50
-        if not r:
-            break
+# rows per keyset chunk; bigger is fewer round trips, smaller is less memory
+KEYSET_CHUNK_SIZE = int(os.getenv("DAILY_CHUNK_SIZE", 100))
 
-# from https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/WindowedRangeQuery
-# cited from many webpages as good way to do paging
-def column_windows(session, column, windowsize):
-    """Return a series of WHERE clauses against 
-    a given column that break it into windows.
+# set in __main__, so jobs run from the command line checkpoint their progress
+job_name = None
+resume_job = False
 
-    Result is an iterable of tuples, consisting of
-    ((start, end), whereclause), where (start, end) are the ids.
 
-    Requires a database that supports window functions, 
-    i.e. Postgresql, SQL Server, Oracle.
+class Checkpoint(object):
+    """
+    Remembers in redis the key of the last row a job finished, so a rerun 
+    with --resume picks up after it instead of starting from the top.
+    """
 
-    Enhance this yourself !  Add a "where" argument
-    so that windows of just a subset of rows can
-    be computed.
+    def __init__(self, name, resume=False):
+        self.redis_key = u"daily_checkpoint:{name}".format(name=name)
+        self.resume = resume
+        self.redis = redis.from_url(os.getenv("REDIS_URL", "redis://127.0.0.1:6379"))
 
-    """
-    def int_for_range(start_id, end_id):
-        if end_id:
-            return and_(
-                column>=start_id,
-                column<end_id
-            )
-        else:
-            return column>=start_id
-
-    q = session.query(
-                column, 
-                func.row_number().\
-                        over(order_by=column).\
-                        label('rownum')
-                ).\
-                from_self(column)
-    if windowsize > 1:
-        q = q.filter("rownum %% %d=1" % windowsize)
-
-    intervals = [id for id, in q]
-
-    while intervals:
-        start = intervals.pop(0)
-        if intervals:
-            end = intervals[0]
-        else:
-            end = None
-        yield int_for_range(start, end)
+    def load(self):
+        if not self.resume:
+            return None
+        saved = self.redis.get(self.redis_key)
+        if saved is None:
+            return None
+        logger.info(u"resuming from checkpoint {redis_key}".format(
+            redis_key=self.redis_key))
+        return pickle.loads(saved)
+
+    def save(self, last_key):
+        self.redis.set(self.redis_key, pickle.dumps(last_key), ex=60*60*24*7)
 
+    def clear(self):
+        self.redis.delete(self.redis_key)
 
 
-def windowed_query(q, column, windowsize, desc=False):
-    """"Break a Query into windows on a given column."""
+def keyset_query(q, column, chunk_size=KEYSET_CHUNK_SIZE, desc=False, checkpoint=None):
+    """
+    Yields everything q returns, ordered by column, chunk_size rows at a time.
+
+    Each chunk seeks past the last row of the chunk before 
+    (WHERE column > last_value ... LIMIT chunk_size), so it is an index range 
+    scan rather than an OFFSET that rescans every row it skips.  Ties in 
+    column are broken on the primary key, so nothing is skipped or repeated.
+    Rows where column is NULL are not returned.
 
-    for whereclause in column_windows(
-                                        q.session, 
-                                        column, windowsize):
+    checkpoint - a Checkpoint to resume from and save progress to.  it's
+        saved after each chunk, so a resumed job may redo up to a chunk of rows.
+    """
+    mapper = class_mapper(column.class_)
+    tiebreak_columns = [c for c in mapper.primary_key if c is not column.property.columns[0]]
+    tiebreak_keys = [mapper.get_property_by_column(c).key for c in tiebreak_columns]
+    sort_columns = [column] + tiebreak_columns
+    if desc:
+        q = q.order_by(None).order_by(*[c.desc() for c in sort_columns])
+    else:
+        q = q.order_by(None).order_by(*sort_columns)
+
+    def past(last_key):
+        (last_value, last_tiebreak) = last_key
         if desc:
-            for row in q.filter(whereclause).order_by(column.desc()):
-                yield row
+            if not tiebreak_columns:
+                return column < last_value
+            return and_(column <= last_value, 
+                or_(column < last_value, tuple_(*tiebreak_columns) < tuple_(*last_tiebreak)))
         else:
-            for row in q.filter(whereclause).order_by(column):
-                yield row
+            if not tiebreak_columns:
+                return column > last_value
+            return and_(column >= last_value, 
+                or_(column > last_value, tuple_(*tiebreak_columns) > tuple_(*last_tiebreak)))
+
+    last_key = None
+    if checkpoint:
+        last_key = checkpoint.load()
+
+    while True:
+        chunk_q = q.filter(column != None)
+        if last_key:
+            chunk_q = chunk_q.filter(past(last_key))
+        rows = chunk_q.limit(chunk_size).all()
+
+        for row in rows:
+            yield row
+            last_key = (getattr(row, column.key), tuple(getattr(row, k) for k in tiebreak_keys))
+
+        # once per chunk, after all its rows have been handled
+        if checkpoint and rows:
+            checkpoint.save(last_key)
+
+        if len(rows) < chunk_size:
+            break
 
+    if checkpoint:
+        checkpoint.clear()
+
+
+def windowed_query(q, column, chunk_size=KEYSET_CHUNK_SIZE, desc=False):
+    """"Stream a Query in chunks on a given column, checkpointing if run as a job."""
+    checkpoint = None
+    if job_name:
+        checkpoint = Checkpoint(u"{job_name}:{column}".format(
+            job_name=job_name, column=column), resume=resume_job)
+    return keyset_query(q, column, chunk_size, desc, checkpoint)
 
 
 
@@ -185,7 +222,7 @@ def profile_deets(url_slug=None,
         q = q.filter(Profile.url_slug>=min_url_slug)
 
     profile_deets = []
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         logger.info(u"profile_deets: {url_slug}".format(
             url_slug=profile.url_slug))
         profile_deets += [get_profile_summary_dict(profile)]
@@ -219,7 +256,7 @@ def profile_deets_live(args):
     start_time = datetime.datetime.utcnow()
     profile_deets = []
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         logger.info(u"profile_deets: {url_slug}".format(
             url_slug=profile.url_slug))
         profile_deets += [get_profile_summary_dict(profile)]
@@ -247,8 +284,7 @@ def add_product_deets_for_everyone(url_slug=None, skip_until_url_slug=None):
         profile_iterator = [Profile.query.filter_by(url_slug=url_slug).first()]
     else:
         q = db.session.query(Profile)
-        profile_iterator = windowed_query(q, Profile.url_slug, 25)
-        # profile_iterator = page_query(Profile.query.order_by(Profile.url_slug.asc()))
+        profile_iterator = windowed_query(q, Profile.url_slug)
 
     run_id = datetime.datetime.utcnow().isoformat()
     for profile in profile_iterator:
@@ -276,7 +312,7 @@ def dedup_everyone(url_slug=None, min_url_slug=None):
     elif min_url_slug:
         q = q.filter(Profile.url_slug>=min_url_slug)
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         if profile.is_live:
             logger.info(u"dedup: {url_slug}".format(url_slug=profile.url_slug))
             response = profile.remove_duplicates()
@@ -287,7 +323,7 @@ def mint_stripe_customers_for_all_profiles():
 
     stripe.api_key = os.getenv("STRIPE_API_KEY")
 
-    for profile in page_query(Profile.query.order_by(Profile.email.asc())):
+    for profile in windowed_query(Profile.query, Profile.email):
 
         if profile.stripe_id:
             print u"Already a Stripe customer for {email}; skipping".format(
@@ -326,7 +362,7 @@ def mint_stripe_customers_for_all_profiles():
 def write_500_random_profile_urls():
     urls = []
     sample_size = 500
-    for profile in page_query(Profile.query):
+    for profile in windowed_query(Profile.query, Profile.id):
         products_count = len(profile.tiids)
         if products_count > 0:
             url = "https://staging-impactstory.org/" + profile.url_slug
@@ -360,7 +396,7 @@ def email_report_to_live_profiles(url_slug=None, min_url_slug=None, max_emails=N
 
     q = profile_query(url_slug, min_url_slug)
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
 
         # logger.debug(u"in email_report_to_live_profiles for {url_slug}".format(
         #     url_slug=profile.url_slug))
@@ -408,7 +444,7 @@ def email_all_profiles_about_tng(url_slug=None, min_url_slug=None, max_emails=No
 
     q = profile_query(url_slug, min_url_slug)
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
 
         logger.debug(u"in email_all_profiles_about_tng for {url_slug}".format(
             url_slug=profile.url_slug))
@@ -429,17 +465,60 @@ def email_all_profiles_about_tng(url_slug=None, min_url_slug=None, max_emails=No
 
     return
 
-def build_refsets(save_after_every_profile=False):
+# more shards than processes, so a slow shard doesn't hold up the others much
+REFSET_SHARDS_PER_PROCESS = 4
+
+def build_refset_shard(shard_args):
+    # runs in a pool process: builds refsets from the profiles in one shard
+    (shard, number_of_shards) = shard_args
     refset_builder = RefsetBuilder()
 
-    q = db.session.query(Profile)
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    q = db.session.query(Profile).filter(Profile.id % number_of_shards == shard)
+    for profile in keyset_query(q, Profile.url_slug):
         refset_builder.process_profile(profile)
-        if save_after_every_profile:
-            save_all_reference_set_lists(refset_builder)
+
+    db.session.remove()
+    return refset_builder
+
+
+def build_refsets_in_processes(processes):
+    number_of_shards = processes * REFSET_SHARDS_PER_PROCESS
+    shards = [(shard, number_of_shards) for shard in range(number_of_shards)]
+
+    # so the pool processes don't inherit our database connections
+    db.session.remove()
+    db.engine.dispose()
+
+    refset_builder = RefsetBuilder()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for shard_refset_builder in pool.imap_unordered(build_refset_shard, shards):
+            refset_builder.merge(shard_refset_builder)
+    finally:
+        pool.close()
+        pool.join()
+    return refset_builder
+
+
+def build_refsets(save_after_every_profile=False, processes=1):
+    if processes > 1 and not save_after_every_profile:
+        refset_builder = build_refsets_in_processes(processes)
+    else:
+        refset_builder = RefsetBuilder()
+
+        q = db.session.query(Profile)
+        for profile in windowed_query(q, Profile.url_slug):
+            refset_builder.process_profile(profile)
+            if save_after_every_profile:
+                save_all_reference_set_lists(refset_builder, swap=False)
 
     save_all_reference_set_lists(refset_builder)
 
+    # percentiles and awards come from the refsets, so every summary and markup needs rebuilding
+    mark_product_summaries_stale()
+    commit(db)
+    bump_markup_generation()
+
 
 
 def collect_embed(url_slug=None, min_url_slug=None):
@@ -448,7 +527,7 @@ def collect_embed(url_slug=None, min_url_slug=None):
     start_time = datetime.datetime.utcnow()
     number_considered = 0.0
     number_markups = 0.0
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         logger.debug("-->collecting embed for {url_slug}".format(
             url_slug=profile.url_slug))
 
@@ -499,7 +578,7 @@ def borked_pinboards_for_life_profiles(url_slug=None, min_url_slug=None):
         q = live_profile_query()
         if min_url_slug:
             q = q.filter(Profile.url_slug>=min_url_slug)
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         all_profile_tiids = [product.tiid for product in profile.products] #includes removed
         print profile.url_slug, profile.id        
         board = Pinboard.query.filter_by(profile_id=profile.id).first()
@@ -537,7 +616,7 @@ def new_metrics_for_live_profiles(url_slug=None, min_url_slug=None, start_days_a
     start_time = datetime.datetime.utcnow()
     number_profiles = 0.0
     total_refreshes = 0
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         number_profiles += 1
         print profile.url_slug, profile.id, profile.last_refreshed, len(profile.display_products)
         number_refreshes = len(profile.display_products)
@@ -560,7 +639,7 @@ from totalimpactwebapp.countries_info import country_iso_by_name
 def update_mendeley_countries_for_live_profiles(url_slug=None, min_url_slug=None):
     q = profile_query(url_slug, min_url_slug)
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         logger.info(u"{url_slug} processing mendeley countries".format(
             url_slug=profile.url_slug))
         for product in profile.display_products:
@@ -605,7 +684,7 @@ def collect_new_mendeley(url_slug=None, min_url_slug=None):
     start_time = datetime.datetime.utcnow()
     number_profiles = 0.0
     total_refreshes = 0
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         number_profiles += 1
         number_refreshes = 0.0
         print profile.url_slug, profile.id
@@ -637,7 +716,7 @@ def linked_accounts(account_type, url_slug=None, min_url_slug=None):
             q = db.session.query(Profile).filter(getattr(Profile, column_name) != None)
 
     number_considered = 0.0
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         number_considered += 1
         logger.info(u"{url_slug} previous number of account products: {num}".format(
             url_slug=profile.url_slug, num=len(profile.account_products)))
@@ -674,7 +753,7 @@ def refresh_twitter(min_tiid=None):
     start_time = datetime.datetime.utcnow()
     number_considered = 0.0
     number_refreshed = 0
-    for product in windowed_query(q, Product.tiid, 25):
+    for product in windowed_query(q, Product.tiid):
         number_considered += 1
         try:
             if product.biblio.repository=="Twitter" and len(product.metrics)==0:
@@ -699,7 +778,7 @@ def refresh_tweeted_products(min_tiid=None):
     start_time = datetime.datetime.utcnow()
     number_considered = 0.0
     number_refreshed = 0
-    for product in windowed_query(q, Product.tiid, 25):
+    for product in windowed_query(q, Product.tiid):
         number_considered += 1
         try:
             if product.get_metric_by_name("altmetric_com", "tweets"):
@@ -718,12 +797,13 @@ def run_through_altmetric_tweets(url_slug=None, min_url_slug=None):
     q = profile_query(url_slug, min_url_slug)
 
     total_objects_saved = 0
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         logger.info(u"{url_slug}".format(
             url_slug=profile.url_slug))
 
         new_objects = save_product_tweets_for_profile(profile)
         total_objects_saved += len(new_objects)
+        invalidate_cached_responses(profile.url_slug)  # its cached /products/tweets
         print "total_objects_saved", total_objects_saved
 
 
@@ -738,11 +818,12 @@ def run_through_twitter_pages(url_slug=None, min_url_slug=None):
 
     from totalimpactwebapp.tweet import save_recent_tweets
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
 
         logger.info(u"{url_slug} has twitter handle {twitter_handle}, now saving tweets".format(
             url_slug=profile.url_slug, twitter_handle=profile.twitter_id))
         save_recent_tweets(profile.id, profile.twitter_id)
+        invalidate_cached_responses(profile.url_slug)
 
 
 
@@ -754,7 +835,7 @@ def run_through_twitter_pages(url_slug=None, min_url_slug=None):
 
 #     number_considered = 0.0
 #     start_time = datetime.datetime.utcnow()
-#     for profile in windowed_query(q, Profile.url_slug, 25):
+#     for profile in windowed_query(q, Profile.url_slug):
 #         number_considered += 1
 
 #         board = Pinboard.query.filter_by(profile_id=profile.id).first()
@@ -795,7 +876,7 @@ def count_news_for_subscribers(url_slug=None, min_url_slug=None):
     total_with_news = 0
     total_number_of_products_with_news = defaultdict(int)
     start_time = datetime.datetime.utcnow()
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         if profile.is_paid_subscriber:
 
             number_considered += 1
@@ -841,7 +922,7 @@ def send_drip_emails(url_slug=None, min_url_slug=None):
         if min_url_slug:
             q = q.filter(Profile.url_slug >= min_url_slug)
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         # logger.info(u"in send_drip_emails with {url_slug}".format(
         #     url_slug=profile.url_slug))
 
@@ -864,7 +945,7 @@ def ip_deets():
     from totalimpactwebapp.interaction import get_ip_insights 
     q = db.session.query(Interaction)
     cache = {}
-    for interaction in windowed_query(q, Interaction.ip, 25):
+    for interaction in windowed_query(q, Interaction.ip):
         if interaction.country:
             continue
             
@@ -894,7 +975,7 @@ def countries_for_all_profiles(url_slug=None, min_created_date=None):
     start_time = datetime.datetime.utcnow()
     number_profiles = 0.0
     total_refreshes = 0
-    for profile in windowed_query(q, Profile.created, 25):  # sort by created
+    for profile in windowed_query(q, Profile.created):  # sort by created
 
         if number_profiles > 500:
             print "ok, got country data for 500 profiles. quitting."
@@ -934,11 +1015,12 @@ def update_twitter_followers(max_pages):
 def update_tweet_text_for_live_profiles(url_slug=None, min_url_slug=None):
     q = profile_query(url_slug, min_url_slug)
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         logger.info(u"in update_tweet_text_for_live_profiles for {url_slug}".format(
             url_slug=profile.url_slug))
 
         profile.parse_and_save_tweets()
+        invalidate_cached_responses(profile.url_slug)
 
 
 
@@ -1014,7 +1096,7 @@ def live_profile_emails(args):
     q = profile_query(url_slug, min_url_slug)
 
     number_profiles_updated = 0.0
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         print profile.email
 
 
@@ -1032,7 +1114,7 @@ def update_all_live_profiles(args):
         limit = 1
 
     number_profiles_updated = 0.0
-    for profile in windowed_query(q, Profile.next_refresh, 25, desc=False):
+    for profile in windowed_query(q, Profile.next_refresh, desc=False):
         product_count = len(profile.products_not_removed)
         logger.info(u"profile {url_slug} has {product_count} products".format(
             url_slug=profile.url_slug, product_count=product_count))
@@ -1117,7 +1199,7 @@ def debug_biblio_for_live_profiles(args):
 
     from totalimpactwebapp.product import put_biblio_in_product
 
-    for profile in windowed_query(q, Profile.url_slug, 25):
+    for profile in windowed_query(q, Profile.url_slug):
         logger.info(u"in debug_biblio_for_live_profiles for {url_slug}".format(
             url_slug=profile.url_slug))
 
@@ -1152,7 +1234,7 @@ def main(function, args):
     elif function=="productdeets":
         add_product_deets_for_everyone(args["url_slug"], args["skip_until_url_slug"])
     elif function=="refsets":
-        build_refsets(args["save_after_every_profile"])
+        build_refsets(args["save_after_every_profile"], args["processes"])
     elif function=="embed":
         collect_embed(args["url_slug"], args["min_url_slug"])
     elif function=="linked_accounts":
@@ -1210,6 +1292,7 @@ if __name__ == "__main__":
     parser.add_argument('--tiid', default=None, type=str, help="tiid")
     parser.add_argument('--min_tiid', default=None, type=str, help="min_tiid")
     parser.add_argument('--save_after_every_profile', action='store_true', help="use to debug refsets, saves refsets to db after every profile.  slow.")
+    parser.add_argument('--processes', default=1, type=int, help="number of processes to build refsets with")
     parser.add_argument('--max_emails', default=None, type=int, help="max number of emails to send")
     parser.add_argument('--account_type', default=None, type=str, help="account_type")
     parser.add_argument('--start_days_ago', type=int)
@@ -1218,6 +1301,7 @@ if __name__ == "__main__":
     parser.add_argument('--max_pages', type=int)
     parser.add_argument('--force_all', type=int)
     parser.add_argument('--no-rq', action="store_true", help="do jobs in this thread")
+    parser.add_argument('--resume', action="store_true", help="start after the last row the previous run of this function finished")
 
     args = vars(parser.parse_args())
     function = args["function"]
@@ -1229,6 +1313,9 @@ if __name__ == "__main__":
     global logger
     logger = logging.getLogger("ti.daily.{function}".format(
         function=function))
+
+    job_name = function
+    resume_job = args["resume"]
     
     main(function, args)
 
@@ -1,8 +1,8 @@
 import mandrill
 import os
 import logging
-import jinja2
 from totalimpactwebapp.testing import is_test_email
+import util
 
 
 logger = logging.getLogger("ti.emailer")
@@ -12,9 +12,7 @@ def send(address, subject, template_name, context):
     if is_test_email(address):
         return False
 
-    templateLoader = jinja2.FileSystemLoader(searchpath="totalimpactwebapp/templates")
-    templateEnv = jinja2.Environment(loader=templateLoader)
-    html_template = templateEnv.get_template(template_name + ".html")
+    html_template = util.get_template(template_name + ".html")
 
     html_to_send = html_template.render(context)
 
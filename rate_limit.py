@@ -245,6 +245,161 @@ class RateLimiter(object):
         return True, 0.0
 
 
+
+DEFAULT_REQUESTS_PER_SECOND = 25
+
+# Token bucket, refilled continuously at rate * rate_factor tokens per second
+# up to burst.  rate_factor drops when the upstream tells us to slow down, and
+# recovers by recovery_per_second.  All in one script so it is atomic without locks.
+TOKEN_BUCKET_ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local recovery_per_second = tonumber(ARGV[5])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at", "rate_factor")
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+local rate_factor = tonumber(bucket[3]) or 1
+
+local elapsed = math.max(0, now - updated_at)
+rate_factor = math.min(1, rate_factor + elapsed * recovery_per_second)
+local effective_rate = rate * rate_factor
+tokens = math.min(burst, tokens + elapsed * effective_rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = (requested - tokens) / effective_rate
+end
+
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "updated_at", tostring(now), "rate_factor", tostring(rate_factor))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / effective_rate + wait) + 60)
+return {allowed, tostring(wait)}
+"""
+
+TOKEN_BUCKET_PENALIZE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local backoff_factor = tonumber(ARGV[3])
+local min_rate_factor = tonumber(ARGV[4])
+local retry_after = tonumber(ARGV[5])
+
+local rate_factor = tonumber(redis.call("HGET", KEYS[1], "rate_factor")) or 1
+rate_factor = math.max(min_rate_factor, rate_factor * backoff_factor)
+
+-- empty the bucket, and go into debt if upstream said how long to wait
+local tokens = -retry_after * rate * rate_factor
+
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "updated_at", tostring(now), "rate_factor", tostring(rate_factor))
+redis.call("EXPIRE", KEYS[1], math.ceil(retry_after + 1 / min_rate_factor) + 60)
+return tostring(rate_factor)
+"""
+
+
+def quotas_from_provider_config(config_providers):
+    """
+    Builds {provider_name: (requests_per_second, burst)} from a providers config 
+    list like default_settings.PROVIDERS, where each provider's config dict can 
+    have "requests_per_second" and "burst" keys.
+    """
+    quotas = {}
+    for (provider_name, provider_config) in config_providers:
+        if "requests_per_second" in provider_config:
+            requests_per_second = float(provider_config["requests_per_second"])
+            burst = float(provider_config.get("burst", max(1, requests_per_second)))
+            quotas[provider_name] = (requests_per_second, burst)
+    return quotas
+
+
+class TokenBucketRateLimiter(object):
+    """
+    Redis backed token bucket rate limiter with a quota per key.
+    Has the same acquire interface as RateLimiter, but each acquire is a single
+    atomic script call with no lock, and the rate adapts: penalize() slows a key 
+    down when its upstream says we are going too fast, and it speeds back up 
+    over time.
+    """
+
+    def __init__(self, quotas=None,
+                default_quota=(DEFAULT_REQUESTS_PER_SECOND, DEFAULT_REQUESTS_PER_SECOND),
+                redis_db=0,
+                redis_namespace='tokenbucket',
+                redis_url=None,
+                backoff_factor=0.5,
+                min_rate_factor=0.05,
+                recovery_seconds=300):
+        """
+        quotas - dict of key: (requests per second, burst)
+        default_quota - (requests per second, burst) for keys not in quotas
+        backoff_factor - rate is multiplied by this on each penalize
+        min_rate_factor - rate never drops below this fraction of the quota
+        recovery_seconds - how long to recover from min_rate_factor to the full quota
+        """
+        if redis_url:
+            self.redis = redis.Redis.from_url(redis_url, db=redis_db)
+        else:
+            self.redis = redis.Redis(db=redis_db)
+        self.log = logging.getLogger('TokenBucketRateLimiter')
+        self.namespace = redis_namespace
+        self.quotas = quotas or {}
+        self.default_quota = default_quota
+        self.backoff_factor = backoff_factor
+        self.min_rate_factor = min_rate_factor
+        self.recovery_per_second = (1.0 - min_rate_factor) / recovery_seconds
+        self._acquire_script = self.redis.register_script(TOKEN_BUCKET_ACQUIRE_SCRIPT)
+        self._penalize_script = self.redis.register_script(TOKEN_BUCKET_PENALIZE_SCRIPT)
+
+    def _bucket_key(self, key):
+        return ':'.join((self.namespace, key))
+
+    def quota(self, key):
+        return self.quotas.get(key, self.default_quota)
+
+    def acquire(self, key, block=True, tokens=1):
+        """
+        Takes tokens from key's bucket if there are enough.
+        block - Whether to wait until we can make the request.  If not, 
+            returns (success, seconds to wait before trying again)
+        """
+        if block:
+            while True:
+                success, wait = self._take(key, tokens)
+                if success:
+                    return True
+                self.log.debug('(%s) blocking acquire sleeping for %.1fs', key, wait)
+                time.sleep(wait)
+        else:
+            return self._take(key, tokens)
+
+    # alternative acquire interface ratelimiter(key)
+    __call__ = acquire
+
+    def _take(self, key, tokens):
+        (requests_per_second, burst) = self.quota(key)
+        (allowed, wait) = self._acquire_script(
+            keys=[self._bucket_key(key)], 
+            args=[requests_per_second, burst, time.time(), tokens, self.recovery_per_second])
+        return (allowed == 1, float(wait))
+
+    def penalize(self, key, retry_after=0):
+        """
+        Call when the upstream for key says we are over its rate limit.
+        Cuts key's rate by backoff_factor, and if retry_after seconds 
+        are given, holds off requests for that long.
+        """
+        (requests_per_second, burst) = self.quota(key)
+        rate_factor = self._penalize_script(
+            keys=[self._bucket_key(key)], 
+            args=[requests_per_second, time.time(), self.backoff_factor, self.min_rate_factor, retry_after])
+        self.log.warn('(%s) rate limited by upstream, now at %s of quota', key, rate_factor)
+        return float(rate_factor)
+
+
 if __name__ == '__main__':
     """
     This is an example of rate limiting using the RateLimiter class
@@ -5,6 +5,15 @@ from nose.tools import assert_not_equals
 from nose.tools import assert_true
 
 import random
+import datetime
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from totalimpactwebapp import views_helpers
+
+
+def make_request(headers):
+    return Request(EnvironBuilder(headers=headers).get_environ())
 
 class TestViewsHelpers(unittest.TestCase):
 
@@ -13,3 +22,30 @@ class TestViewsHelpers(unittest.TestCase):
 
     def test_file_loads(self):
         assert True
+
+    def test_is_not_modified_matching_etag(self):
+        etag = views_helpers.make_etag(["fingerprint"], 1, None, "/profile/jason")
+        request = make_request({"If-None-Match": 'W/"{etag}"'.format(etag=etag)})
+        assert_true(views_helpers.is_not_modified(request, etag, None))
+
+    def test_is_not_modified_changed_etag(self):
+        etag = views_helpers.make_etag(["fingerprint"], 1, None, "/profile/jason")
+        new_etag = views_helpers.make_etag(["fingerprint"], 2, None, "/profile/jason")
+        request = make_request({"If-None-Match": 'W/"{etag}"'.format(etag=etag)})
+        assert_equals(views_helpers.is_not_modified(request, new_etag, None), False)
+
+    def test_is_not_modified_since(self):
+        now = datetime.datetime(2014, 3, 1, 18, 0, 0)
+        last_modified = datetime.datetime(2014, 3, 1, 12, 0, 0, 123)
+        request = make_request({"If-Modified-Since": "Sat, 01 Mar 2014 12:00:00 GMT"})
+        assert_true(views_helpers.is_not_modified(request, "etag", last_modified, now))
+
+        later = datetime.datetime(2014, 3, 1, 13, 0, 0)
+        assert_equals(views_helpers.is_not_modified(request, "etag", later, now), False)
+
+    def test_is_not_modified_since_yesterday(self):
+        # nothing changed, but the client's copy has yesterday's diffs
+        now = datetime.datetime(2014, 3, 2, 1, 0, 0)
+        last_modified = datetime.datetime(2014, 3, 1, 12, 0, 0)
+        request = make_request({"If-Modified-Since": "Sat, 01 Mar 2014 12:00:00 GMT"})
+        assert_equals(views_helpers.is_not_modified(request, "etag", last_modified, now), False)
@@ -40,6 +40,17 @@ class TestPlosalm(ProviderTestCase):
         expected = {'plosalm:pdf_views': 952, 'plosalm:html_views': 13642}
         assert_equals(metrics_dict, expected)
 
+    def test_extract_metrics_batch_success(self):
+        f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
+        good_page = f.read()
+        metrics_by_doi = self.provider._extract_metrics_batch(good_page)
+        expected = {"10.1371/journal.pone.0036240": {'plosalm:pdf_views': 952, 'plosalm:html_views': 13642}}
+        assert_equals(metrics_by_doi, expected)
+
+    def test_metrics_batch_no_relevant_aliases(self):
+        response = self.provider.metrics_batch([[("doi", "10.1234/notplos")], [("url", "http://a.com")]])
+        assert_equals(response, [{}, {}])
+
     @http
     def test_metrics(self):
         metrics_dict = self.provider.metrics([self.testitem_metrics])
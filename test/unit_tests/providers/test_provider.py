@@ -7,6 +7,7 @@ from test.utils import setup_postgres_for_unittests, teardown_postgres_for_unitt
 
 import simplejson, BeautifulSoup
 import os
+import time
 from sqlalchemy.sql import text    
 
 sampledir = os.path.join(os.path.split(__file__)[0], "../../../extras/sample_provider_pages/")
@@ -140,3 +141,30 @@ class TestProviderFactory():
         print md["pubmed"]
         assert_equals(md["pubmed"]['url'], 'http://pubmed.gov')
 
+
+
+class TestHttpSession():
+
+    def test_get_http_session_shared_per_host(self):
+        session = provider.get_http_session("http://en.wikipedia.org/w/api.php?srsearch=a")
+        same_session = provider.get_http_session("http://EN.wikipedia.org/wiki/Special:Search")
+        other_session = provider.get_http_session("http://alm.plos.org/api/v3/articles")
+        assert_equals(session is same_session, True)
+        assert_equals(session is other_session, False)
+
+
+class TestProviderCaching():
+
+    def test_cacheable_status_codes(self):
+        test_provider = Provider()
+        assert_equals(test_provider.cacheable_status_codes, [200])
+        test_provider.negative_cache_duration = 60
+        assert_equals(test_provider.cacheable_status_codes, [200, 404, 410])
+
+    def test_cached_response_is_stale(self):
+        cache_data = {"status_code": 200, "url": "http://a.com", "text": "hi"}
+        assert_equals(provider.CachedResponse(cache_data).is_stale, False)
+        cache_data["fresh_until"] = time.time() + 60
+        assert_equals(provider.CachedResponse(cache_data).is_stale, False)
+        cache_data["fresh_until"] = time.time() - 60
+        assert_equals(provider.CachedResponse(cache_data).is_stale, True)
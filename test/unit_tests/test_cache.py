@@ -0,0 +1,92 @@
+from nose.tools import assert_equals
+
+from totalimpact import cache as cache_module
+from totalimpact import tiredis
+from totalimpact.tiredis import REDIS_UNITTEST_DATABASE_NUMBER
+
+
+class UnittestCache(cache_module.Cache):
+    def _get_client(self):
+        return tiredis.from_url("redis://localhost:6379", db=REDIS_UNITTEST_DATABASE_NUMBER)
+
+    def _is_full(self):
+        return False
+
+
+class TestCache():
+
+    def setUp(self):
+        # we're putting unittests for redis in their own db (number 8) so they can be deleted with abandon
+        self.cache = UnittestCache(60)
+        self.cache._get_client().flushdb()
+        cache_module.local_cache.clear()
+
+    def test_set_and_get_cache_entry(self):
+        self.cache.set_cache_entry({"url": "http://a.com"}, {"text": "hi", "status_code": 200})
+        response = self.cache.get_cache_entry({"url": "http://a.com"})
+        assert_equals(response, {"text": "hi", "status_code": 200})
+
+    def test_set_cache_entry_expires(self):
+        self.cache.set_cache_entry({"url": "http://a.com"}, {"text": "hi", "status_code": 200})
+        hash_key = self.cache._build_hash_key({"url": "http://a.com"})
+        assert_equals(0 < self.cache._get_client().ttl(hash_key) <= 60, True)
+
+    def test_set_and_get_cache_entries(self):
+        self.cache.set_cache_entries([
+            ({"url": "http://a.com"}, {"text": "a", "status_code": 200}),
+            ({"url": "http://b.com"}, {"text": "b", "status_code": 404})
+            ])
+        response = self.cache.get_cache_entries([
+            {"url": "http://b.com"}, 
+            {"url": "http://missing.com"}, 
+            {"url": "http://a.com"}
+            ])
+        expected = [{"text": "b", "status_code": 404}, None, {"text": "a", "status_code": 200}]
+        assert_equals(response, expected)
+
+    def test_get_cache_entry_from_local_tier(self):
+        self.cache.set_cache_entry({"url": "http://a.com"}, {"text": "hi", "status_code": 200})
+        self.cache._get_client().flushdb()
+        response = self.cache.get_cache_entry({"url": "http://a.com"})
+        assert_equals(response["text"], "hi")
+
+    def test_get_cache_entries_empty(self):
+        assert_equals(self.cache.get_cache_entries([]), [])
+
+
+class TestLocalCache():
+
+    def setUp(self):
+        self.local_cache = cache_module.LocalCache(max_bytes=100)
+
+    def test_get_missing(self):
+        assert_equals(self.local_cache.get("a"), None)
+
+    def test_set_and_get(self):
+        self.local_cache.set("a", {"text": "a"}, 10, 60)
+        assert_equals(self.local_cache.get("a"), {"text": "a"})
+
+    def test_expired(self):
+        self.local_cache.set("a", {"text": "a"}, 10, -1)
+        assert_equals(self.local_cache.get("a"), None)
+        assert_equals(self.local_cache.size, 0)
+
+    def test_evicts_least_recently_used(self):
+        self.local_cache.set("a", {"text": "a"}, 40, 60)
+        self.local_cache.set("b", {"text": "b"}, 40, 60)
+        self.local_cache.get("a")
+        self.local_cache.set("c", {"text": "c"}, 40, 60)
+        assert_equals(self.local_cache.get("b"), None)
+        assert_equals(self.local_cache.get("a"), {"text": "a"})
+        assert_equals(self.local_cache.size, 80)
+
+    def test_evicts_expired_first(self):
+        self.local_cache.set("a", {"text": "a"}, 40, 60)
+        self.local_cache.set("b", {"text": "b"}, 40, -1)
+        self.local_cache.set("c", {"text": "c"}, 40, 60)
+        assert_equals(self.local_cache.get("a"), {"text": "a"})
+        assert_equals(self.local_cache.size, 80)
+
+    def test_too_big(self):
+        self.local_cache.set("a", {"text": "a"}, 101, 60)
+        assert_equals(self.local_cache.get("a"), None)
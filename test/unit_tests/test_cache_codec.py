@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import json
+import zlib
+from nose.tools import assert_equals, assert_true
+
+from totalimpact import cache_codec
+
+SAMPLE_DATA = {
+    "text": u"<html>" + u"caf\xe9 " * 1000 + u"</html>",
+    "status_code": 200,
+    "url": u"http://example.com/caf\xe9"
+    }
+
+
+class TestCacheCodec():
+
+    def test_roundtrip_zlib(self):
+        codec = cache_codec.get_codec("zlib")
+        encoded = cache_codec.encode(SAMPLE_DATA, codec)
+        assert_equals(cache_codec.decode(encoded), SAMPLE_DATA)
+
+    def test_roundtrip_no_compression(self):
+        codec = cache_codec.get_codec("none")
+        encoded = cache_codec.encode(SAMPLE_DATA, codec)
+        assert_equals(cache_codec.decode(encoded), SAMPLE_DATA)
+
+    def test_roundtrip_extra_keys(self):
+        data = dict(SAMPLE_DATA, headers={"content-type": "text/html"})
+        codec = cache_codec.get_codec("zlib")
+        encoded = cache_codec.encode(data, codec)
+        assert_equals(cache_codec.decode(encoded), data)
+
+    def test_roundtrip_missing_keys(self):
+        codec = cache_codec.get_codec("zlib")
+        for data in [{"text": u"hi", "status_code": 200}, {"status_code": 404}, {}]:
+            encoded = cache_codec.encode(data, codec)
+            assert_equals(cache_codec.decode(encoded), data)
+
+    def test_roundtrip_none_values(self):
+        data = {"text": None, "status_code": None, "url": None}
+        codec = cache_codec.get_codec("zlib")
+        encoded = cache_codec.encode(data, codec)
+        assert_equals(cache_codec.decode(encoded), data)
+
+    def test_zlib_is_smaller(self):
+        codec = cache_codec.get_codec("zlib")
+        encoded = cache_codec.encode(SAMPLE_DATA, codec)
+        assert_true(len(encoded) < len(json.dumps(SAMPLE_DATA)) / 5)
+
+    def test_decode_legacy_json(self):
+        assert_equals(cache_codec.decode(json.dumps(SAMPLE_DATA)), SAMPLE_DATA)
+
+    def test_unknown_codec_name_uses_zlib(self):
+        assert_equals(cache_codec.get_codec("snappy")["name"], "zlib")
@@ -0,0 +1,97 @@
+from nose.tools import assert_equals, assert_raises
+import time
+from multiprocessing.pool import ThreadPool
+
+import core_tasks
+from totalimpact.providers.provider import ProviderRateLimitError
+
+ARTICLE_PIPELINE = [
+    [("aliases", "mendeley")], 
+    [("aliases", "crossref")], 
+    [("biblio", "crossref"), ("biblio", "pubmed")],
+    [("metrics", "wikipedia"), ("metrics", "plosalm")]
+]
+
+GITHUB_PIPELINE = [
+    [("aliases", "github")], 
+    [("biblio", "github")],
+    [("metrics", "wikipedia"), ("metrics", "plosalm")]
+]
+
+
+class TestRefreshRounds():
+
+    def _sorted(self, rounds):
+        return [dict((k, sorted(v)) for (k, v) in round_groups.iteritems()) for round_groups in rounds]
+
+    def test_refresh_rounds_groups_tiids_by_provider(self):
+        rounds = core_tasks.refresh_rounds({"a": ARTICLE_PIPELINE, "b": GITHUB_PIPELINE, "c": ARTICLE_PIPELINE})
+        expected = [
+            {("aliases", "mendeley"): ["a", "c"], ("aliases", "github"): ["b"]},
+            {("aliases", "crossref"): ["a", "c"]},
+            {("biblio", "crossref"): ["a", "c"], ("biblio", "pubmed"): ["a", "c"], ("biblio", "github"): ["b"]},
+            {("metrics", "wikipedia"): ["a", "b", "c"], ("metrics", "plosalm"): ["a", "b", "c"]}
+        ]
+        assert_equals(self._sorted(rounds), expected)
+
+    def test_refresh_rounds_empty(self):
+        assert_equals(core_tasks.refresh_rounds({}), [])
+
+
+
+class TestRunRefreshRounds():
+
+    def setUp(self):
+        self.old_run_provider_batch = core_tasks.run_provider_batch
+        self.old_timeout_seconds = core_tasks.PROVIDER_TIMEOUT_SECONDS
+        core_tasks.run_provider_batch = self.run_provider_batch
+        core_tasks.PROVIDER_TIMEOUT_SECONDS = 0.5
+        self.pool = ThreadPool(2)
+
+    def tearDown(self):
+        core_tasks.run_provider_batch = self.old_run_provider_batch
+        core_tasks.PROVIDER_TIMEOUT_SECONDS = self.old_timeout_seconds
+        self.pool.terminate()
+
+    def run_provider_batch(self, tiids, method_name, provider_name):
+        if provider_name == "hangs":
+            time.sleep(5)
+        elif provider_name == "fails":
+            raise ValueError("nope")
+
+    def test_times_out_and_records_errors(self):
+        rounds = [{("metrics", "hangs"): ["a"], ("metrics", "fails"): ["a", "b"], ("metrics", "works"): ["b"]}]
+        start = time.time()
+        provider_errors = core_tasks.run_refresh_rounds(rounds, self.pool)
+
+        assert_equals(time.time() - start < 2, True)
+        assert_equals(sorted(provider_errors["a"].keys()), ["metrics:fails", "metrics:hangs"])
+        assert_equals(provider_errors["b"].keys(), ["metrics:fails"])
+        assert_equals("TIMEOUT" in provider_errors["a"]["metrics:hangs"], True)
+
+
+class FakeRateLimiter(object):
+    def __init__(self, waits):
+        self.waits = waits  # seconds to wait for each acquire, 0 to allow it
+
+    def acquire(self, key, block=True):
+        wait = self.waits.pop(0)
+        return (wait == 0, wait)
+
+
+class TestWaitForRateLimit():
+
+    def setUp(self):
+        self.old_rate = core_tasks.rate
+
+    def tearDown(self):
+        core_tasks.rate = self.old_rate
+
+    def test_waits_for_a_short_wait(self):
+        core_tasks.rate = FakeRateLimiter([0.1, 0.1, 0])
+        core_tasks.wait_for_rate_limit("crossref")
+        assert_equals(core_tasks.rate.waits, [])
+
+    def test_gives_up_on_a_long_wait(self):
+        core_tasks.rate = FakeRateLimiter([core_tasks.MAX_INLINE_RATE_LIMIT_WAIT_SECONDS + 1])
+        assert_raises(ProviderRateLimitError, core_tasks.wait_for_rate_limit, "crossref")
@@ -0,0 +1,63 @@
+from nose.tools import assert_equals
+import datetime
+import arrow
+
+from totalimpactwebapp.metric import Metric
+from totalimpactwebapp.metric import set_diff_windows
+from totalimpactwebapp.snap import ZeroSnap
+from test.utils import FakeSnap
+
+
+def fake_snap_days_ago(days_ago, raw_value, now):
+    last_collected_date = now.datetime.replace(tzinfo=None) - datetime.timedelta(days=days_ago)
+    return FakeSnap(u"mendeley", u"readers", raw_value, last_collected_date)
+
+
+def walked_window_start_snap(metric, now):
+    # how the window start used to be found: sort newest first and walk
+    window_start_time = now.replace(days=-metric.window_start_min_days_ago)
+    for snap in sorted(metric.snaps, key=lambda x: x.last_collected_date, reverse=True):
+        if arrow.get(snap.last_collected_date, 'UTC') < window_start_time:
+            return snap
+    return None
+
+
+class TestDiffWindows():
+
+    def setUp(self):
+        self.now = arrow.utcnow()
+
+    def make_metric(self, snap_days_ago, product_days_ago=100):
+        metric = Metric(u"tiid", u"mendeley", u"readers", {"milestones": [1, 10]})
+        metric.product_create_date = self.now.replace(days=-product_days_ago)
+        for (i, days_ago) in enumerate(snap_days_ago):
+            metric.add_snap(fake_snap_days_ago(days_ago, i, self.now))
+        return metric
+
+    def test_window_start_matches_walking_the_snaps(self):
+        metric = self.make_metric([30, 1, 9, 20, 8.5, 2])
+        expected = walked_window_start_snap(metric, self.now)
+        assert_equals(metric.window_start_snap_at(self.now) is expected, True)
+        assert_equals(metric.diff_window_start_value, 4)
+
+    def test_ties_take_the_first_snap(self):
+        metric = self.make_metric([1, 10, 10, 30])
+        assert_equals(metric.window_start_snap_at(self.now) is metric.snaps[1], True)
+
+    def test_no_snap_older_than_window(self):
+        metric = self.make_metric([1, 2])
+        assert_equals(isinstance(metric.window_start_snap_at(self.now), ZeroSnap), True)
+
+    def test_set_diff_windows_matches_one_at_a_time(self):
+        snap_days_ago_lists = [[30, 1, 9, 20, 8.5, 2], [1, 10, 10, 30], [1, 2], [20, 30], [3]]
+        metrics = [self.make_metric(days) for days in snap_days_ago_lists]
+        metrics.append(self.make_metric([2, 4], product_days_ago=5))
+        expected = [metric.window_start_snap_at(self.now) for metric in metrics]
+
+        set_diff_windows(metrics, now=self.now)
+        for (metric, expected_snap) in zip(metrics, expected):
+            if isinstance(expected_snap, ZeroSnap):
+                assert_equals(metric._window_start_snap.last_collected_date,
+                    expected_snap.last_collected_date)
+            else:
+                assert_equals(metric._window_start_snap is expected_snap, True)
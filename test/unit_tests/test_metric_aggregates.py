@@ -0,0 +1,50 @@
+from nose.tools import assert_equals
+
+from totalimpactwebapp.metric_aggregates import MetricAggregates
+from totalimpactwebapp.metric_aggregates import milestone_crossed
+from test.utils import FakeMetric
+from test.utils import FakeProduct
+
+
+class TestMetricAggregates():
+
+    def setUp(self):
+        self.products = [
+            FakeProduct(metrics=[
+                FakeMetric(u"mendeley", u"readers", u"saved", 2, 4),
+                FakeMetric(u"figshare", u"views", u"viewed", None, 7)
+            ]),
+            FakeProduct(metrics=[
+                FakeMetric(u"mendeley", u"readers", u"saved", 3, 3),
+                FakeMetric(u"delicious", u"bookmarks", u"saved", 1, 9)
+            ])
+        ]
+        self.aggregates = MetricAggregates(self.products)
+
+    def test_by_name(self):
+        accumulation = self.aggregates.get_by_name(u"mendeley", u"readers")
+        assert_equals(len(accumulation.metrics), 2)
+        assert_equals(accumulation.int_start_value, 5)
+        assert_equals(accumulation.int_end_value, 7)
+
+        # only the first one has a diff
+        assert_equals(accumulation.diff_start_value, 2)
+        assert_equals(accumulation.diff_end_value, 4)
+        assert_equals(accumulation.diff_milestone_just_reached, None)
+
+    def test_by_engagement(self):
+        accumulation = self.aggregates.get_by_engagement(u"saved")
+        assert_equals(len(accumulation.metrics), 3)
+        assert_equals(accumulation.diff_start_value, 3)
+        assert_equals(accumulation.diff_end_value, 13)
+        assert_equals(accumulation.diff_milestone_just_reached, 10)
+
+    def test_missing_group_is_empty(self):
+        accumulation = self.aggregates.get_by_name(u"scopus", u"citations")
+        assert_equals(accumulation.metrics, [])
+        assert_equals(accumulation.int_end_value, 0)
+        assert_equals(accumulation.diff_milestone_just_reached, None)
+
+    def test_milestone_crossed(self):
+        assert_equals(milestone_crossed([1, 5, 10], 0, 7), 5)
+        assert_equals(milestone_crossed([1, 5, 10], 5, 9), None)
@@ -0,0 +1,62 @@
+from nose.tools import assert_equals
+
+from totalimpactwebapp import product
+
+
+class FakeAliasRow(object):
+    def __init__(self, alias_tuple):
+        self.my_alias_tuple_for_comparing = alias_tuple
+
+class FakeAliases(object):
+    def __init__(self, has_formal_alias):
+        self.has_formal_alias = has_formal_alias
+
+class FakeProduct(object):
+    def __init__(self, name, title, alias_tuples=[], genre="article", is_preprint=False):
+        self.name = name
+        self.genre = genre
+        self.is_preprint = is_preprint
+        self.biblio_dedup_key = ("biblio", (title, genre, is_preprint))
+        self.alias_rows = [FakeAliasRow(alias_tuple) for alias_tuple in alias_tuples]
+        self.aliases = FakeAliases(any(ns in ["doi", "pmid", "arxiv"] for (ns, nid) in alias_tuples))
+
+
+class TestBuildDuplicatesList():
+
+    def _names(self, groups):
+        return [[p.name for p in group] for group in groups]
+
+    def test_groups_by_title_and_alias(self):
+        products = [
+            FakeProduct("a", "cats", [("doi", "10.1/a")]),
+            FakeProduct("b", "dogs", [("doi", "10.1/b")]),
+            FakeProduct("c", "cats!", [("doi", "10.1/a")]),
+            FakeProduct("d", "dogs", [("pmid", "123")]),
+            FakeProduct("e", "fish")
+        ]
+        groups = product.build_duplicates_list(products)
+        assert_equals(self._names(groups), [["a", "c"], ["b", "d"], ["e"]])
+
+    def test_genre_and_preprint_must_match(self):
+        products = [
+            FakeProduct("a", "cats", [("doi", "10.1/a")]),
+            FakeProduct("b", "cats", [("doi", "10.1/a")], genre="dataset"),
+            FakeProduct("c", "cats", [("doi", "10.1/a")], is_preprint=True)
+        ]
+        groups = product.build_duplicates_list(products)
+        assert_equals(self._names(groups), [["a"], ["b"], ["c"]])
+
+    def test_url_only_matches_when_no_formal_alias(self):
+        products = [
+            FakeProduct("a", "cats", [("doi", "10.1/a"), ("url", "http://cats.com")]),
+            FakeProduct("b", "dogs", [("doi", "10.1/b"), ("url", "http://cats.com")]),
+            FakeProduct("c", "fish", [("url", "http://cats.com")])
+        ]
+        groups = product.build_duplicates_list(products)
+        assert_equals(self._names(groups), [["a", "b", "c"]])
+
+        groups = product.build_duplicates_list(products[0:2])
+        assert_equals(self._names(groups), [["a"], ["b"]])
+
+    def test_empty(self):
+        assert_equals(product.build_duplicates_list([]), [])
@@ -0,0 +1,61 @@
+from nose.tools import assert_equals
+import redis
+
+from totalimpact import REDIS_UNITTEST_DATABASE_NUMBER
+from totalimpactwebapp import product_markup
+from totalimpactwebapp.product_markup import Markup
+
+
+class TestMarkupFragments():
+
+    def setUp(self):
+        # we're putting unittests for redis in their own db (number 8) so they can be deleted with abandon
+        self.r = redis.Redis(db=REDIS_UNITTEST_DATABASE_NUMBER)
+        self.r.flushdb()
+        self.old_redis = product_markup.fragment_redis
+        product_markup.fragment_redis = self.r
+        self.renders = []
+
+    def tearDown(self):
+        product_markup.fragment_redis = self.old_redis
+
+    def make_markup(self):
+        markup = Markup("jason", embed=False)
+        def render(local_context):
+            self.renders.append(local_context)
+            return u"<div>{title}</div>".format(title=local_context["title"])
+        markup._render = render
+        return markup
+
+    def test_rendered_once_per_version(self):
+        html = self.make_markup().make({"title": u"first"}, tiid="abc", version="v1")
+        assert_equals(html, u"<div>first</div>")
+
+        # another request, with the same version, gets the saved fragment
+        html = self.make_markup().make({"title": u"second"}, tiid="abc", version="v1")
+        assert_equals(html, u"<div>first</div>")
+        assert_equals(len(self.renders), 1)
+
+    def test_new_version_rerenders(self):
+        self.make_markup().make({"title": u"first"}, tiid="abc", version="v1")
+        html = self.make_markup().make({"title": u"second"}, tiid="abc", version="v2")
+        assert_equals(html, u"<div>second</div>")
+
+    def test_new_generation_rerenders(self):
+        self.make_markup().make({"title": u"first"}, tiid="abc", version="v1")
+        product_markup.bump_markup_generation()
+        html = self.make_markup().make({"title": u"second"}, tiid="abc", version="v1")
+        assert_equals(html, u"<div>second</div>")
+
+    def test_no_version_is_not_cached(self):
+        self.make_markup().make({"title": u"first"})
+        html = self.make_markup().make({"title": u"second"})
+        assert_equals(html, u"<div>second</div>")
+        assert_equals(self.r.keys("markup:*"), [])
+
+    def test_prefetch(self):
+        self.make_markup().make({"title": u"first"}, tiid="abc", version="v1")
+
+        markup = self.make_markup()
+        markup.prefetch([("abc", "v1"), ("def", "v1")])
+        assert_equals(markup.fragments.values(), [u"<div>first</div>"])
@@ -0,0 +1,119 @@
+from nose.tools import assert_equals
+import datetime
+
+from totalimpactwebapp import db, app
+from totalimpactwebapp import product_summary
+from totalimpactwebapp.product_summary import ProductSummary
+from totalimpactwebapp.product_summary import summary_is_current
+from test.utils import setup_postgres_for_unittests, teardown_postgres_for_unittests
+from test.utils import FakeProduct
+from test.utils import FakeProfile
+
+
+class TestSummaryIsCurrent():
+
+    def setUp(self):
+        self.now = datetime.datetime(2014, 10, 8, 15, 0)
+
+    def summary(self, **kwargs):
+        summary = ProductSummary(tiid=u"abc", url_slug=u"jason")
+        summary.summary_updated = datetime.datetime(2014, 10, 8, 1, 0)
+        for (k, v) in kwargs.iteritems():
+            setattr(summary, k, v)
+        return summary
+
+    def test_current(self):
+        assert_equals(summary_is_current(self.summary(), u"jason", self.now), True)
+
+    def test_stale(self):
+        assert_equals(summary_is_current(self.summary(is_stale=True), u"jason", self.now), False)
+
+    def test_other_url_slug(self):
+        assert_equals(summary_is_current(self.summary(), u"jason2", self.now), False)
+
+    def test_built_yesterday(self):
+        summary = self.summary(summary_updated=datetime.datetime(2014, 10, 7, 23, 59))
+        assert_equals(summary_is_current(summary, u"jason", self.now), False)
+
+
+
+class TestGetProductSummaries():
+
+    def setUp(self):
+        self.db = setup_postgres_for_unittests(db, app)
+
+        # summaries are built from fakes, so this tests which ones get built
+        self.old_get_products_from_tiids = product_summary.get_products_from_tiids
+        self.old_save_product_summaries = product_summary.save_product_summaries
+        product_summary.get_products_from_tiids = self.get_products_from_tiids
+        product_summary.save_product_summaries = self.save_product_summaries
+        self.built_tiids = []
+
+        self.profile = FakeProfile(id=1, url_slug=u"jason", products=[
+            FakeProduct(u"a"),
+            FakeProduct(u"b"),
+            FakeProduct(u"c", removed=datetime.datetime(2014, 1, 1))
+        ])
+
+    def tearDown(self):
+        product_summary.get_products_from_tiids = self.old_get_products_from_tiids
+        product_summary.save_product_summaries = self.old_save_product_summaries
+        teardown_postgres_for_unittests(self.db)
+
+    def get_products_from_tiids(self, tiids, ignore_order=False):
+        return [FakeProduct(tiid) for tiid in tiids]
+
+    def save_product_summaries(self, products, url_slug):
+        summaries = []
+        for product in products:
+            self.built_tiids.append(product.tiid)
+            summaries.append(ProductSummary(
+                tiid=product.tiid,
+                profile_id=self.profile.id,
+                url_slug=url_slug,
+                is_account_product=False,
+                product_dict={"tiid": product.tiid}))
+        for summary in summaries:
+            db.session.merge(summary)
+        db.session.commit()
+        return summaries
+
+    def test_builds_missing_then_reuses(self):
+        response = product_summary.get_product_summaries(self.profile)
+        assert_equals(response, [{"tiid": u"a"}, {"tiid": u"b"}])
+        assert_equals(self.built_tiids, [u"a", u"b"])
+
+        response = product_summary.get_product_summaries(self.profile)
+        assert_equals(response, [{"tiid": u"a"}, {"tiid": u"b"}])
+        assert_equals(self.built_tiids, [u"a", u"b"])
+
+    def test_rebuilds_stale(self):
+        product_summary.get_product_summaries(self.profile)
+        product_summary.mark_product_summaries_stale([u"b"])
+        db.session.commit()
+
+        product_summary.get_product_summaries(self.profile)
+        assert_equals(self.built_tiids, [u"a", u"b", u"b"])
+
+    def test_rebuilds_for_new_url_slug(self):
+        product_summary.get_product_summaries(self.profile)
+        self.profile.url_slug = u"jason2"
+
+        product_summary.get_product_summaries(self.profile)
+        assert_equals(self.built_tiids, [u"a", u"b", u"a", u"b"])
+
+    def test_drops_removed_products(self):
+        product_summary.get_product_summaries(self.profile)
+        self.profile.products = self.profile.products[0:1]
+
+        response = product_summary.get_product_summaries(self.profile)
+        assert_equals(response, [{"tiid": u"a"}])
+        assert_equals([s.tiid for s in ProductSummary.query.all()], [u"a"])
+
+    def test_mark_stale_without_the_table(self):
+        db.session.commit()
+        ProductSummary.__table__.drop(db.engine)
+
+        # doesn't raise, and leaves the session usable for the caller's commit
+        product_summary.mark_product_summaries_stale([u"a"])
+        db.session.commit()
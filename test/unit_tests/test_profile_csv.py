@@ -0,0 +1,43 @@
+from nose.tools import assert_equals
+
+from totalimpactwebapp.profile import csv_row
+from totalimpactwebapp.profile import iter_csv_lines
+from test.utils import FakeMetric
+from test.utils import FakeProduct
+
+
+class TestCsv():
+
+    def setUp(self):
+        self.products = [
+            FakeProduct(u"a",
+                metrics=[FakeMetric(u"mendeley", u"readers", end_value=4)],
+                biblio={"title": u"Cats, and dogs"},
+                aliases={"doi": u"10.1/a"}),
+            FakeProduct(u"b",
+                metrics=[FakeMetric(u"figshare", u"views", end_value=7)],
+                biblio={"title": u"caf\u00e9"})
+        ]
+        self.header_metric_names = [u"figshare:views", u"mendeley:readers"]
+
+    def test_csv_row(self):
+        metric_keys = [(u"figshare", u"views"), (u"mendeley", u"readers")]
+        assert_equals(csv_row(self.products[0], metric_keys),
+            [u"a", "Cats, and dogs", "10.1/a", "", 4])
+
+    def test_csv_row_missing_biblio_and_aliases(self):
+        product = FakeProduct(u"c")
+        assert_equals(csv_row(product, [(u"mendeley", u"readers")]),
+            [u"c", "", "", ""])
+
+    def test_iter_csv_lines(self):
+        lines = list(iter_csv_lines(iter(self.products), self.header_metric_names))
+        assert_equals(lines, [
+            "tiid,title,doi,figshare:views,mendeley:readers\r\n",
+            'a,"Cats, and dogs",10.1/a,,4\r\n',
+            "b,caf\xc3\xa9,,7,\r\n"
+        ])
+
+    def test_iter_csv_lines_no_products(self):
+        lines = list(iter_csv_lines([], []))
+        assert_equals(lines, ["tiid,title,doi\r\n"])
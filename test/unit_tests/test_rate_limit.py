@@ -0,0 +1,54 @@
+from nose.tools import assert_equals, assert_true, assert_false
+import redis
+
+import rate_limit
+from totalimpact import REDIS_UNITTEST_DATABASE_NUMBER
+
+
+class TestQuotasFromProviderConfig():
+
+    def test_quotas_from_provider_config(self):
+        config_providers = [
+            ("crossref", {"requests_per_second": 10}),
+            ("mendeley", {"requests_per_second": 0.5, "burst": 3}),
+            ("pubmed", {})
+        ]
+        response = rate_limit.quotas_from_provider_config(config_providers)
+        expected = {"crossref": (10.0, 10.0), "mendeley": (0.5, 3.0)}
+        assert_equals(response, expected)
+
+
+class TestTokenBucketRateLimiter():
+
+    def setUp(self):
+        # we're putting unittests for redis in their own db (number 8) so they can be deleted with abandon
+        self.r = redis.Redis(db=REDIS_UNITTEST_DATABASE_NUMBER)
+        self.r.flushdb()
+        self.rate = rate_limit.TokenBucketRateLimiter(
+            quotas={"slow": (1, 2)},
+            redis_db=REDIS_UNITTEST_DATABASE_NUMBER)
+
+    def test_acquire_up_to_burst(self):
+        assert_equals(self.rate.acquire("slow", block=False), (True, 0.0))
+        assert_equals(self.rate.acquire("slow", block=False), (True, 0.0))
+        (success, wait) = self.rate.acquire("slow", block=False)
+        assert_false(success)
+        assert_true(0 < wait <= 1)
+
+    def test_default_quota(self):
+        for i in range(rate_limit.DEFAULT_REQUESTS_PER_SECOND):
+            (success, wait) = self.rate.acquire("other", block=False)
+            assert_true(success)
+        (success, wait) = self.rate.acquire("other", block=False)
+        assert_false(success)
+
+    def test_penalize(self):
+        rate_factor = self.rate.penalize("slow", retry_after=10)
+        assert_equals(rate_factor, 0.5)
+        (success, wait) = self.rate.acquire("slow", block=False)
+        assert_false(success)
+        # 10 seconds of debt plus one token, at half rate
+        assert_true(wait > 10)
+
+        rate_factor = self.rate.penalize("slow")
+        assert_equals(rate_factor, 0.25)
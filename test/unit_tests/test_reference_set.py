@@ -0,0 +1,108 @@
+from nose.tools import assert_equals
+import numpy
+
+from totalimpactwebapp import reference_set
+from totalimpactwebapp.reference_set import ReferenceSetList
+from totalimpactwebapp.reference_set import RefsetBuilder
+from test.utils import FakeSnap
+
+
+class TestPercentiles():
+
+    def setUp(self):
+        self.old_reference_set_lists = reference_set.reference_set_lists
+        refset_list = ReferenceSetList(year=u"2012", genre=u"article", host=None,
+            mendeley_discipline=u"ALL", provider=u"mendeley", interaction=u"readers")
+        refset_list.percentiles = [0]*50 + [3]*25 + [10]*25 + [40]
+        reference_set.reference_set_lists = {refset_list.get_lookup_key(): refset_list}
+        reference_set.product_level_reference_sets.clear()
+
+        self.refset = reference_set.get_product_level_reference_set(
+            year=u"2012", genre=u"article", host=None, mendeley_discipline=None)
+
+    def tearDown(self):
+        reference_set.reference_set_lists = self.old_reference_set_lists
+        reference_set.product_level_reference_sets.clear()
+
+    def walked_percentile(self, raw_value):
+        percentiles = reference_set.reference_set_lists.values()[0].percentiles
+        return self.refset.get_percentile_by_walking(percentiles, raw_value)
+
+    def test_get_percentile_matches_walking_the_list(self):
+        for raw_value in [0, 1, 3, 4, 10, 11, 40, 41, 2.5]:
+            response = self.refset.get_percentile(u"mendeley", u"readers", raw_value)
+            assert_equals(response["value"], self.walked_percentile(raw_value))
+
+    def test_get_percentile_no_refset(self):
+        response = self.refset.get_percentile(u"mendeley", u"groups", 3)
+        assert_equals(response, None)
+
+    def test_shared_by_products_with_the_same_key(self):
+        refset = reference_set.get_product_level_reference_set(
+            year=u"2012", genre=u"article", host=None, mendeley_discipline=None)
+        assert_equals(refset is self.refset, True)
+
+    def test_set_snap_percentiles(self):
+        snaps = [FakeSnap(u"mendeley", u"readers", raw_value, refset=self.refset)
+                    for raw_value in [0, 4, 41, u"Yes"]]
+        snaps.append(FakeSnap(u"mendeley", u"groups", 3, refset=self.refset))
+        reference_set.set_snap_percentiles(snaps)
+
+        percentiles = [snap.precomputed_percentile for snap in snaps]
+        expected = [self.refset.get_percentile(snap.provider, snap.interaction, snap.raw_value)
+                    for snap in snaps]
+        assert_equals(percentiles, expected)
+        assert_equals([p["value"] for p in percentiles[0:3]], [1, 76, 99])
+
+
+
+class TestRefsetBuilder():
+
+    def record(self, builder, raw_values, n_products):
+        for i in range(n_products):
+            builder.record_product(year=u"2012", genre=u"dataset", host=u"figshare")
+        for raw_value in raw_values:
+            builder.record_metric(year=u"2012", genre=u"dataset", host=u"figshare",
+                provider=u"figshare", interaction=u"views", raw_value=raw_value)
+
+    def metric_key(self):
+        return ReferenceSetList.build_lookup_key(year=u"2012", genre=u"dataset", host=u"figshare",
+            provider=u"figshare", interaction=u"views")
+
+    def test_percentiles_match_numpy(self):
+        raw_values = [1, 1, 2, 3, 5, 8, 13, 21, 2.5, 100]
+        builder = RefsetBuilder()
+        self.record(builder, raw_values, 15)
+
+        elements = raw_values + [0]*5
+        expected = [int(round(p, 0)) for p in numpy.percentile(elements, q=range(101))]
+        assert_equals(builder.percentiles(self.metric_key()), expected)
+
+    def test_too_few_products(self):
+        builder = RefsetBuilder()
+        self.record(builder, [1, 2, 3], 9)
+        assert_equals(builder.percentiles(self.metric_key()), None)
+
+    def test_merge(self):
+        whole = RefsetBuilder()
+        self.record(whole, [1, 2, 3, 40, 5, 6], 12)
+
+        first_part = RefsetBuilder()
+        self.record(first_part, [1, 2, 3], 6)
+        second_part = RefsetBuilder()
+        self.record(second_part, [40, 5, 6], 6)
+        merged = first_part.merge(second_part)
+
+        assert_equals(merged.percentiles(self.metric_key()), whole.percentiles(self.metric_key()))
+
+    def test_take_back(self):
+        builder = RefsetBuilder()
+        self.record(builder, [1, 2, 3, 4], 10)
+        builder.record_metric(year=u"2012", genre=u"dataset", host=u"figshare",
+            provider=u"figshare", interaction=u"views", raw_value=4, count=-1)
+        builder.record_metric(year=u"2012", genre=u"dataset", host=u"figshare",
+            provider=u"figshare", interaction=u"views", raw_value=7)
+
+        expected = RefsetBuilder()
+        self.record(expected, [1, 2, 3, 7], 10)
+        assert_equals(builder.percentiles(self.metric_key()), expected.percentiles(self.metric_key()))
@@ -0,0 +1,44 @@
+from nose.tools import assert_equals
+import os
+import shutil
+import tempfile
+
+from totalimpactwebapp.reference_set import ReferenceSetList
+from totalimpactwebapp import refset_store
+
+
+class TestRefsetStore():
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "refsets-test.bin")
+
+        self.refset_lists = []
+        for (interaction, percentiles) in [(u"readers", range(101)), (u"groups", [0]*100 + [7])]:
+            refset_list = ReferenceSetList(year=u"2012", genre=u"article", host=None,
+                mendeley_discipline=u"ALL", provider=u"mendeley", interaction=interaction)
+            refset_list.percentiles = percentiles
+            refset_list.N = 500
+            self.refset_lists.append(refset_list)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_write_and_open(self):
+        refset_store.write_refset_store(self.path, self.refset_lists)
+        stored = refset_store.open_refset_store(self.path)
+
+        assert_equals(len(stored), 2)
+        for refset_list in self.refset_lists:
+            stored_refset_list = stored[refset_list.get_lookup_key()]
+            assert_equals(list(stored_refset_list.percentiles), refset_list.percentiles)
+            assert_equals(stored_refset_list.N, 500)
+            assert_equals(stored_refset_list.get_lookup_key(), refset_list.get_lookup_key())
+
+    def test_leaves_no_temp_file(self):
+        refset_store.write_refset_store(self.path, self.refset_lists)
+        assert_equals(os.listdir(self.temp_dir), ["refsets-test.bin"])
+
+    def test_empty(self):
+        refset_store.write_refset_store(self.path, [])
+        assert_equals(refset_store.open_refset_store(self.path), {})
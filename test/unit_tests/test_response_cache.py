@@ -0,0 +1,50 @@
+from nose.tools import assert_equals
+import datetime
+import redis
+
+from totalimpact import REDIS_UNITTEST_DATABASE_NUMBER
+from totalimpactwebapp import response_cache
+
+
+class TestResponseCache():
+
+    def setUp(self):
+        # we're putting unittests for redis in their own db (number 8) so they can be deleted with abandon
+        self.r = redis.Redis(db=REDIS_UNITTEST_DATABASE_NUMBER)
+        self.r.flushdb()
+        self.old_redis = response_cache.response_cache_redis
+        response_cache.response_cache_redis = self.r
+
+    def tearDown(self):
+        response_cache.response_cache_redis = self.old_redis
+
+    def test_save_and_get(self):
+        last_modified = datetime.datetime(2014, 3, 1)
+        generation = response_cache.get_generation("Jason")
+        response_cache.save_cached_response("Jason", generation, "/profile/jason/products",
+            '{"list":[]}', "abc", last_modified)
+
+        generation = response_cache.get_generation("jason")
+        response = response_cache.get_cached_response("jason", generation, "/profile/jason/products")
+        assert_equals(response, ('{"list":[]}', "abc", last_modified))
+
+    def test_invalidate(self):
+        generation = response_cache.get_generation("jason")
+        response_cache.save_cached_response("jason", generation, "/profile/jason/products",
+            '{"list":[]}', None, None)
+
+        response_cache.invalidate_cached_responses("jason")
+        generation = response_cache.get_generation("jason")
+        response = response_cache.get_cached_response("jason", generation, "/profile/jason/products")
+        assert_equals(response, None)
+
+    def test_saved_after_invalidation_is_not_served(self):
+        # built from data that changed while it was being built
+        old_generation = response_cache.get_generation("jason")
+        response_cache.invalidate_cached_responses("jason")
+        response_cache.save_cached_response("jason", old_generation, "/profile/jason/products",
+            '{"list":[]}', None, None)
+
+        generation = response_cache.get_generation("jason")
+        response = response_cache.get_cached_response("jason", generation, "/profile/jason/products")
+        assert_equals(response, None)
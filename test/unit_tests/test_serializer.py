@@ -0,0 +1,43 @@
+from nose.tools import assert_equals
+import datetime
+import json
+
+from totalimpactwebapp import serializer
+from totalimpactwebapp.snap import Snap
+
+
+class TestSerializer():
+
+    def setUp(self):
+        self.snap = Snap(
+            tiid="abcd",
+            provider="wikipedia",
+            interaction="mentions",
+            raw_value=3,
+            drilldown_url="http://example.com",
+            last_collected_date=datetime.datetime(2014, 6, 1, 12, 0))
+
+    def test_to_jsonable_uses_schema(self):
+        response = serializer.to_jsonable(self.snap)
+        expected = {
+            "collected_date": "2014-06-01T12:00:00",
+            "provider": "wikipedia",
+            "interaction": "mentions",
+            "value": 3,
+            "drilldown_url": "http://example.com",
+            "percentile": None
+        }
+        assert_equals(response, expected)
+
+    def test_to_jsonable_matches_todict_for_snap(self):
+        import util
+        assert_equals(serializer.to_jsonable(self.snap), util.todict(self.snap))
+
+    def test_dumps_is_compact_unless_pretty(self):
+        assert_equals(serializer.dumps({"a": [1, 2]}), '{"a":[1,2]}')
+        assert_equals(serializer.dumps({"a": 1}, pretty=True), '{\n    "a": 1\n}')
+
+    def test_iter_dumps_matches_dumps(self):
+        thing = {"list": [{"snap": self.snap}, 2, "three"], "empty": [], "about": {"a": None}}
+        streamed = "".join(serializer.iter_dumps(thing))
+        assert_equals(json.loads(streamed), json.loads(serializer.dumps(thing)))
@@ -80,3 +80,14 @@ class TestTiRedis():
         assert_equals(response, {"hi":"lookup"})
 
 
+
+    def test_finish_profile_refresh_tiid(self):
+        self.r.set_profile_refresh_tiids(42, ["abcd", "efgh"])
+        assert_equals(self.r.finish_profile_refresh_tiid(42, "abcd"), False)
+        assert_equals(self.r.finish_profile_refresh_tiid(42, "abcd"), False)
+        assert_equals(self.r.finish_profile_refresh_tiid(42, "efgh"), True)
+        # only the call that finished the last tiid gets True
+        assert_equals(self.r.finish_profile_refresh_tiid(42, "efgh"), None)
+
+    def test_finish_profile_refresh_tiid_not_tracked(self):
+        assert_equals(self.r.finish_profile_refresh_tiid(43, "abcd"), None)
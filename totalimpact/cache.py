@@ -1,24 +1,145 @@
 import os
-import sys
+import time
 import hashlib
 import logging
 import json
+import threading
+from collections import OrderedDict
 from cPickle import PicklingError
 import redis
 
 from totalimpact.tiredis import REDIS_CACHE_DATABASE_NUMBER
+from totalimpact import cache_codec
 
 # set up logging
 logger = logging.getLogger("ti.cache")
 
 cache_client = redis.from_url(os.getenv("REDIS_URL"), REDIS_CACHE_DATABASE_NUMBER)
 
-MAX_PAYLOAD_SIZE_BYTES = 1000*1000 # 1mb
+MAX_PAYLOAD_SIZE_BYTES = 1000*1000 # 1mb, after compression
 MAX_CACHE_SIZE_BYTES = 300*1000*1000 #300mb
+MEMORY_CHECK_INTERVAL_SECONDS = 30
+CACHE_CODEC = os.getenv("CACHE_CODEC", "zlib")
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", 20*1000*1000)) #20mb per process
+LOCAL_CACHE_MAX_AGE = 60*5  # so we don't serve much past the redis expiry
 
 class CacheException(Exception):
     pass
 
+
+class MemoryMonitor(object):
+    """ Samples redis used_memory in a background thread, so writes 
+        don't each need an INFO round-trip to know if the cache is full """
+
+    def __init__(self, get_client, interval=MEMORY_CHECK_INTERVAL_SECONDS):
+        self.get_client = get_client
+        self.interval = interval
+        self.used_memory = 0
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def sample(self):
+        try:
+            self.used_memory = self.get_client().info()["used_memory"]
+        except redis.RedisError:
+            logger.warning(u"Unable to get used_memory from redis cache")
+
+    def _poll(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def start(self):
+        # threads don't survive a fork, so start one per process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.sample()
+                poller = threading.Thread(target=self._poll, name="cache-memory-monitor")
+                poller.daemon = True
+                poller.start()
+
+    @property
+    def is_full(self):
+        self.start()
+        return self.used_memory >= MAX_CACHE_SIZE_BYTES
+
+
+memory_monitor = MemoryMonitor(lambda: cache_client)
+
+
+class LocalCache(object):
+    """ Bounded in-process LRU of cache entries, each charged the size it's
+        given.  Sits in front of redis so a worker doesn't go back to redis
+        for urls it fetched moments ago.  Cache keeps entries here encoded,
+        and decodes them on a hit, so max_bytes is what they really use. """
+
+    def __init__(self, max_bytes=LOCAL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # hash_key: (expires_at, size, data)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, hash_key):
+        with self.lock:
+            try:
+                (expires_at, size, data) = self.entries.pop(hash_key)
+            except KeyError:
+                return None
+            if expires_at <= time.time():
+                self.size -= size
+                return None
+            # reinsert so it is the most recently used
+            self.entries[hash_key] = (expires_at, size, data)
+            return data
+
+    def set(self, hash_key, data, size, max_age):
+        if size > self.max_bytes:
+            return
+        expires_at = time.time() + min(max_age, LOCAL_CACHE_MAX_AGE)
+        with self.lock:
+            if hash_key in self.entries:
+                self.size -= self.entries.pop(hash_key)[1]
+            self.entries[hash_key] = (expires_at, size, data)
+            self.size += size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # drop everything expired first, then least recently used until we fit
+        now = time.time()
+        for (hash_key, (expires_at, size, data)) in self.entries.items():
+            if expires_at <= now:
+                del self.entries[hash_key]
+                self.size -= size
+        while self.size > self.max_bytes:
+            (hash_key, (expires_at, size, data)) = self.entries.popitem(last=False)
+            self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+local_cache = LocalCache()
+
+cache_stats = {
+    "local": {"hits": 0, "misses": 0},
+    "redis": {"hits": 0, "misses": 0}
+}
+
+def _count(tier, hits, misses):
+    # approximate under concurrency, which is fine for monitoring
+    cache_stats[tier]["hits"] += hits
+    cache_stats[tier]["misses"] += misses
+
+def get_cache_stats():
+    return dict((tier, dict(counts)) for (tier, counts) in cache_stats.iteritems())
+
+
 class Cache(object):
     """ Maintains a cache of URL responses in memcached """
 
@@ -29,9 +150,13 @@ class Cache(object):
 
     def _get_client(self):
         return cache_client
+
+    def _is_full(self):
+        return memory_monitor.is_full
  
-    def __init__(self, max_cache_age=60*60):  #one hour
+    def __init__(self, max_cache_age=60*60, codec_name=CACHE_CODEC):  #one hour
         self.max_cache_age = max_cache_age
+        self.codec = cache_codec.get_codec(codec_name)
         self.flush_cache()
 
     def flush_cache(self):
@@ -41,32 +166,94 @@ class Cache(object):
 
     def get_cache_entry(self, key):
         """ Get an entry from the cache, returns None if not found """
-        mc = self._get_client()
-        hash_key = self._build_hash_key(key)
-        response = mc.get(hash_key)
-        if response:
-            response = json.loads(response)
-        return response
+        return self.get_cache_entries([key])[0]
 
-    def set_cache_entry(self, key, data):
-        """ Store a cache entry """
+    def get_cache_entries(self, keys):
+        """ Get many entries from the cache, looking in this process first 
+            and then in redis with one round-trip.  Returns a list in the 
+            same order as keys, with None for entries not found """
+        if not keys:
+            return []
+
+        hash_keys = [self._build_hash_key(key) for key in keys]
+        entries = []
+        for hash_key in hash_keys:
+            encoded = local_cache.get(hash_key)
+            if encoded is None:
+                entries.append(None)
+            else:
+                entries.append(cache_codec.decode(encoded))
+        missing_hash_keys = [hash_key for (hash_key, entry) in zip(hash_keys, entries) if entry is None]
+        _count("local", len(hash_keys)-len(missing_hash_keys), len(missing_hash_keys))
+        if not missing_hash_keys:
+            return entries
+
+        mc = self._get_client()
+        responses = dict(zip(missing_hash_keys, mc.mget(missing_hash_keys)))
+        num_redis_hits = 0
+        for (i, hash_key) in enumerate(hash_keys):
+            response = responses.get(hash_key)
+            if entries[i] is None and response:
+                entries[i] = cache_codec.decode(response)
+                local_cache.set(hash_key, response, len(response), self.max_cache_age)
+                num_redis_hits += 1
+        _count("redis", num_redis_hits, len(missing_hash_keys)-num_redis_hits)
+        return entries
 
-        if sys.getsizeof(data["text"]) > MAX_PAYLOAD_SIZE_BYTES:
+    def _encode(self, data):
+        """ Returns the compressed entry, or None if it is too big to cache """
+        encoded = cache_codec.encode(data, self.codec)
+        if len(encoded) > MAX_PAYLOAD_SIZE_BYTES:
             logger.debug(u"Not caching because payload is too large")
             return None
+        return encoded
 
-        mc = self._get_client()
+    def set_cache_entry(self, key, data, max_age=None):
+        """ Store a cache entry, for max_age seconds if given """
+        max_age = max_age or self.max_cache_age
+        encoded = self._encode(data)
+        if not encoded:
+            return None
 
-        if mc.info()["used_memory"] >= MAX_CACHE_SIZE_BYTES:
+        hash_key = self._build_hash_key(key)
+        local_cache.set(hash_key, encoded, len(encoded), max_age)
+
+        if self._is_full():
             logger.debug(u"Not caching because redis cache is too full")
             return None
 
-        hash_key = self._build_hash_key(key)
-        set_response = mc.set(hash_key, json.dumps(data))
-        mc.expire(hash_key, self.max_cache_age)
+        mc = self._get_client()
+        set_response = mc.set(hash_key, encoded, ex=max_age)
 
         if not set_response:
             logger.warning("Unable to store into Redis. Make sure redis server is running.")
             raise CacheException("Unable to store into Redis. Make sure redis server is running.")
         return set_response
+
+    def set_cache_entries(self, entries, max_age=None):
+        """ Store many (key, data) cache entries in one pipelined round-trip """
+        max_age = max_age or self.max_cache_age
+        encoded_entries = []
+        for (key, data) in entries:
+            encoded = self._encode(data)
+            if encoded:
+                hash_key = self._build_hash_key(key)
+                local_cache.set(hash_key, encoded, len(encoded), max_age)
+                encoded_entries.append((hash_key, encoded))
+        if not encoded_entries:
+            return None
+
+        if self._is_full():
+            logger.debug(u"Not caching because redis cache is too full")
+            return None
+
+        pipe = self._get_client().pipeline(transaction=False)
+        for (hash_key, encoded) in encoded_entries:
+            pipe.set(hash_key, encoded, ex=max_age)
+        set_responses = pipe.execute()
+
+        if not all(set_responses):
+            logger.warning("Unable to store into Redis. Make sure redis server is running.")
+            raise CacheException("Unable to store into Redis. Make sure redis server is running.")
+        return set_responses
   
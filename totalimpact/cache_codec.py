@@ -0,0 +1,129 @@
+import json
+import struct
+import zlib
+import logging
+
+try:
+    import lz4
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger("ti.cache_codec")
+
+# Cache entries are stored as
+#   MAGIC + codec id byte + compressed(envelope)
+# where the envelope is
+#   flags (ubyte), status_code (ushort), len(url) (uint), len(extra) (uint), url, extra, body
+# flags say which of status_code, url and text the entry had.  url and body
+# are utf-8, extra is json of any other keys (headers etc), or empty.
+# Anything without the magic prefix is a legacy plain-json entry.
+
+MAGIC = "\xc4\x1e"
+ENVELOPE_HEADER = struct.Struct("!BHII")
+
+HAS_STATUS_CODE = 1
+HAS_URL = 2
+HAS_TEXT = 4
+
+
+class CacheCodecException(Exception):
+    pass
+
+
+def zlib_compress(raw):
+    return zlib.compress(raw, 6)
+
+def no_compression(raw):
+    return raw
+
+codecs_by_name = {
+    "none": {"name": "none", "codec_id": 0, "compress": no_compression, "decompress": no_compression},
+    "zlib": {"name": "zlib", "codec_id": 1, "compress": zlib_compress, "decompress": zlib.decompress}
+}
+if lz4:
+    codecs_by_name["lz4"] = {"name": "lz4", "codec_id": 2, "compress": lz4.compress, "decompress": lz4.decompress}
+
+codecs_by_id = dict((codec["codec_id"], codec) for codec in codecs_by_name.values())
+
+
+def get_codec(name):
+    try:
+        return codecs_by_name[name]
+    except KeyError:
+        logger.warning(u"Unknown cache codec {name}, using zlib".format(
+            name=name))
+        return codecs_by_name["zlib"]
+
+
+def _to_utf8(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def encode(data, codec):
+    """ Packs a cache data dict (text, status_code, url, plus anything else)
+        into compressed bytes """
+    flags = 0
+    extra = dict(data)
+
+    # status_code, url and text go outside the json when they fit there,
+    # anything else (like a None) stays in extra so it comes back the same
+    status_code = extra.pop("status_code", None)
+    if isinstance(status_code, int) and 0 <= status_code <= 0xffff:
+        flags |= HAS_STATUS_CODE
+    else:
+        if "status_code" in data:
+            extra["status_code"] = status_code
+        status_code = 0
+
+    url = extra.pop("url", None)
+    if isinstance(url, basestring):
+        flags |= HAS_URL
+        url = _to_utf8(url)
+    else:
+        if "url" in data:
+            extra["url"] = url
+        url = ""
+
+    body = extra.pop("text", None)
+    if isinstance(body, basestring):
+        flags |= HAS_TEXT
+        body = _to_utf8(body)
+    else:
+        if "text" in data:
+            extra["text"] = body
+        body = ""
+
+    extra_json = json.dumps(extra) if extra else ""
+    envelope = ENVELOPE_HEADER.pack(flags, status_code, len(url), len(extra_json))
+    envelope += url + extra_json + body
+    return MAGIC + chr(codec["codec_id"]) + codec["compress"](envelope)
+
+
+def decode(value):
+    """ Unpacks bytes made by encode back into a cache data dict """
+    if not value.startswith(MAGIC):
+        return json.loads(value)
+
+    try:
+        codec = codecs_by_id[ord(value[len(MAGIC)])]
+    except (KeyError, IndexError):
+        raise CacheCodecException("Unknown codec for cache entry")
+
+    envelope = codec["decompress"](value[len(MAGIC)+1:])
+    (flags, status_code, url_length, extra_length) = ENVELOPE_HEADER.unpack_from(envelope)
+    start = ENVELOPE_HEADER.size
+
+    data = {}
+    if flags & HAS_STATUS_CODE:
+        data["status_code"] = status_code
+    if flags & HAS_URL:
+        data["url"] = envelope[start:start+url_length].decode("utf-8")
+    start += url_length
+    if extra_length:
+        data.update(json.loads(envelope[start:start+extra_length]))
+    start += extra_length
+    if flags & HAS_TEXT:
+        data["text"] = envelope[start:].decode("utf-8")
+    return data
@@ -9,16 +9,18 @@ PROXY = "" # used with  providers-test-proxy.py script in the extras directory
 
 # List of desired providers and their configuration files
 # Alias methods will be called in the order of this list
+# A provider's config can set "requests_per_second" and "burst" to rate limit 
+# it differently from the default, eg ("crossref", {"requests_per_second": 10}) 
 PROVIDERS = [
     # this is up here because it can produce dois
-    ("pubmed", {}),
+    ("pubmed", {"requests_per_second": 3}),  # ncbi e-utilities limit without an api key
 
     # best biblio providers go here, in order with best first
     ("arxiv", {}),
-    ("crossref", {}),
+    ("crossref", {"requests_per_second": 20}),  # well under the 50/s crossref advertises
     ("dryad", {}),            
     ("figshare", {}),            
-    ("github", {}),
+    ("github", {"requests_per_second": 1.3, "burst": 10}),  # 5000 an hour
     # ("github_account", {}),
     ("publons", {}),
     ("slideshare", {}),
@@ -33,11 +35,11 @@ PROVIDERS = [
     ("webpage", {}),
 
     # don't-have-biblio providers go here, alphabetical order
-    ("altmetric_com", {}),    
+    ("altmetric_com", {"requests_per_second": 1, "burst": 5}),
     ("citeulike", {}),   
     ("plosalm", {}),
     ("plossearch", {}),
-    ("scopus", {}),
+    ("scopus", {"requests_per_second": 3}),
     ("wikipedia", {}),
 ]
 
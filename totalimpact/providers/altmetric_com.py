@@ -18,6 +18,9 @@ class Altmetric_Com(Provider):
     metrics_url_template_via_citations = 'http://api.altmetric.com/v1/citations/1y?key=' + os.environ["ALTMETRIC_COM_KEY"]
     provenance_url_template = 'http://www.altmetric.com/details.php?citation_id=%s&src=impactstory.org'
 
+    # a 404 just means nobody has mentioned it yet, and metrics are only refreshed daily
+    negative_cache_duration = 60*60*24
+
     static_meta_dict =  {
         "tweets": {
             "display_name": "Twitter tweets",
@@ -15,6 +15,9 @@ class Plosalm(Provider):
     metrics_url_template = "http://alm.plos.org/api/v3/articles?ids=%s&source=citations,counter&api_key=" + os.environ["PLOS_KEY_V3"]
     provenance_url_template = "http://dx.doi.org/%s"
 
+    max_batch_size = 50  # dois per ALM api call
+    stale_while_revalidate_duration = 60*60  # ALM counts are only updated daily
+
     PLOS_ICON = "http://www.plos.org/wp-content/themes/plos_new/favicon.ico"
 
     static_meta_dict =  {
@@ -54,7 +57,12 @@ class Plosalm(Provider):
             raise ProviderContentMalformedError
 
         json_response = provider._load_json(page)
-        this_article = json_response[0]["sources"][0]["metrics"]
+        metrics_dict = self._metrics_from_article(json_response[0])
+
+        return metrics_dict
+
+    def _metrics_from_article(self, article):
+        this_article = article["sources"][0]["metrics"]
 
         dict_of_keylists = {
             'plosalm:html_views' : ['html'],
@@ -65,4 +73,51 @@ class Plosalm(Provider):
 
         return metrics_dict
 
+    def _extract_metrics_batch(self, page, status_code=200):
+        # returns a dict of lowercased doi: metrics_dict for every article in the page
+        if status_code != 200:
+            if status_code == 404:
+                return {}
+            else:
+                raise(self._get_error(status_code))
+
+        json_response = provider._load_json(page)
+
+        metrics_by_doi = {}
+        for article in json_response:
+            try:
+                metrics_by_doi[article["doi"].lower()] = self._metrics_from_article(article)
+            except (KeyError, IndexError, TypeError, AttributeError):
+                pass
+        return metrics_by_doi
+
+    def metrics_batch(self, 
+            aliases_list,
+            provider_url_template=None,
+            cache_enabled=True):
+        # the ALM api takes a comma-separated list of dois, so look them up together
+        if not provider_url_template:
+            provider_url_template = self.metrics_url_template
+
+        dois = [self.get_best_id(aliases) for aliases in aliases_list]
+        unique_dois = sorted(set([doi.lower() for doi in dois if doi]))
+
+        metrics_by_doi = {}
+        for i in range(0, len(unique_dois), self.max_batch_size):
+            dois_chunk = unique_dois[i:i+self.max_batch_size]
+            url = self._get_templated_url(provider_url_template, ",".join(dois_chunk), "metrics")
+            response = self.http_get(url, cache_enabled=cache_enabled, allow_redirects=True)
+            metrics_by_doi.update(self._extract_metrics_batch(response.text, response.status_code))
+
+        responses = []
+        for (aliases, doi) in zip(aliases_list, dois):
+            metrics_and_drilldown = {}
+            if doi:
+                metrics = metrics_by_doi.get(doi.lower(), {})
+                for metric_name in metrics:
+                    drilldown_url = self.provenance_url(metric_name, aliases)
+                    metrics_and_drilldown[metric_name] = (metrics[metric_name], drilldown_url)
+            responses.append(metrics_and_drilldown)
+
+        return responses
 
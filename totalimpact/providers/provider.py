@@ -3,7 +3,7 @@
 from totalimpact import cache as cache_module
 from totalimpact import default_settings
 
-import requests, os, time, threading, sys, traceback, importlib, urllib, logging, itertools
+import requests, os, time, threading, sys, traceback, importlib, urllib, urlparse, logging, itertools
 import simplejson
 import BeautifulSoup
 import socket
@@ -11,6 +11,7 @@ import analytics
 import re
 from xml.dom import minidom 
 from xml.parsers.expat import ExpatError
+from multiprocessing.pool import ThreadPool
 from sqlalchemy.sql import text    
 
 logger = logging.getLogger("ti.provider")
@@ -19,6 +20,7 @@ logger = logging.getLogger("ti.provider")
 requests_log = logging.getLogger("requests").setLevel(logging.WARNING) 
 
 USER_AGENT = "Impactstory" # User-Agent string to use on HTTP requests
+HTTP_POOL_MAXSIZE = 20  # keep-alive connections kept open per host, per process
 
 
 class CachedResponse:
@@ -26,27 +28,95 @@ class CachedResponse:
         self.status_code = cache_data['status_code']
         self.url = cache_data['url']
         self.text = cache_data['text']
+        self.fresh_until = cache_data.get('fresh_until')
 
-def get_page_from_cache(url, headers, allow_redirects, cache):
+    @property
+    def is_stale(self):
+        return bool(self.fresh_until) and (self.fresh_until < time.time())
+
+def get_page_from_cache(url, headers, allow_redirects, cache, status_codes=(200,)):
     cache_key = headers.copy()
     cache_key.update({"url":url, "allow_redirects":allow_redirects})
 
     cache_data = cache.get_cache_entry(cache_key)
-    # use it if it was a 200, otherwise go get it again
-    if cache_data and (cache_data['status_code'] == 200):
+    # use it if it was a 200 (or a cached not-found), otherwise go get it again
+    if cache_data and (cache_data['status_code'] in status_codes):
         # logger.debug(u"returning from cache: %s" %(url))
         return CachedResponse(cache_data)
     return None
 
-def store_page_in_cache(url, headers, allow_redirects, response, cache):
-    cache_key = headers.copy()
-    cache_key.update({"url":url, "allow_redirects":allow_redirects})
-
+def get_pages_from_cache(urls, headers, allow_redirects, cache, status_codes=(200,)):
+    # like get_page_from_cache, but looks up all the urls in one round-trip
+    cache_keys = []
+    for url in urls:
+        cache_key = headers.copy()
+        cache_key.update({"url":url, "allow_redirects":allow_redirects})
+        cache_keys.append(cache_key)
+
+    cached_responses = {}
+    for (url, cache_data) in zip(urls, cache.get_cache_entries(cache_keys)):
+        if cache_data and (cache_data['status_code'] in status_codes):
+            cached_responses[url] = CachedResponse(cache_data)
+    return cached_responses
+
+def _cache_data_from_response(response, max_age, stale_age):
     cache_data = {
         'text':             response.text, 
         'status_code':      response.status_code, 
         'url':              response.url}
-    cache.set_cache_entry(cache_key, cache_data)
+    if stale_age:
+        cache_data['fresh_until'] = time.time() + max_age
+    return cache_data
+
+def store_page_in_cache(url, headers, allow_redirects, response, cache, max_age=None, stale_age=0):
+    # entries are kept stale_age seconds past max_age, and can be served stale in that time
+    max_age = max_age or cache.max_cache_age
+    cache_key = headers.copy()
+    cache_key.update({"url":url, "allow_redirects":allow_redirects})
+    cache.set_cache_entry(cache_key, 
+        _cache_data_from_response(response, max_age, stale_age), 
+        max_age + stale_age)
+
+def store_pages_in_cache(responses, headers, allow_redirects, cache, max_age=None, stale_age=0):
+    # like store_page_in_cache, but for a dict of url:response, in one round-trip
+    max_age = max_age or cache.max_cache_age
+    entries = []
+    for (url, response) in responses.iteritems():
+        cache_key = headers.copy()
+        cache_key.update({"url":url, "allow_redirects":allow_redirects})
+        entries.append((cache_key, _cache_data_from_response(response, max_age, stale_age)))
+    cache.set_cache_entries(entries, max_age + stale_age)
+
+
+# keep-alive sessions, one per host, shared by all providers in this process
+http_sessions = {}
+http_sessions_pid = None
+http_sessions_lock = threading.Lock()
+
+def get_http_session(url):
+    global http_sessions_pid
+
+    host = urlparse.urlparse(url).netloc.lower()
+    with http_sessions_lock:
+        if http_sessions_pid != os.getpid():
+            # don't share sockets with the process we were forked from
+            http_sessions.clear()
+            http_sessions_pid = os.getpid()
+
+        if host not in http_sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, 
+                pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[host] = session
+        return http_sessions[host]
+
+
+# urls being refetched in the background after a stale cache hit
+revalidating_urls = set()
+revalidating_urls_lock = threading.Lock()
 
 
 def is_issn_in_doaj(issn):
@@ -149,6 +219,12 @@ class ProviderFactory(object):
         
 class Provider(object):
 
+    # providers can override these
+    negative_cache_duration = 0  # seconds to cache "not found" responses.  0 to not cache them
+    negative_cache_status_codes = [404, 410]
+    stale_while_revalidate_duration = 0  # serve expired responses this long while refetching in background
+    max_batch_size = 1  # products looked up per upstream call by the *_batch methods
+
     def __init__(self, 
             max_cache_duration=60*15,  # 15 minutes
             max_retries=0, 
@@ -191,7 +267,15 @@ class Provider(object):
         #     "status_code": status_code
         #     })
 
-        if status_code >= 500:
+        if status_code == 429:
+            error = ProviderRateLimitError(response)
+            try:
+                error.retry_after = int(headers.get("Retry-After", 0))
+            except (ValueError, TypeError, AttributeError):
+                pass
+            self.logger.info(u"%s ProviderRateLimitError status code=%i, %s, %s" 
+                % (self.provider_name, status_code, text, str(headers)))
+        elif status_code >= 500:
             error = ProviderServerError(response)
             self.logger.info(u"%s ProviderServerError status code=%i, %s, %s" 
                 % (self.provider_name, status_code, text, str(headers)))
@@ -536,6 +620,19 @@ class Provider(object):
 
         return metrics_dict
 
+    # default batch methods; providers whose upstream can look up many ids
+    # in one call should override these.  Each takes a list of aliases lists,
+    # one per product, and returns a list of responses in the same order.
+    def aliases_batch(self, aliases_list, provider_url_template=None, cache_enabled=True):
+        return [self.aliases(aliases, provider_url_template, cache_enabled) for aliases in aliases_list]
+
+    def biblio_batch(self, aliases_list, provider_url_template=None, cache_enabled=True):
+        return [self.biblio(aliases, provider_url_template, cache_enabled) for aliases in aliases_list]
+
+    def metrics_batch(self, aliases_list, provider_url_template=None, cache_enabled=True):
+        return [self.metrics(aliases, provider_url_template, cache_enabled) for aliases in aliases_list]
+
+
     # ideally would aggregate all tweets from all urls.  
     # the problem is this requires multiple drill-down links, which is troubling for UI at the moment
     # for now, look up all the alias urls and use metrics for url that is most tweeted
@@ -551,6 +648,12 @@ class Provider(object):
             else: 
                 url_aliases += [("url", url), ("url", url+u"/")]
 
+        if cache_enabled and len(url_aliases) > 1:
+            # warm the cache for all the candidates at once, so the lookups below are cache hits
+            template = provider_url_template or self.metrics_url_template
+            candidate_urls = [self._get_templated_url(template, url, "metrics") for (namespace, url) in url_aliases]
+            self.http_get_multiple(candidate_urls, allow_redirects=True)
+
         for url_alias in url_aliases:
             (namespace, url) = url_alias
             metrics = self.get_metrics_for_id(url, provider_url_template, cache_enabled)
@@ -566,6 +669,56 @@ class Provider(object):
     # Core methods
     # These should be consistent for all providers
     
+    @property
+    def cacheable_status_codes(self):
+        if self.negative_cache_duration:
+            return [200] + self.negative_cache_status_codes
+        return [200]
+
+    def _store_responses_in_cache(self, responses, headers, allow_redirects, cache):
+        # successes and not-founds are cached for different lengths of time
+        ok_responses = {}
+        not_found_responses = {}
+        for (url, r) in responses.iteritems():
+            if r is None:
+                continue
+            if r.status_code == 200:
+                ok_responses[url] = r
+            elif self.negative_cache_duration and (r.status_code in self.negative_cache_status_codes):
+                not_found_responses[url] = r
+
+        if ok_responses:
+            store_pages_in_cache(ok_responses, headers, allow_redirects, cache, 
+                self.max_cache_duration, self.stale_while_revalidate_duration)
+        if not_found_responses:
+            store_pages_in_cache(not_found_responses, headers, allow_redirects, cache, 
+                self.negative_cache_duration)
+
+    def _revalidate_in_background(self, url, headers, timeout, allow_redirects):
+        revalidate_key = (url, allow_redirects)
+        with revalidating_urls_lock:
+            if revalidate_key in revalidating_urls:
+                return
+            revalidating_urls.add(revalidate_key)
+
+        headers = headers.copy()
+        def revalidate():
+            try:
+                r = self.http_get(url, headers=headers, timeout=timeout, cache_enabled=False, allow_redirects=allow_redirects)
+                cache = cache_module.Cache(self.max_cache_duration)
+                self._store_responses_in_cache({url: r}, headers, allow_redirects, cache)
+            except ProviderError, e:
+                self.logger.info(u"{provider_name} couldn't revalidate stale {url}: {e}".format(
+                    provider_name=self.provider_name, url=url, e=e.log()))
+            finally:
+                with revalidating_urls_lock:
+                    revalidating_urls.discard(revalidate_key)
+
+        revalidator = threading.Thread(target=revalidate)
+        revalidator.daemon = True
+        revalidator.start()
+
+
     def http_get(self, url, headers={}, timeout=20, cache_enabled=True, allow_redirects=False):
         """ Returns a requests.models.Response object or raises exception
             on failure. Will cache requests to the same URL. """
@@ -574,10 +727,12 @@ class Provider(object):
 
         if cache_enabled:
             cache = cache_module.Cache(self.max_cache_duration)
-            cached_response = get_page_from_cache(url, headers, allow_redirects, cache)
+            cached_response = get_page_from_cache(url, headers, allow_redirects, cache, self.cacheable_status_codes)
             if cached_response:
                 self.logger.debug(u"{provider_name} CACHE HIT on {url}".format(
                     provider_name=self.provider_name, url=url))
+                if cached_response.is_stale:
+                    self._revalidate_in_background(url, headers, timeout, allow_redirects)
                 return cached_response
             
         try:
@@ -590,11 +745,12 @@ class Provider(object):
                 self.logger.info(u"{provider_name} LIVE GET on an url that throws UnicodeDecodeError".format(
                     provider_name=self.provider_name))
 
-            r = requests.get(url, headers=headers, timeout=timeout, allow_redirects=allow_redirects, verify=False)
-            if r and not r.encoding:
+            session = get_http_session(url)
+            r = session.get(url, headers=headers, timeout=timeout, allow_redirects=allow_redirects, verify=False)
+            if r is not None and not r.encoding:
                 r.encoding = "utf-8"     
-            if r and cache_enabled:
-                store_page_in_cache(url, headers, allow_redirects, r, cache)
+            if r is not None and cache_enabled:
+                self._store_responses_in_cache({url: r}, headers, allow_redirects, cache)
 
         except (requests.exceptions.Timeout, socket.timeout) as e:
             self.logger.info(u"{provider_name} provider timed out on GET on {url}".format(
@@ -614,39 +770,49 @@ class Provider(object):
 
 
     def http_get_multiple(self, urls, headers={}, timeout=20, cache_enabled=True, allow_redirects=False, num_concurrent_requests=False):
-        """ Returns a requests.models.Response object or raises exception
-            on failure. Will cache requests to the same URL. """
+        """ Returns a dict of url: requests.models.Response object or raises 
+            exception on failure. Urls that aren't in the cache are requested 
+            in parallel, at most num_concurrent_requests at a time. 
+            Will cache requests to the same URL. """
 
         headers["User-Agent"] = USER_AGENT
 
+        responses = dict((url, None) for url in urls)
+
         # use the cache if the config parameter is set and the arg allows it
         if cache_enabled:
             cache = cache_module.Cache(self.max_cache_duration)
-
-        responses = {}
-        for url in urls:
-            responses[url] = None
-            if cache_enabled:
-                cached_response = get_page_from_cache(url, headers, allow_redirects, cache)
-                if cached_response:
-                    responses[url] = cached_response
+            cached_responses = get_pages_from_cache(responses.keys(), headers, allow_redirects, cache, self.cacheable_status_codes)
+            for (url, cached_response) in cached_responses.iteritems():
+                if cached_response.is_stale:
+                    self._revalidate_in_background(url, headers, timeout, allow_redirects)
+            responses.update(cached_responses)
 
         uncached_urls = [url for url in responses if not responses[url]]
+        if not uncached_urls:
+            return responses
+
+        if not num_concurrent_requests:
+            num_concurrent_requests = self.max_simultaneous_requests
+        num_workers = min(num_concurrent_requests, len(uncached_urls))
+
+        def get_uncached(url):
+            # caching is done below, once all the responses are in
+            return self.http_get(url, headers=headers, timeout=timeout, cache_enabled=False, allow_redirects=allow_redirects)
+
+        if num_workers > 1:
+            pool = ThreadPool(num_workers)
+            try:
+                fresh_responses = pool.map(get_uncached, uncached_urls)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            fresh_responses = [get_uncached(url) for url in uncached_urls]
 
-        # replace the loop below with requests made in parallel, ideally!
-        fresh_responses = []
-        fresh_responses_dict = {}
-        for u in uncached_urls:
-            fresh_responses += [self.http_get(u, headers=headers, timeout=timeout, allow_redirects=allow_redirects)]
-
-        if fresh_responses:
-            fresh_responses_dict = dict(zip(uncached_urls, fresh_responses))
-            if cache_enabled:
-                for url in fresh_responses_dict:
-                    r = fresh_responses_dict[url]
-                    if r and not r.encoding:
-                        r.encoding = "utf-8"     
-                    store_page_in_cache(url, headers, allow_redirects, r, cache)
+        fresh_responses_dict = dict(zip(uncached_urls, fresh_responses))
+        if cache_enabled:
+            self._store_responses_in_cache(fresh_responses_dict, headers, allow_redirects, cache)
         responses.update(fresh_responses_dict)
         return responses
 
@@ -700,7 +866,7 @@ class ProviderValidationFailedError(ProviderClientError):
     pass
 
 class ProviderRateLimitError(ProviderClientError):
-    pass
+    retry_after = 0  # seconds, if the provider told us
 
 class ProviderAuthenticationError(ProviderClientError):
     pass
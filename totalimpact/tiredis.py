@@ -64,6 +64,30 @@ def get_provider_task_ids(self, tiid):
     return task_ids
 
 
+def set_profile_refresh_tiids(self, profile_id, tiids, expire=60*60*2):
+    key = "profile_refresh_tiids:{profile_id}".format(
+        profile_id=profile_id)
+    pipe = self.pipeline()
+    pipe.sadd(key, *tiids)
+    pipe.expire(key, expire)
+    pipe.execute()
+
+
+def finish_profile_refresh_tiid(self, profile_id, tiid):
+    # returns None if this profile's refresh isn't being tracked, 
+    # otherwise True for exactly one call: the one that finishes its last tiid
+    key = "profile_refresh_tiids:{profile_id}".format(
+        profile_id=profile_id)
+    pipe = self.pipeline()  # MULTI/EXEC, so these happen atomically
+    pipe.exists(key)
+    pipe.srem(key, tiid)
+    pipe.scard(key)
+    (was_tracked, num_removed, num_remaining) = pipe.execute()
+    if not was_tracked:
+        return None
+    return (num_removed==1) and (num_remaining==0)
+
+
 def set_value(self, key, value, expire, pipe=None):
     if not pipe:
         pipe = self
@@ -154,4 +178,6 @@ redis.Redis.get_reference_lookup_dict = get_reference_lookup_dict
 redis.Redis.set_provider_task_ids = set_provider_task_ids
 redis.Redis.get_provider_task_ids = get_provider_task_ids
 redis.Redis.clear_provider_task_ids = clear_provider_task_ids
+redis.Redis.set_profile_refresh_tiids = set_profile_refresh_tiids
+redis.Redis.finish_profile_refresh_tiid = finish_profile_refresh_tiid
 
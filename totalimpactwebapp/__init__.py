@@ -7,7 +7,6 @@ from flask import Flask
 from flask.ext.compress import Compress
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager
-from flask.ext.cache import Cache
 from flask_debugtoolbar import DebugToolbarExtension
 
 from sqlalchemy import exc
@@ -65,11 +64,18 @@ if (os.getenv("FLASK_DEBUG", False) == "True"):
     toolbar = DebugToolbarExtension(app)
 
 # gzip responses and make it similar on staging and production
-Compress(app)
+class StreamingCompress(Compress):
+    # Flask-Compress reads response.data to gzip it, which would pull a
+    # streamed response into memory whole, so those go out uncompressed
+    def after_request(self, response):
+        if response.is_streamed:
+            return response
+        return super(StreamingCompress, self).after_request(response)
+
+StreamingCompress(app)
 app.config["COMPRESS_DEBUG"] = compress_json
 
-# setup cache
-cache = Cache(app, config={'CACHE_TYPE': 'simple'})
+# public profile responses are cached in redis, see response_cache.py
 
 # so you can fake PATCH support (http://flask.pocoo.org/docs/patterns/methodoverrides/)
 app.wsgi_app = HTTPMethodOverrideMiddleware(app.wsgi_app)
@@ -3,6 +3,7 @@ from util import dict_from_dir
 
 import logging
 import configs
+from collections import defaultdict
 
 logger = logging.getLogger("ti.award")
 
@@ -12,10 +13,15 @@ def make_list(metrics):
     """
     Factory to make a list of Award objects from a list of Metric objects.
     """
+    # one pass to group the metrics, rather than one per award
+    metrics_by_award = defaultdict(list)
+    for metric in metrics:
+        metrics_by_award[(metric.engagement_type, metric.audience)].append(metric)
+
     awards = []
     for engagement_type in configs.award_configs["engagement_types"].keys():
         for audience in configs.award_configs["audiences"].keys():
-            this_award = Award(engagement_type, audience, metrics)
+            this_award = Award(engagement_type, audience, metrics_by_award[(engagement_type, audience)])
             if len(this_award.metrics):
                 awards.append(this_award)
 
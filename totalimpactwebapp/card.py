@@ -2,36 +2,25 @@ from totalimpactwebapp import db
 import util
 import configs
 import datetime
-import jinja2
+from util import get_template
 import numpy
 import logging
 from collections import defaultdict
 from collections import Counter
+from totalimpactwebapp.metric_aggregates import MetricAggregates
 
 logger = logging.getLogger("ti.card")
 
 
-def get_metrics_by_name(products, provider, interaction):
-    matching_metrics = []
-    for product in products:
-        metric = product.get_metric_by_name(provider, interaction)
-        if metric:
-            matching_metrics.append(metric)
-    return matching_metrics
+def get_metrics_by_name(products, provider, interaction, aggregates=None):
+    if aggregates is None:
+        aggregates = MetricAggregates(products)
+    return aggregates.get_by_name(provider, interaction).metrics
 
-def get_metrics_by_engagement(products, engagement):
-    matching_metrics = []
-    all_possible_metrics_config_dicts = configs.metrics().values()
-
-    for product in products:
-        for config_dict in all_possible_metrics_config_dicts:
-            if config_dict["engagement_type"]==engagement:
-                provider = config_dict["provider"]
-                interaction = config_dict["interaction"]
-                metric = product.get_metric_by_name(provider, interaction)
-                if metric:
-                    matching_metrics.append(metric)
-    return matching_metrics
+def get_metrics_by_engagement(products, engagement, aggregates=None):
+    if aggregates is None:
+        aggregates = MetricAggregates(products)
+    return aggregates.get_by_engagement(engagement).metrics
 
 
 class Card(object):
@@ -85,20 +74,16 @@ class Card(object):
 
 
     def to_html(self):
-        templateLoader = jinja2.FileSystemLoader(searchpath="totalimpactwebapp/templates")
-        templateEnv = jinja2.Environment(loader=templateLoader)
-        html_template = templateEnv.get_template(self.get_template_name() + ".html")
+        html_template = get_template(self.get_template_name() + ".html")
         return html_template.render({"card": self})
 
     def to_text(self):
-        templateLoader = jinja2.FileSystemLoader(searchpath="totalimpactwebapp/templates")
-        templateEnv = jinja2.Environment(loader=templateLoader)
-        html_template = templateEnv.get_template(self.get_template_name() + ".txt")
+        html_template = get_template(self.get_template_name() + ".txt")
         return html_template.render(self)
 
     def to_dict(self):
         # ignore some properties to keep dict small.   
-        properties_to_ignore = ["profile", "product"]
+        properties_to_ignore = ["profile", "product", "aggregates"]
         ret = util.dict_from_dir(self, properties_to_ignore)
 
         # individual cards can add in more subelements to help with debugging
@@ -110,11 +95,12 @@ class Card(object):
 
 class ProductNewDiffCard(Card):
 
-    def __init__(self, products, product, metric, url_slug=None, timestamp=None):
+    def __init__(self, products, product, metric, url_slug=None, timestamp=None, aggregates=None):
         self.url_slug = url_slug
         self.products = products
         self.product = product
         self.metric = metric
+        self.aggregates = aggregates
         super(ProductNewDiffCard, self).__init__(timestamp=timestamp)
 
     @classmethod
@@ -132,12 +118,13 @@ class ProductNewDiffCard(Card):
 
     @property
     def num_profile_products_this_good(self):
+        if self.aggregates is None:
+            self.aggregates = MetricAggregates(self.products)
+
+        # each product has at most one metric with this provider and interaction
         ret = 0
-        for product in self.products:
-            if product.has_metric_this_good(
-                    self.metric.provider,
-                    self.metric.interaction,
-                    self.metric.display_count):
+        for metric in self.aggregates.get_by_name(self.metric.provider, self.metric.interaction).metrics:
+            if metric.display_count >= self.metric.display_count:
                 ret += 1
         return ret
 
@@ -193,29 +180,36 @@ class ProductNewDiffCard(Card):
 
 class AbstractProductsAccumulationCard(Card):
 
-    def __init__(self, products, provider, interaction, url_slug=None, timestamp=None):
+    def __init__(self, products, provider, interaction, url_slug=None, timestamp=None, aggregates=None):
         self.url_slug = url_slug
         self.products = products
         self.provider = provider
         self.interaction = interaction
+        if aggregates is None:
+            aggregates = MetricAggregates(products)
+        self.aggregates = aggregates
 
         # this card doesn't have a solo metric object, but it helps to 
         # save an exemplar metric so that it can be used to access relevant display properies
         try:
-            self.exemplar_metric = get_metrics_by_name(self.products, provider, interaction)[0] #exemplar metric 
+            self.exemplar_metric = get_metrics_by_name(self.products, provider, interaction, aggregates)[0] #exemplar metric 
         except IndexError:
             pass
         super(AbstractProductsAccumulationCard, self).__init__(timestamp=timestamp)
 
 
     @classmethod
-    def would_generate_a_card(cls, products, provider, interaction):
-        return cls.metric_accumulations(products, provider, interaction) is not None
+    def would_generate_a_card(cls, products, provider, interaction, aggregates=None):
+        return cls.metric_accumulations(products, provider, interaction, aggregates) is not None
+
+    @util.cached_property
+    def _accumulations(self):
+        return self.metric_accumulations(self.products, self.provider, self.interaction, self.aggregates)
 
     @property
     def milestone_awarded(self):
         try:
-            return self.metric_accumulations(self.products, self.provider, self.interaction)["milestone"]
+            return self._accumulations["milestone"]
         except (KeyError, TypeError):
             return None
 
@@ -226,14 +220,14 @@ class AbstractProductsAccumulationCard(Card):
     @property
     def current_value(self):
         try:
-            return self.metric_accumulations(self.products, self.provider, self.interaction)["accumulated_diff_end_value"]
+            return self._accumulations["accumulated_diff_end_value"]
         except (KeyError, TypeError):
             return None
 
     @property
     def diff_value(self):
         try:
-            return self.metric_accumulations(self.products, self.provider, self.interaction)["accumulated_diff"]
+            return self._accumulations["accumulated_diff"]
         except (KeyError, TypeError):
             return None                        
 
@@ -246,7 +240,8 @@ class AbstractProductsAccumulationCard(Card):
         # ignore some properties to keep dict small.   
         properties_to_ignore = [
             "exemplar_metric", 
-            "products"
+            "products",
+            "aggregates"
             ]
         ret = util.dict_from_dir(self, properties_to_ignore)
         return ret
@@ -258,31 +253,22 @@ class AbstractNewDiffCard(AbstractProductsAccumulationCard):
         return "card-profile"
 
     @classmethod
-    def metric_accumulations(cls, products, provider, interaction):
-        matching_metrics = get_metrics_by_name(products, provider, interaction)
-
-        metrics_with_diffs = [m for m in matching_metrics if m.can_diff and m.diff_value]
-
-         # quit if there's no matching metrics or they dont' have no diffs
-        if not len(metrics_with_diffs):
+    def metric_accumulations(cls, products, provider, interaction, aggregates=None):
+        if aggregates is None:
+            aggregates = MetricAggregates(products)
+        accumulation = aggregates.get_by_name(provider, interaction)
+
+         # quit if there's no matching metrics or they dont' have no diffs,
+         # or if we didn't just pass any milestones
+        milestone = accumulation.diff_milestone_just_reached
+        if milestone is None:
             return None
 
-        accumulated_diff_start_value = sum([m.diff_window_start_value for m in metrics_with_diffs])
-        accumulated_diff_end_value = sum([m.diff_window_end_value for m in metrics_with_diffs])
-        accumulated_diff = accumulated_diff_end_value - accumulated_diff_start_value
-
-        # milestones will be the same in all the metrics so just grab the first one
-        milestones = matching_metrics[0].config["milestones"]
-
-        # see if we just passed any of them
-        for milestone in sorted(milestones, reverse=True):
-            if accumulated_diff_start_value < milestone <= accumulated_diff_end_value:
-                return ({
-                    "milestone": milestone, 
-                    "accumulated_diff_end_value": accumulated_diff_end_value,
-                    "accumulated_diff": accumulated_diff
-                    })
-        return None
+        return ({
+            "milestone": milestone, 
+            "accumulated_diff_end_value": accumulation.diff_end_value,
+            "accumulated_diff": accumulation.diff_end_value - accumulation.diff_start_value
+            })
 
 
 class ProfileNewDiffCard(AbstractNewDiffCard):
@@ -300,7 +286,8 @@ class GenreNewDiffCard(AbstractNewDiffCard):
         properties_to_ignore = [
             "url_slug", 
             "exemplar_metric", 
-            "products"
+            "products",
+            "aggregates"
             ]
         ret = util.dict_from_dir(self, properties_to_ignore)
         return ret
@@ -308,10 +295,12 @@ class GenreNewDiffCard(AbstractNewDiffCard):
 
 class GenreMetricSumCard(AbstractProductsAccumulationCard):
     @classmethod
-    def would_generate_a_card(cls, products, provider, interaction):
-        if cls.metric_accumulations(products, provider, interaction) is not None:
+    def would_generate_a_card(cls, products, provider, interaction, aggregates=None):
+        if aggregates is None:
+            aggregates = MetricAggregates(products)
+        if cls.metric_accumulations(products, provider, interaction, aggregates) is not None:
             try:
-                exemplar_metric = get_metrics_by_name(products, provider, interaction)[0] #exemplar metric 
+                exemplar_metric = get_metrics_by_name(products, provider, interaction, aggregates)[0] #exemplar metric 
                 if exemplar_metric.engagement_type not in ["viewed", "saved"]:
                     return True
             except IndexError:
@@ -372,21 +361,19 @@ class GenreMetricSumCard(AbstractProductsAccumulationCard):
 
     @classmethod
     #override with a version that returns all cards, not just ones that freshly pass milestones
-    def metric_accumulations(cls, products, provider, interaction):
-        matching_metrics = get_metrics_by_name(products, provider, interaction)
-        matching_metrics = [m for m in matching_metrics if m.is_int]
-
-        accumulated_diff_start_value = sum([m.diff_window_start_value for m in matching_metrics 
-            if m.diff_window_start_value])
-        accumulated_diff_end_value = sum([m.diff_window_end_value for m in matching_metrics 
-            if m.diff_window_end_value])
+    def metric_accumulations(cls, products, provider, interaction, aggregates=None):
+        if aggregates is None:
+            aggregates = MetricAggregates(products)
+        accumulation = aggregates.get_by_name(provider, interaction)
+
+        accumulated_diff_start_value = accumulation.int_start_value
+        accumulated_diff_end_value = accumulation.int_end_value
         accumulated_diff = accumulated_diff_end_value - accumulated_diff_start_value
 
         if not accumulated_diff_end_value:
             return None
 
-        # milestones will be the same in all the metrics so just grab the first one
-        milestones = matching_metrics[0].config["milestones"]
+        milestones = accumulation.milestones
 
         # see if we just passed any of them
         for milestone in sorted(milestones, reverse=True):
@@ -405,33 +392,41 @@ class GenreMetricSumCard(AbstractProductsAccumulationCard):
         properties_to_ignore = [
             "url_slug", 
             "exemplar_metric", 
-            "products"
+            "products",
+            "aggregates"
             ]
         ret = util.dict_from_dir(self, properties_to_ignore)
         return ret
 
 
 class GenreEngagementSumCard(Card):
-    def __init__(self, products, engagement, url_slug=None, timestamp=None):
+    def __init__(self, products, engagement, url_slug=None, timestamp=None, aggregates=None):
         self.url_slug = url_slug
         self.products = products
         self.engagement = engagement
+        if aggregates is None:
+            aggregates = MetricAggregates(products)
+        self.aggregates = aggregates
 
         # this card doesn't have a solo metric object, but it helps to 
         # save an exemplar metric so that it can be used to access relevant display properies
         try:
-            self.exemplar_metric = get_metrics_by_engagement(self.products, engagement)[0] #exemplar metric 
+            self.exemplar_metric = get_metrics_by_engagement(self.products, engagement, aggregates)[0] #exemplar metric 
         except IndexError:
             pass
         super(GenreEngagementSumCard, self).__init__(timestamp=timestamp)
 
     @classmethod
-    def would_generate_a_card(cls, products, engagement):
+    def would_generate_a_card(cls, products, engagement, aggregates=None):
         if engagement in ["viewed", "saved"]:
-            if cls.engagement_accumulations(products, engagement) is not None:
+            if cls.engagement_accumulations(products, engagement, aggregates) is not None:
                 return True
         return False
 
+    @util.cached_property
+    def _accumulations(self):
+        return self.engagement_accumulations(self.products, self.engagement, self.aggregates)
+
     @property
     def genre(self):
         return self.products[0].genre
@@ -463,20 +458,20 @@ class GenreEngagementSumCard(Card):
     @property
     def current_value(self):
         try:
-            return self.engagement_accumulations(self.products, self.engagement)["accumulated_diff_end_value"]
+            return self._accumulations["accumulated_diff_end_value"]
         except (KeyError, TypeError):
             return None
 
     @property
     def diff_value(self):
         try:
-            return self.engagement_accumulations(self.products, self.engagement)["accumulated_diff"]
+            return self._accumulations["accumulated_diff"]
         except (KeyError, TypeError):
             return None 
 
     @property
     def tooltip(self):
-        accumulation_string = self.engagement_accumulations(self.products, self.engagement)["accumulated_string"]
+        accumulation_string = self._accumulations["accumulated_string"]
         tooltip = u"{current_value} {display_things_we_are_counting}, including: {accumulation_string}".format(
             current_value=self.current_value, 
             display_things_we_are_counting=self.display_things_we_are_counting,
@@ -487,14 +482,14 @@ class GenreEngagementSumCard(Card):
 
     @classmethod
     #override with a version that returns all cards, not just ones that freshly pass milestones
-    def engagement_accumulations(cls, products, engagement):
-        matching_metrics = get_metrics_by_engagement(products, engagement)
-        matching_metrics = [m for m in matching_metrics if m.is_int]
-
-        accumulated_diff_start_value = sum([m.diff_window_start_value for m in matching_metrics 
-            if m.diff_window_start_value])
-        accumulated_diff_end_value = sum([m.diff_window_end_value for m in matching_metrics 
-            if m.diff_window_end_value])
+    def engagement_accumulations(cls, products, engagement, aggregates=None):
+        if aggregates is None:
+            aggregates = MetricAggregates(products)
+        accumulation = aggregates.get_by_engagement(engagement)
+        matching_metrics = accumulation.int_metrics
+
+        accumulated_diff_start_value = accumulation.int_start_value
+        accumulated_diff_end_value = accumulation.int_end_value
         accumulated_diff = accumulated_diff_end_value - accumulated_diff_start_value
 
         accumulated_dict = defaultdict(int)
@@ -526,7 +521,8 @@ class GenreEngagementSumCard(Card):
         properties_to_ignore = [
             "url_slug", 
             "exemplar_metric", 
-            "products"
+            "products",
+            "aggregates"
             ]
         ret = util.dict_from_dir(self, properties_to_ignore)
         return ret
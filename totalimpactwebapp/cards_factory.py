@@ -3,13 +3,17 @@ from totalimpactwebapp.card import ProfileNewDiffCard
 from totalimpactwebapp.card import GenreNewDiffCard
 from totalimpactwebapp.card import GenreMetricSumCard
 from totalimpactwebapp.card import GenreEngagementSumCard
+from totalimpactwebapp.metric_aggregates import MetricAggregates
 import configs
 
 import datetime
 
 
 
-def make_product_new_metrics_cards(products, url_slug):
+def make_product_new_metrics_cards(products, url_slug, aggregates=None):
+    if aggregates is None:
+        aggregates = MetricAggregates(products)
+
     cards = []
     for product in products:
 
@@ -18,13 +22,16 @@ def make_product_new_metrics_cards(products, url_slug):
 
         for metric in product.metrics:
             if ProductNewDiffCard.would_generate_a_card(metric):
-                new_card = ProductNewDiffCard(products, product, metric, url_slug)
+                new_card = ProductNewDiffCard(products, product, metric, url_slug, aggregates=aggregates)
                 cards.append(new_card)
 
     return cards
 
 
-def make_product_list_cards(products, card_class, url_slug=None):
+def make_product_list_cards(products, card_class, url_slug=None, aggregates=None):
+    if aggregates is None:
+        aggregates = MetricAggregates(products)
+
     cards = []
     all_possible_metrics_config_dicts = configs.metrics().values()
 
@@ -35,14 +42,17 @@ def make_product_list_cards(products, card_class, url_slug=None):
         if "citations" in interaction:
             continue  # we aren't allowed to accumulate scopus, don't want to accumulate PMC ciations
 
-        if card_class.would_generate_a_card(products, provider, interaction):
-            new_card = card_class(products, provider, interaction, url_slug)
+        if card_class.would_generate_a_card(products, provider, interaction, aggregates):
+            new_card = card_class(products, provider, interaction, url_slug, aggregates=aggregates)
             cards.append(new_card)
 
     return cards
 
 
-def make_product_list_engagement_cards(products, card_class, url_slug=None):
+def make_product_list_engagement_cards(products, card_class, url_slug=None, aggregates=None):
+    if aggregates is None:
+        aggregates = MetricAggregates(products)
+
     cards = []
     engagement_types = configs.award_configs["engagement_types"]
 
@@ -51,21 +61,25 @@ def make_product_list_engagement_cards(products, card_class, url_slug=None):
         if "cited"==engagement:
             continue  # we aren't allowed to accumulate scopus, don't want to accumulate PMC ciations
 
-        if card_class.would_generate_a_card(products, engagement):
-            new_card = card_class(products, engagement, url_slug)
+        if card_class.would_generate_a_card(products, engagement, aggregates):
+            new_card = card_class(products, engagement, url_slug, aggregates=aggregates)
             cards.append(new_card)
 
     return cards
 
 
-def make_profile_new_metrics_cards(products, url_slug):
-    return make_product_list_cards(products, ProfileNewDiffCard, url_slug)
+def make_profile_new_metrics_cards(products, url_slug, aggregates=None):
+    return make_product_list_cards(products, ProfileNewDiffCard, url_slug, aggregates)
+
 
+def make_summary_cards(products, aggregates=None):
+    # every card looks its metrics up in the same aggregates, made in one pass
+    if aggregates is None:
+        aggregates = MetricAggregates(products)
 
-def make_summary_cards(products):
     cards = []
-    cards += make_product_list_cards(products, GenreMetricSumCard)
-    cards += make_product_list_engagement_cards(products, GenreEngagementSumCard)
+    cards += make_product_list_cards(products, GenreMetricSumCard, aggregates=aggregates)
+    cards += make_product_list_engagement_cards(products, GenreEngagementSumCard, aggregates=aggregates)
     cards.sort(key=lambda x: x.sort_by, reverse=True)
     return cards
 
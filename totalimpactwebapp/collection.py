@@ -1,4 +1,6 @@
 from totalimpactwebapp.profile import get_profile_from_id
+from totalimpactwebapp.product import set_percentiles
+from totalimpactwebapp.product import set_diff_windows
 from totalimpactwebapp.cards_factory import make_summary_cards
 from totalimpactwebapp.product_markup import Markup
 from totalimpactwebapp.tweet import tweets_from_tiids
@@ -29,6 +31,8 @@ class Collection(object):
         self.tagspace = tagspace
         self.tag = tag
         self.products = products_matching_tag(self.profile.display_products, tagspace, tag)
+        set_percentiles(self.products)
+        set_diff_windows(self.products)
 
     @cached_property
     def tiids(self):
@@ -2,6 +2,7 @@ import logging
 from collections import Counter
 from totalimpactwebapp.cards_factory import make_summary_cards
 from totalimpactwebapp.cards_factory import make_genre_new_metrics_cards
+from totalimpactwebapp.metric_aggregates import MetricAggregates
 from util import cached_property
 from util import dict_from_dir
 from totalimpactwebapp.configs import get_genre_config
@@ -50,9 +51,13 @@ class Genre(object):
     def icon(self):
         return get_genre_config(self.name)["icon"]
 
+    @cached_property
+    def metric_aggregates(self):
+        return MetricAggregates(self.products)
+
     @cached_property
     def cards(self):
-        return make_summary_cards(self.products)
+        return make_summary_cards(self.products, self.metric_aggregates)
 
     @cached_property
     def cards_new_metrics(self):
@@ -78,7 +83,8 @@ class Genre(object):
     def to_dict(self):
         attributes_to_ignore = [
             "profile_id",
-            "products"
+            "products",
+            "metric_aggregates"
         ]
         ret = dict_from_dir(self, attributes_to_ignore)
         return ret
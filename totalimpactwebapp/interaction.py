@@ -10,6 +10,9 @@ from totalimpactwebapp import db
 import os
 
 def log_interaction_event(tiid, ip, event, headers, timestamp):
+    # here to avoid a circular import, product_summary imports product which imports us
+    from totalimpactwebapp.product_summary import mark_product_summaries_stale
+
     new_interaction = Interaction(
         tiid=tiid,
         timestamp=timestamp,
@@ -17,6 +20,9 @@ def log_interaction_event(tiid, ip, event, headers, timestamp):
         ip=ip,
         headers=headers)
     db.session.add(new_interaction)
+
+    # the summary shows the impactstory views and downloads counted from interactions
+    mark_product_summaries_stale([tiid])
     commit(db)
 
 
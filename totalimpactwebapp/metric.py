@@ -2,6 +2,9 @@ import configs
 import logging
 import arrow
 import math
+import calendar
+import numpy
+from collections import defaultdict
 from util import cached_property
 from util import dict_from_dir
 from totalimpactwebapp.snap import ZeroSnap
@@ -13,14 +16,25 @@ utc_now = arrow.utcnow()
 
 
 
+def timestamp(date):
+    # seconds since the epoch, for naive utc datetimes like last_collected_date
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1000000.0
+
+
 def make_metrics_list(tiid, snaps, product_created):
     metrics = []
 
+    # one pass over the snaps, rather than one per metric config
+    snaps_by_metric = defaultdict(list)
+    for snap in snaps:
+        snaps_by_metric[(snap.provider, snap.interaction)].append(snap)
+
     for fully_qualified_metric_name, my_config in configs.metrics().iteritems():
 
         my_provider, my_interaction = fully_qualified_metric_name.split(":")
+        my_snaps = snaps_by_metric.get((my_provider, my_interaction))
 
-        if Metric.would_make_a_metric(my_provider, my_interaction, snaps):
+        if my_snaps:
 
             my_metric = Metric(
                 tiid,
@@ -28,7 +42,7 @@ def make_metrics_list(tiid, snaps, product_created):
                 my_interaction,
                 my_config)
 
-            my_metric.add_snaps_from_list(snaps)
+            my_metric.add_snaps_from_list(my_snaps)
 
             my_metric.product_create_date = arrow.get(product_created, 'UTC')
             metrics.append(my_metric)
@@ -36,6 +50,45 @@ def make_metrics_list(tiid, snaps, product_created):
     return metrics
 
 
+def set_diff_windows(metrics, now=None):
+    """
+    Works out the diff window of every one of metrics at once (say, all of a
+    profile's), and gives each metric its window start snap with
+    metric.set_window_start_snap.  All their snap timestamps go in one
+    array, so finding each metric's newest snap older than the window is
+    a handful of array operations for the lot, instead of a sort and a walk
+    per metric.  They all share the same now.
+    """
+    if now is None:
+        now = arrow.utcnow()
+
+    metrics = [metric for metric in metrics if metric.snaps]
+    if not metrics:
+        return
+
+    window_start = timestamp(now.replace(days=-Metric.window_start_min_days_ago).datetime)
+    lengths = numpy.array([len(metric.snaps) for metric in metrics])
+    starts = numpy.cumsum(lengths) - lengths
+    timestamps = numpy.concatenate([metric.snap_timestamps for metric in metrics])
+
+    # each metric's snaps are oldest first, so its ones older than the window come first
+    number_older = numpy.add.reduceat((timestamps < window_start).astype(int), starts)
+
+    # where the run of snaps collected at the same moment as each snap starts
+    run_start = numpy.ones(len(timestamps), dtype=bool)
+    run_start[1:] = timestamps[1:] != timestamps[:-1]
+    run_start[starts] = True
+    run_starts = numpy.maximum.accumulate(
+        numpy.where(run_start, numpy.arange(len(timestamps)), 0))
+
+    for (metric, start, older) in zip(metrics, starts, number_older):
+        if older:
+            position = int(run_starts[start + older - 1] - start)
+        else:
+            position = None
+        metric.set_window_start_snap(metric.window_start_snap_at(now, position))
+
+
 
 class Metric(object):
 
@@ -84,21 +137,41 @@ class Metric(object):
 
 
     @cached_property
-    def most_recent_snap(self):
+    def snaps_oldest_to_newest(self):
+        # a stable sort, so snaps collected at the same moment keep their order
         return sorted(
             self.snaps,
             key=lambda x: x.last_collected_date,
-            reverse=True
-        )[0]
+            reverse=False
+        )
+
+    @cached_property
+    def snap_timestamps(self):
+        # lines up with snaps_oldest_to_newest
+        return numpy.array(
+            [timestamp(snap.last_collected_date) for snap in self.snaps_oldest_to_newest],
+            dtype=float)
+
+    @cached_property
+    def most_recent_snap(self):
+        # max and min take the first of any ties, like the sorts they replace
+        return max(self.snaps, key=lambda x: x.last_collected_date)
 
 
     @cached_property
     def oldest_snap(self):
-        return sorted(
-            self.snaps,
-            key=lambda x: x.last_collected_date,
-            reverse=False
-        )[0]
+        return min(self.snaps, key=lambda x: x.last_collected_date)
+
+    def newest_snap_position_older_than(self, when):
+        # position in snaps_oldest_to_newest, or None if no snap is that old
+        timestamps = self.snap_timestamps
+        position = numpy.searchsorted(timestamps, timestamp(when.datetime), side="left")
+        if not position:
+            return None
+
+        # of snaps collected at that same moment, the one a walk from newest
+        # to oldest would have found first
+        return int(numpy.searchsorted(timestamps, timestamps[position-1], side="left"))
 
 
     @cached_property
@@ -146,10 +219,24 @@ class Metric(object):
 
         return None
 
+    def set_window_start_snap(self, snap):
+        # worked out ahead of time, see set_diff_windows
+        self.precomputed_window_start_snap = snap
+
     @cached_property
     def _window_start_snap(self):
+        if hasattr(self, "precomputed_window_start_snap"):
+            return self.precomputed_window_start_snap
+        return self.window_start_snap_at(arrow.utcnow())
+
+    def window_start_snap_at(self, now, newest_snap_position_older_than_window=None):
+        """
+        The snap the diff window starts at, as of now.  set_diff_windows
+        passes in where the newest snap older than the window is, having
+        found it for lots of metrics at once; otherwise it's looked up here.
+        """
         most_recent_snap_time = arrow.get(self.most_recent_snap.last_collected_date, 'UTC')
-        window_start_time = arrow.utcnow().replace(days=-self.window_start_min_days_ago)
+        window_start_time = now.replace(days=-self.window_start_min_days_ago)
 
         # all our data is super old
         if most_recent_snap_time < window_start_time:
@@ -159,7 +246,7 @@ class Metric(object):
             minutes=self.product_min_age_for_diff_minutes)
 
         # we're currently in the first minutes of this product's life
-        if arrow.utcnow() < min_for_diff:
+        if now < min_for_diff:
             return None
 
         # we first introduced this metric less than a week ago: then no diff.
@@ -181,21 +268,12 @@ class Metric(object):
          # this is a product we've had for a while, we've (hopefully)
          # done multiple updates
         else:
-            newest_snap_older_than_window = None
-            sorted_snaps = sorted(
-                self.snaps,
-                key=lambda x: x.last_collected_date,
-                reverse=True
-            )
-
-            for snap in sorted_snaps:
-                my_snap_time = arrow.get(snap.last_collected_date, 'UTC')
-                if my_snap_time < window_start_time:
-                    newest_snap_older_than_window = snap
-                    break
-
-            if newest_snap_older_than_window:
-                return newest_snap_older_than_window
+            position = newest_snap_position_older_than_window
+            if position is None:
+                position = self.newest_snap_position_older_than(window_start_time)
+
+            if position is not None:
+                return self.snaps_oldest_to_newest[position]
             else:
                 snap_to_return = ZeroSnap(self.product_create_date.datetime)
                 return snap_to_return
@@ -348,7 +426,7 @@ class Metric(object):
         return ret
 
     def to_dict(self):
-        ret = dict_from_dir(self, ["config", "snaps"])
+        ret = dict_from_dir(self, ["config", "snaps", "snaps_oldest_to_newest", "snap_timestamps"])
         return ret
 
 
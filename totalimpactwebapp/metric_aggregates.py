@@ -0,0 +1,95 @@
+import logging
+
+logger = logging.getLogger("ti.metric_aggregates")
+
+
+def milestone_crossed(milestones, start_value, end_value):
+    # the biggest milestone passed going from start_value to end_value, or None
+    for milestone in sorted(milestones, reverse=True):
+        if start_value < milestone <= end_value:
+            return milestone
+    return None
+
+
+class MetricAccumulation(object):
+    """
+    Totals for one group of metrics: all the ones with the same provider and
+    interaction, or all the ones with the same engagement type.
+    """
+    def __init__(self):
+        self.metrics = []
+
+        # integer metrics, with the values their diff windows start and end at
+        self.int_metrics = []
+        self.int_start_value = 0
+        self.int_end_value = 0
+
+        # metrics with a diff, and the same for them
+        self.diff_metrics = []
+        self.diff_start_value = 0
+        self.diff_end_value = 0
+
+    def add_metric(self, metric):
+        self.metrics.append(metric)
+
+        if metric.is_int:
+            self.int_metrics.append(metric)
+            if metric.diff_window_start_value:
+                self.int_start_value += metric.diff_window_start_value
+            if metric.diff_window_end_value:
+                self.int_end_value += metric.diff_window_end_value
+
+        if metric.can_diff and metric.diff_value:
+            self.diff_metrics.append(metric)
+            self.diff_start_value += metric.diff_window_start_value
+            self.diff_end_value += metric.diff_window_end_value
+
+    @property
+    def milestones(self):
+        # milestones will be the same in all the metrics so just grab the first one
+        return self.metrics[0].config["milestones"]
+
+    @property
+    def diff_milestone_just_reached(self):
+        if not self.diff_metrics:
+            return None
+        return milestone_crossed(self.milestones, self.diff_start_value, self.diff_end_value)
+
+
+
+class MetricAggregates(object):
+    """
+    products' metrics, gathered in one pass into a MetricAccumulation for
+    each provider and interaction and for each engagement type.  Cards look
+    their group up here instead of rescanning every product for every
+    metric config.
+    """
+    def __init__(self, products=None):
+        self.by_name = {}
+        self.by_engagement = {}
+        if products:
+            for product in products:
+                self.add_product(product)
+
+    def add_product(self, product):
+        for metric in product.metrics:
+            name = (metric.provider, metric.interaction)
+            if name not in self.by_name:
+                self.by_name[name] = MetricAccumulation()
+            self.by_name[name].add_metric(metric)
+
+            if metric.engagement_type not in self.by_engagement:
+                self.by_engagement[metric.engagement_type] = MetricAccumulation()
+            self.by_engagement[metric.engagement_type].add_metric(metric)
+
+    def get_by_name(self, provider, interaction):
+        try:
+            return self.by_name[(provider, interaction)]
+        except KeyError:
+            return MetricAccumulation()
+
+    def get_by_engagement(self, engagement):
+        try:
+            return self.by_engagement[engagement]
+        except KeyError:
+            return MetricAccumulation()
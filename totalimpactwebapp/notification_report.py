@@ -1,10 +1,18 @@
 from totalimpactwebapp.cards_factory import *
+from totalimpactwebapp.metric_aggregates import MetricAggregates
+from totalimpactwebapp.product import set_percentiles
+from totalimpactwebapp.product import set_diff_windows
 import os
 
 def get_all_cards(profile):
+    set_percentiles(profile.products_not_removed)
+    set_diff_windows(profile.products_not_removed)
+
+    aggregates = MetricAggregates(profile.products_not_removed)
+
     cards = []
-    cards += make_product_new_metrics_cards(profile.products_not_removed, url_slug=profile.url_slug)
-    cards += make_profile_new_metrics_cards(profile.products_not_removed, url_slug=profile.url_slug)
+    cards += make_product_new_metrics_cards(profile.products_not_removed, url_slug=profile.url_slug, aggregates=aggregates)
+    cards += make_profile_new_metrics_cards(profile.products_not_removed, url_slug=profile.url_slug, aggregates=aggregates)
     return cards
 
 
@@ -3,6 +3,7 @@ import arrow
 import datetime
 import os
 import json
+import hashlib
 import boto
 import requests
 import shortuuid
@@ -12,6 +13,8 @@ from collections import defaultdict
 import flask
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import FlushError
+from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm import lazyload
 
 # these imports need to be here for sqlalchemy
 from totalimpactwebapp import snap
@@ -26,10 +29,8 @@ from totalimpactwebapp import countries
 from totalimpactwebapp.metric import make_metrics_list
 from totalimpactwebapp.biblio import Biblio
 from totalimpactwebapp.biblio import BiblioRow
-from totalimpactwebapp.biblio import matches_biblio
 from totalimpactwebapp.aliases import Aliases
 from totalimpactwebapp.aliases import AliasRow
-from totalimpactwebapp.aliases import matches_alias
 from totalimpactwebapp.snap import Snap
 from totalimpactwebapp.tweet import Tweet
 
@@ -76,27 +77,96 @@ def make(raw_dict):
 def get_product(tiid):
     return Product.query.get(tiid)
 
-def get_products_from_tiids(tiids, ignore_order=False):
+
+def get_product_validators(tiid):
+    """
+    What responses built from product tiid depend on, as (fingerprint,
+    last_modified), from the item row and its interactions without loading
+    the product.  None if there's no such product.
+    """
+    row = db.session.query(
+        Product.tiid,
+        Product.profile_id,
+        Product.removed,
+        Product.last_modified,
+        Product.last_refresh_started,
+        Product.last_refresh_finished,
+        Product.last_refresh_status,
+        Product.has_file,
+        Product.pdf_url
+    ).filter(Product.tiid==tiid).first()
+    if row is None:
+        return None
+
+    (interaction_count, max_interaction_id) = db.session.query(
+        db.func.count(interaction.Interaction.interaction_id),
+        db.func.max(interaction.Interaction.interaction_id)
+    ).filter(interaction.Interaction.tiid==tiid).one()
+
+    fingerprint = list(row) + [interaction_count, max_interaction_id]
+    timestamps = [t for t in [row.removed, row.last_modified, row.last_refresh_finished] if t]
+    last_modified = max(timestamps) if timestamps else None
+    return (fingerprint, last_modified)
+
+# relationships that can be picked to eager load, see product_load_options
+PRODUCT_RELATIONSHIPS = ["alias_rows", "biblio_rows", "snaps", "interactions"]
+
+def product_load_options(load=None):
+    """
+    Query options to eager load just the relationships named in load, 
+    leaving the rest to load lazily if something touches them.
+    load=None keeps the model defaults, which eager load all of them.
+    """
+    if load is None:
+        return []
+
+    unknown = set(load) - set(PRODUCT_RELATIONSHIPS)
+    if unknown:
+        raise ValueError(u"unknown product relationships to load: {unknown}".format(
+            unknown=sorted(unknown)))
+
+    options = []
+    for relationship_name in PRODUCT_RELATIONSHIPS:
+        if relationship_name in load:
+            options.append(subqueryload(relationship_name))
+        else:
+            options.append(lazyload(relationship_name))
+    return options
+
+
+def get_products_from_tiids(tiids, ignore_order=False, load=None):
     #  @ignore_order makes it slightly faster by not sorting
+    #  @load is which relationships to eager load, see product_load_options
     if not tiids:
         return []
         
-    unsorted_products = Product.query.filter(Product.tiid.in_(tiids)).all()
-    ret = []
+    q = Product.query.filter(Product.tiid.in_(tiids))
+    unsorted_products = q.options(*product_load_options(load)).all()
 
     if ignore_order:
-        ret = unsorted_products
-    else:
-        for my_tiid in tiids:
-            try:
-                my_product = [p for p in unsorted_products if p.tiid == my_tiid][0]
-            except IndexError:
-                continue
-            ret.append(my_product)
+        return unsorted_products
 
+    products_by_tiid = dict((product.tiid, product) for product in unsorted_products)
+    ret = [products_by_tiid[tiid] for tiid in tiids if tiid in products_by_tiid]
     return ret
 
 
+def set_percentiles(products):
+    # all their snaps' percentiles in one go, before their metrics are made
+    snaps = []
+    for product in products:
+        snaps += product.percentile_snaps
+    reference_set.set_snap_percentiles(snaps)
+
+
+def set_diff_windows(products):
+    # all their metrics' diff windows in one go, as of the same moment
+    metrics = []
+    for product in products:
+        metrics += product.metrics
+    metric.set_diff_windows(metrics)
+
+
 def upload_file_and_commit(product, file_to_upload, db):
     resp = product.upload_file(file_to_upload)
     commit(db)
@@ -131,21 +201,21 @@ class Product(db.Model):
         'AliasRow',
         lazy='subquery',
         cascade="all, delete-orphan",
-        backref=db.backref("item", lazy="subquery")
+        backref=db.backref("item", lazy="select")
     )
 
     biblio_rows = db.relationship(
         'BiblioRow',
         lazy='subquery',
         cascade="all, delete-orphan",
-        backref=db.backref("item", lazy="subquery")
+        backref=db.backref("item", lazy="select")
     )
 
     snaps = db.relationship(
         'Snap',
         lazy='subquery',
         cascade='all, delete-orphan',
-        backref=db.backref("item", lazy="subquery"),
+        backref=db.backref("item", lazy="select"),
         primaryjoin=snaps_join_string
     )
 
@@ -153,7 +223,7 @@ class Product(db.Model):
         'Interaction',
         lazy='subquery',
         cascade='all, delete-orphan',
-        backref=db.backref("item", lazy="subquery")
+        backref=db.backref("item", lazy="select")
     )
 
     def __init__(self, **kwargs):
@@ -273,8 +343,12 @@ class Product(db.Model):
         self.last_refresh_status = u"STARTED"
         self.last_refresh_failure_message = None
 
-    def set_refresh_status(self, myredis, failure_message=None):
-        redis_refresh_status = refresh_status(self.tiid, myredis)
+    def set_refresh_status(self, myredis, failure_message=None, provider_errors=None):
+        # batched refreshes pass in their provider_errors, rather than having per-provider tasks
+        if provider_errors is not None:
+            redis_refresh_status = refresh_status_from_provider_errors(provider_errors)
+        else:
+            redis_refresh_status = refresh_status(self.tiid, myredis)
         if not redis_refresh_status["short"].startswith(u"SUCCESS"):
             self.last_refresh_failure_message = redis_refresh_status["long"]
         if failure_message:
@@ -367,11 +441,13 @@ class Product(db.Model):
     def fulltext_cta(self):
         return get_genre_config(self.genre)["fulltext_cta"]
 
+    @cached_property
+    def metrics_by_name(self):
+        # (provider, interaction) => metric
+        return dict([((metric.provider, metric.interaction), metric) for metric in self.metrics])
+
     def get_metric_by_name(self, provider, interaction):
-        for metric in self.metrics:
-            if metric.provider==provider and metric.interaction==interaction:
-                return metric
-        return None
+        return self.metrics_by_name.get((provider, interaction), None)
 
     @cached_property
     def has_metrics(self):
@@ -417,12 +493,11 @@ class Product(db.Model):
 
     @cached_property
     def percentile_snaps(self):
-        my_refset = reference_set.ProductLevelReferenceSet()
-        my_refset.year = self.year
-        my_refset.genre = self.genre
-        my_refset.host = self.host
-        my_refset.title = self.biblio.display_title
-        my_refset.mendeley_discipline = self.mendeley_discipline
+        my_refset = reference_set.get_product_level_reference_set(
+            year=self.year,
+            genre=self.genre,
+            host=self.host,
+            mendeley_discipline=self.mendeley_discipline)
 
         ret = []
         for snap in self.snaps_including_interactions:
@@ -762,6 +837,24 @@ class Product(db.Model):
         return ret
 
 
+    @cached_property
+    def markup_version(self):
+        # changes whenever something the markup shows does: aliases, biblio, 
+        # metrics, interactions, the embed or the file.  the diffs ("new this
+        # week") move with time too, so it also changes every utc day.
+        interaction_counts = Counter([(i.event, i.country) for i in self.interactions])
+        version_parts = [
+            self.embed_markup,
+            self.has_file,
+            sorted([(a.namespace, a.nid) for a in self.alias_rows]),
+            sorted([(b.provider, b.biblio_name, b.biblio_value) for b in self.biblio_rows]),
+            sorted([(s.provider, s.interaction, s.raw_value, s.last_collected_date) for s in self.snaps]),
+            sorted(interaction_counts.items()),
+            datetime.datetime.utcnow().date()
+        ]
+        version_string = json.dumps(version_parts, default=unicode, sort_keys=True)
+        return hashlib.md5(version_string.encode("utf-8")).hexdigest()
+
     def to_markup_dict(self, markup, hide_keys=None, show_keys="all"):
         keys_to_show = [
             "tiid",
@@ -789,7 +882,7 @@ class Product(db.Model):
         ]
         my_dict = self.to_dict(keys_to_show)
 
-        my_dict["markup"] = markup.make(my_dict)
+        my_dict["markup"] = markup.make(my_dict, tiid=self.tiid, version=self.markup_version)
 
         if hide_keys is not None:
             for key_to_hide in hide_keys:
@@ -870,11 +963,31 @@ def refresh_status(tiid, myredis):
 
 
 
+def refresh_status_from_provider_errors(provider_errors):
+    if provider_errors:
+        status_short = u"SUCCESS with FAILURES"
+    else:
+        status_short = u"SUCCESS: refresh finished"
+
+    status_long = u"{status_short}; errors: {provider_errors}".format(
+        status_short=status_short, provider_errors=provider_errors)
+
+    return {"short": status_short, "long": status_long}
+
+
+
 def aliases_not_in_existing_products(retrieved_aliases, tiids_to_exclude):
     if not tiids_to_exclude:
         return retrieved_aliases
 
-    products_to_exclude = Product.query.filter(Product.tiid.in_(tiids_to_exclude)).all()
+    products_to_exclude = get_products_from_tiids(tiids_to_exclude, 
+        ignore_order=True, 
+        load=["alias_rows", "biblio_rows"])
+
+    existing_dedup_keys = set()
+    for product in products_to_exclude:
+        existing_dedup_keys.add(product.biblio_dedup_key)
+        existing_dedup_keys.update(alias_dedup_keys(product))
 
     new_aliases = []
     for alias_tuple in retrieved_aliases:
@@ -884,10 +997,13 @@ def aliases_not_in_existing_products(retrieved_aliases, tiids_to_exclude):
         found = False
         if ns=="biblio":
             temp_product = put_biblio_in_product(temp_product, nid, provider_name="bibtex")
-            found = has_equivalent_biblio_in_list(temp_product, products_to_exclude)
+            found = temp_product.biblio_dedup_key in existing_dedup_keys
         else:
             temp_product = put_aliases_in_product(temp_product, [alias_tuple])
-            found = has_equivalent_alias_in_list(temp_product, products_to_exclude)
+            keys = alias_dedup_keys(temp_product)
+            if temp_product.aliases.has_formal_alias:
+                keys = [key for key in keys if not is_url_dedup_key(key)]
+            found = any(key in existing_dedup_keys for key in keys)
         if not found:        
             new_aliases += [alias_tuple]
 
@@ -901,6 +1017,10 @@ def start_product_update(profile_id, tiids_to_update, priority):
     for tiid in tiids_to_update:
         myredis.clear_provider_task_ids(tiid)
         myredis.set_provider_task_ids(tiid, ["STARTED"])  # set this right away
+
+    # counted down as each tiid finishes, so we know when the whole profile is done
+    if tiids_to_update:
+        myredis.set_profile_refresh_tiids(profile_id, tiids_to_update)
     
     # this import here to avoid circular dependancies
     from core_tasks import put_on_celery_queue
@@ -945,54 +1065,75 @@ def import_and_create_products(profile_id, provider_name, importer_input, analyt
     return products
 
 
-def has_dedupable_genres(product1, product2):
-    if product1.genre==product2.genre:
-        if product1.is_preprint==product2.is_preprint:
-            return True
-    return False
+def alias_dedup_keys(product):
+    """
+    A key for each of product's aliases.  Two products sharing a key have 
+    the same alias within the same genre and preprint-ness, so are duplicates.
+    """
+    keys = []
+    for alias_row in product.alias_rows:
+        alias_tuple = alias_row.my_alias_tuple_for_comparing
+        if alias_tuple:
+            (ns, nid) = alias_tuple
+            keys.append(("alias", ns, nid, product.genre, product.is_preprint))
+    return keys
 
 
-def has_equivalent_alias_in_list(product1, duplicate_products_group):
-    if product1.aliases.has_formal_alias:
-        exclude = ["url"]
-    else:
-        exclude = []
-        
-    has_equivalent = False
-    for product2 in duplicate_products_group:
-        if matches_alias(product1, product2, exclude=exclude) and has_dedupable_genres(product1, product2):
-           has_equivalent = True
-    return has_equivalent
+def is_url_dedup_key(key):
+    return key[0]=="alias" and key[1]=="url"
 
 
-def has_equivalent_biblio_in_list(product1, duplicate_products_group):
-    has_equivalent = False
-    for product2 in duplicate_products_group:
-        if matches_biblio(product1, product2) and has_dedupable_genres(product1, product2):
-           has_equivalent = True
-    return has_equivalent
+class DisjointSets(object):
+    """
+    Union-find over the integers 0..n-1.  The root of each set is its 
+    smallest member.
+    """
 
-def build_duplicates_list(products):
-    distinct_groups = defaultdict(list)
+    def __init__(self, n):
+        self.parent = range(n)
 
-    for product in products:
-        is_distinct_item = True
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
 
-        for (group_id, duplicate_products_group) in distinct_groups.iteritems():
-            if has_equivalent_biblio_in_list(product, duplicate_products_group) or \
-                has_equivalent_alias_in_list(product, duplicate_products_group):
-                is_distinct_item = False  
-                distinct_group_id = group_id
+    def union(self, i, j):
+        root_i = self.find(i)
+        root_j = self.find(j)
+        if root_i != root_j:
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
 
-        if is_distinct_item:
-            distinct_group_id = len(distinct_groups)
 
-        # whether distinct or not,
-        # add this to the group, and add all its aliases too
-        distinct_groups[distinct_group_id] += [product]
+def build_duplicates_list(products):
+    products = list(products)
+    groups = DisjointSets(len(products))
+
+    first_product_with_key = {}
+    products_with_url_key = defaultdict(list)
+
+    for (i, product) in enumerate(products):
+        has_formal_alias = product.aliases.has_formal_alias
+
+        for key in [product.biblio_dedup_key] + alias_dedup_keys(product):
+            if is_url_dedup_key(key):
+                # a shared url only counts if this product has no formal alias,
+                # and then it matches every earlier product with that url
+                if not has_formal_alias:
+                    for j in products_with_url_key[key]:
+                        groups.union(i, j)
+                    del products_with_url_key[key][:]
+                products_with_url_key[key].append(i)
+            elif key in first_product_with_key:
+                groups.union(i, first_product_with_key[key])
+            else:
+                first_product_with_key[key] = i
 
+    distinct_groups = defaultdict(list)
+    for (i, product) in enumerate(products):
+        distinct_groups[groups.find(i)].append(product)
 
-    distinct_groups_values = [group for group in distinct_groups.values() if group]
+    distinct_groups_values = [distinct_groups[root] for root in sorted(distinct_groups)]
     return distinct_groups_values
 
 
@@ -1018,6 +1159,7 @@ def patch_biblio(tiid, patch_dict, provider="user_provided"):
         if biblio_name == "free_fulltext_url":
             product.embed_markup = product.get_embed_markup() #alters an attribute, so caller should commit
 
+    product.last_modified = datetime.datetime.utcnow()  # so cached copies are revalidated
     commit(db)
     return {"product": product}
 
@@ -1098,7 +1240,7 @@ def refresh_products_from_tiids(profile_id, tiids, analytics_credentials={}, sou
     if source=="scheduled":
         priority = "low"
 
-    products = Product.query.filter(Product.tiid.in_(tiids)).all()
+    products = get_products_from_tiids(tiids, ignore_order=True, load=[])
     tiids_to_update = []  
 
     for product in products:
@@ -1,33 +1,114 @@
-import jinja2
+import os
+import logging
+import redis
+
+from totalimpact import tiredis
+from util import get_template
+
+
+logger = logging.getLogger("ti.product_markup")
+
+# how long a rendered fragment is kept.  a product's fragments are keyed on
+# its markup_version, so they don't need to expire to stay correct.
+MARKUP_FRAGMENT_MAX_AGE = int(os.getenv("MARKUP_FRAGMENT_MAX_AGE", 60*60*24*7))
+
+# bumped when everything has to be rerendered, like after the refsets change
+MARKUP_GENERATION_KEY = "markup_generation"
+
+fragment_redis = tiredis.from_url(
+    os.getenv("REDIS_URL", "redis://127.0.0.1:6379"),
+    db=tiredis.REDIS_MAIN_DATABASE_NUMBER)
+
+
+def get_markup_generation():
+    try:
+        return fragment_redis.get(MARKUP_GENERATION_KEY) or 0
+    except redis.RedisError:
+        return 0
+
+
+def bump_markup_generation():
+    try:
+        return fragment_redis.incr(MARKUP_GENERATION_KEY)
+    except redis.RedisError, e:
+        logger.warning(u"couldn't bump markup generation: {e}".format(e=e))
+        return None
+
 
 
 class Markup():
     def __init__(self, url_slug, embed=False):
         self.url_slug = url_slug
+        self.embed = embed
 
-        self.template = self._create_template("product.html")
+        self.set_template("product.html")
 
         self.context = {
             "embed": embed,
             "url_slug": url_slug
         }
-
-
-    def _create_template(self, template_name):
-        template_loader = jinja2.FileSystemLoader(searchpath="totalimpactwebapp/templates")
-        template_env = jinja2.Environment(loader=template_loader)
-        return template_env.get_template(template_name)
+        self.fragments = {}
+        self.generation = None
 
     def set_template(self, template_name):
-        self.template = self._create_template(template_name)
+        self.template_name = template_name
+        self.template = get_template(template_name)
 
-    def make(self, local_context):
+    def make(self, local_context, tiid=None, version=None):
         # the local context overwrites the Self on if there are conflicts.
-        full_context = dict(self.context, **local_context)
+        # with a tiid and a version, the html comes from the fragment cache.
+        if tiid is None or version is None:
+            return self._render(local_context)
 
-        return self.template.render(full_context)
+        fragment_key = self._fragment_key(tiid, version)
+        if fragment_key in self.fragments:
+            return self.fragments[fragment_key]
+
+        html = None
+        try:
+            html = fragment_redis.get(fragment_key)
+        except redis.RedisError, e:
+            logger.warning(u"couldn't get markup fragment {fragment_key}: {e}".format(
+                fragment_key=fragment_key, e=e))
 
+        if html is None:
+            html = self._render(local_context)
+            try:
+                fragment_redis.set(fragment_key, html.encode("utf-8"), ex=MARKUP_FRAGMENT_MAX_AGE)
+            except redis.RedisError, e:
+                logger.warning(u"couldn't save markup fragment {fragment_key}: {e}".format(
+                    fragment_key=fragment_key, e=e))
+        else:
+            html = html.decode("utf-8")
 
+        self.fragments[fragment_key] = html
+        return html
 
+    def prefetch(self, tiids_and_versions):
+        # gets many fragments in one round trip, so later make()s don't each need one
+        fragment_keys = [self._fragment_key(tiid, version) for (tiid, version) in tiids_and_versions]
+        if not fragment_keys:
+            return
+        try:
+            htmls = fragment_redis.mget(fragment_keys)
+        except redis.RedisError, e:
+            logger.warning(u"couldn't prefetch markup fragments: {e}".format(e=e))
+            return
+        for (fragment_key, html) in zip(fragment_keys, htmls):
+            if html is not None:
+                self.fragments[fragment_key] = html.decode("utf-8")
 
+    def _render(self, local_context):
+        full_context = dict(self.context, **local_context)
+        return self.template.render(full_context)
 
+    def _fragment_key(self, tiid, version):
+        if self.generation is None:
+            self.generation = get_markup_generation()
+        return u"markup:{generation}:{template_name}:{embed}:{url_slug}:{tiid}:{version}".format(
+            generation=self.generation,
+            template_name=self.template_name,
+            embed=int(bool(self.embed)),
+            url_slug=self.url_slug,
+            tiid=tiid,
+            version=version)
@@ -0,0 +1,233 @@
+import logging
+import datetime
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from totalimpactwebapp import db
+from totalimpactwebapp.json_sqlalchemy import JSONAlchemy
+from totalimpactwebapp.product import get_products_from_tiids
+from totalimpactwebapp.product import set_percentiles
+from totalimpactwebapp.product import set_diff_windows
+from totalimpactwebapp.product_markup import Markup
+from util import commit
+from totalimpactwebapp.serializer import to_jsonable
+
+
+logger = logging.getLogger("ti.product_summary")
+
+
+# what the profile page's products list needs from each product
+PRODUCT_LIST_KEYS = [
+    # for rendering biblio
+    "biblio",
+    "embed_markup",
+
+    "_tiid",
+    "tiid",
+    "markup",
+    "countries_str",
+
+    # for sorting
+    "year",
+    "title",
+    "awardedness_score",
+    "metrics_raw_sum",
+    "authors",
+
+    # misc
+    "genre",
+    "genre_icon"
+]
+
+
+# CREATE TABLE product_summary (
+#     tiid text PRIMARY KEY,
+#     profile_id integer,
+#     url_slug text,
+#     is_account_product boolean,
+#     genre text,
+#     year text,
+#     title text,
+#     awardedness_score double precision,
+#     metrics_raw_sum double precision,
+#     product_dict text,
+#     is_stale boolean,
+#     summary_updated timestamp
+# );
+# CREATE INDEX ix_product_summary_profile_id ON product_summary (profile_id);
+
+class ProductSummary(db.Model):
+    """
+    One row per product with everything the profile products list shows,
+    precomputed, so the list is one indexed query instead of loading every
+    product with all its snaps and rendering its markup.
+    """
+    tiid = db.Column(db.Text, primary_key=True)
+    profile_id = db.Column(db.Integer, index=True)
+    url_slug = db.Column(db.Text)
+    is_account_product = db.Column(db.Boolean)
+    genre = db.Column(db.Text)
+    year = db.Column(db.Text)
+    title = db.Column(db.Text)
+    awardedness_score = db.Column(db.Float)
+    metrics_raw_sum = db.Column(db.Float)
+    product_dict = db.Column(JSONAlchemy(db.Text))
+    is_stale = db.Column(db.Boolean)
+    summary_updated = db.Column(db.DateTime())
+
+    def __init__(self, **kwargs):
+        self.summary_updated = datetime.datetime.utcnow()
+        self.is_stale = False
+        super(ProductSummary, self).__init__(**kwargs)
+
+    def __repr__(self):
+        return u'<ProductSummary {url_slug} {tiid}>'.format(
+            url_slug=self.url_slug,
+            tiid=self.tiid)
+
+
+def build_product_summary(product, markup):
+    product_dict = to_jsonable(product.to_markup_dict(markup, show_keys=PRODUCT_LIST_KEYS))
+
+    year = product.year
+    if year is not None:
+        year = unicode(year)
+
+    product_summary = ProductSummary(
+        tiid = product.tiid,
+        profile_id = product.profile_id,
+        url_slug = markup.url_slug,
+        is_account_product = product.is_account_product,
+        genre = product.genre,
+        year = year,
+        title = product.title,
+        awardedness_score = product.awardedness_score,
+        metrics_raw_sum = product.metrics_raw_sum,
+        product_dict = product_dict
+        )
+    return product_summary
+
+
+def save_product_summaries(products, url_slug):
+    # returns the new summaries, unattached to the session so commit doesn't expire them
+    markup = Markup(url_slug, embed=False)
+    set_percentiles(products)
+    set_diff_windows(products)
+
+    product_summaries = [build_product_summary(product, markup) for product in products]
+    for product_summary in product_summaries:
+        db.session.merge(product_summary)
+    commit(db)
+    return product_summaries
+
+
+def mark_product_summaries_stale(tiids=None):
+    # tiids=None marks them all, for when something every product depends on
+    # changes, like the reference sets.  caller commits.
+    q = ProductSummary.query
+    if tiids is not None:
+        if not tiids:
+            return
+        q = q.filter(ProductSummary.tiid.in_(tiids))
+
+    # in a savepoint, so if it fails (say product_summary hasn't been created
+    # yet) the caller's transaction and the write it's part of still go through.
+    # summaries are rebuilt every day anyway, see summary_is_current.
+    savepoint = db.session.begin_nested()
+    try:
+        q.update({"is_stale": True}, synchronize_session=False)
+        savepoint.commit()
+    except SQLAlchemyError, e:
+        savepoint.rollback()
+        logger.warning(u"couldn't mark product summaries stale: {e}".format(
+            e=e))
+
+
+def summary_is_current(product_summary, url_slug, now=None):
+    # a summary is rebuilt if it's been marked stale, was built for another
+    # url_slug, or was built before today (utc).  its diffs ("new this week")
+    # are reckoned a day at a time, like Product.markup_version.
+    if now is None:
+        now = datetime.datetime.utcnow()
+    start_of_today = datetime.datetime(now.year, now.month, now.day)
+
+    if product_summary.is_stale:
+        return False
+    if product_summary.url_slug != url_slug:
+        return False
+    if product_summary.summary_updated is None or product_summary.summary_updated < start_of_today:
+        return False
+    return True
+
+
+def delete_product_summaries(tiids):
+    # caller commits
+    if tiids:
+        ProductSummary.query.filter(ProductSummary.tiid.in_(tiids)).delete(synchronize_session=False)
+
+
+def get_product_summaries(profile):
+    """
+    The profile's products list, from product_summary.
+
+    Summaries that are missing or not summary_is_current are rebuilt first,
+    and ones for products no longer on the profile are dropped,
+    so profile only needs its bare products loaded (loading_profile="bare_products").
+    If product_summary can't be used the list is built from the products.
+    """
+    current_tiids = [product.tiid for product in profile.products_not_removed]
+    url_slug = profile.url_slug
+    try:
+        return get_product_summaries_from_table(profile.id, url_slug, current_tiids)
+    except SQLAlchemyError, e:
+        logger.warning(u"couldn't use product summaries for {url_slug}, building the list: {e}".format(
+            url_slug=url_slug, e=e))
+        db.session.rollback()
+
+    markup = Markup(url_slug, embed=False)
+    products = get_products_from_tiids(current_tiids)
+    set_percentiles(products)
+    set_diff_windows(products)
+    return [build_product_summary(product, markup).product_dict
+                for product in products if not product.is_account_product]
+
+
+def get_product_summaries_from_table(profile_id, url_slug, current_tiids):
+    current_tiids_set = set(current_tiids)
+    now = datetime.datetime.utcnow()
+
+    # read what we need before any commit expires the rows
+    summaries_by_tiid = {}
+    tiids_to_delete = []
+    for product_summary in ProductSummary.query.filter(ProductSummary.profile_id==profile_id):
+        if product_summary.tiid not in current_tiids_set:
+            tiids_to_delete.append(product_summary.tiid)
+        elif summary_is_current(product_summary, url_slug, now):
+            summaries_by_tiid[product_summary.tiid] = product_summary.product_dict, product_summary.is_account_product
+
+    tiids_to_build = [tiid for tiid in current_tiids if tiid not in summaries_by_tiid]
+
+    delete_product_summaries(tiids_to_delete)
+    if tiids_to_build:
+        logger.info(u"building {num} product summaries for {url_slug}".format(
+            num=len(tiids_to_build), url_slug=url_slug))
+        products = get_products_from_tiids(tiids_to_build, ignore_order=True)
+        for product_summary in save_product_summaries(products, url_slug):
+            summaries_by_tiid[product_summary.tiid] = product_summary.product_dict, product_summary.is_account_product
+    elif tiids_to_delete:
+        commit(db)
+
+    ret = []
+    for tiid in current_tiids:
+        if tiid in summaries_by_tiid:
+            (product_dict, is_account_product) = summaries_by_tiid[tiid]
+            if not is_account_product:
+                ret.append(product_dict)
+    return ret
+
+
+def update_product_summary(product):
+    # after a refresh writes new data for product.  url_slug is from its profile.
+    if not product.profile_id or not product.profile:
+        return None
+    return save_product_summaries([product], product.profile.url_slug)[0]
@@ -10,6 +10,13 @@ from totalimpactwebapp.product import start_product_update
 from totalimpactwebapp.product import import_and_create_products
 from totalimpactwebapp.product import build_duplicates_list
 from totalimpactwebapp.product import refresh_products_from_tiids
+from totalimpactwebapp.product import PRODUCT_RELATIONSHIPS
+from totalimpactwebapp.product import set_percentiles
+from totalimpactwebapp.product import set_diff_windows
+from totalimpactwebapp.product import get_products_from_tiids
+from totalimpactwebapp.interaction import Interaction
+from totalimpactwebapp.biblio import BiblioRow
+from totalimpactwebapp.snap import Snap
 from totalimpactwebapp.genre import make_genres_list
 from totalimpactwebapp.refresh_status import save_profile_refresh_status
 from totalimpactwebapp.refresh_status import RefreshStatus
@@ -70,6 +77,119 @@ def clean_value_for_csv(value_to_store):
     return value_to_store
 
 
+CSV_ALIAS_NAMES = ["title", "doi"]
+
+def csv_header_metric_names(products):
+    metric_names = set()
+    for product in products:
+        for (provider, interaction) in product.metrics_by_name:
+            metric_names.add(u"{provider}:{interaction}".format(
+                provider=provider, interaction=interaction))
+    return sorted(metric_names)
+
+
+def csv_display_tiids(profile_id):
+    # the tiids of a profile's display_products, without loading the products
+    tiids = [tiid for (tiid, ) in db.session.query(Product.tiid).filter(
+        Product.profile_id==profile_id, Product.removed==None).order_by(Product.tiid)]
+    if not tiids:
+        return []
+
+    account_tiids = set()
+    is_account_rows = db.session.query(BiblioRow.tiid, BiblioRow.biblio_value).filter(
+        BiblioRow.tiid.in_(tiids), BiblioRow.biblio_name=="is_account")
+    for (tiid, is_account) in is_account_rows:
+        if is_account:
+            account_tiids.add(tiid)
+    return [tiid for tiid in tiids if tiid not in account_tiids]
+
+
+def csv_header_metric_names_for_tiids(tiids):
+    # same as csv_header_metric_names, from the snap and interaction rows
+    if not tiids:
+        return []
+
+    metric_names = set()
+    snap_names = db.session.query(Snap.provider, Snap.interaction).filter(
+        Snap.tiid.in_(tiids)).distinct()
+    for (provider, interaction) in snap_names:
+        metric_names.add(u"{provider}:{interaction}".format(
+            provider=provider, interaction=interaction))
+
+    events = [event for (event, ) in db.session.query(Interaction.event).filter(
+        Interaction.tiid.in_(tiids)).distinct()]
+    if events:
+        # snaps_including_interactions adds countries whenever there are any
+        for event in events + ["countries"]:
+            metric_names.add(u"impactstory:{event}".format(event=event))
+
+    # only configured metrics get made, see make_metrics_list
+    return sorted(metric_names & set(configs.metrics().keys()))
+
+
+CSV_PRODUCTS_PER_QUERY = 100
+
+def iter_csv_products(tiids):
+    # products a chunk at a time; each chunk can be dropped once its rows are out
+    for start in range(0, len(tiids), CSV_PRODUCTS_PER_QUERY):
+        for product in get_products_from_tiids(tiids[start:start+CSV_PRODUCTS_PER_QUERY]):
+            yield product
+
+
+def iter_csv_of_profile_products(profile_id):
+    tiids = csv_display_tiids(profile_id)
+    header_metric_names = csv_header_metric_names_for_tiids(tiids)
+    return iter_csv_lines(iter_csv_products(tiids), header_metric_names)
+
+
+def csv_row(product, metric_keys):
+    # metric_keys are (provider, interaction) for each metric column
+    row = [product.tiid]
+    for alias_name in CSV_ALIAS_NAMES:
+        try:
+            if alias_name=="title":
+                row.append(clean_value_for_csv(product.biblio.title))
+            else:
+                row.append(clean_value_for_csv(product.aliases.doi))
+        except (AttributeError, KeyError):
+            row.append("")
+
+    metrics_by_name = product.metrics_by_name
+    for metric_key in metric_keys:
+        try:
+            value = metrics_by_name[metric_key].most_recent_snap.raw_value_cleaned_for_export
+            row.append(clean_value_for_csv(value))
+        except (AttributeError, KeyError):
+            row.append("")
+    return row
+
+
+def iter_csv_lines(products, header_metric_names):
+    """
+    Yields the csv of products a line at a time, header first.
+
+    products can be any iterable, like iter_csv_products, so a big export
+    never has to be all in memory at once; the header has to be known up
+    front, see csv_header_metric_names_for_tiids.
+    """
+    line_buffer = StringIO.StringIO()
+    writer = csv.writer(line_buffer, delimiter=',', dialect=csv.excel)
+
+    def pop_line(row):
+        writer.writerow(row)
+        line = line_buffer.getvalue()
+        line_buffer.seek(0)
+        line_buffer.truncate()
+        return line
+
+    yield pop_line(["tiid"] + CSV_ALIAS_NAMES + header_metric_names)
+
+    metric_keys = [tuple(name.split(":", 1)) for name in header_metric_names]
+    for product in products:
+        yield pop_line(csv_row(product, metric_keys))
+
+
+
 class EmailExistsError(Exception):
     pass
 
@@ -123,14 +243,14 @@ class Profile(db.Model):
         'Product',
         lazy='subquery',
         cascade='all, delete-orphan',
-        backref=db.backref("profile", lazy="subquery")
+        backref=db.backref("profile", lazy="select")
     )
 
     drip_emails = db.relationship(
         'DripEmail',
         lazy='subquery',
         cascade='all, delete-orphan',
-        backref=db.backref("profile", lazy="subquery")
+        backref=db.backref("profile", lazy="select")
     )    
 
     def __init__(self, **kwargs):
@@ -495,6 +615,7 @@ class Profile(db.Model):
     def get_products_markup(self, markup, hide_keys=None, show_keys="all"):
 
         markup.set_template("product.html")
+        markup.prefetch([(p.tiid, p.markup_version) for p in self.display_products])
 
         product_dicts = [p.to_markup_dict(markup, hide_keys, show_keys)
                 for p in self.display_products]
@@ -504,53 +625,11 @@ class Profile(db.Model):
 
 
     def csv_of_products(self):
-        (header, rows) = self.build_csv_rows()
-
-        mystream = StringIO.StringIO()
-        dw = csv.DictWriter(mystream, delimiter=',', dialect=csv.excel, fieldnames=header)
-        dw.writeheader()
-        for row in rows:
-            dw.writerow(row)
-        contents = mystream.getvalue()
-        mystream.close()
-        return contents
-
-    def build_csv_rows(self):
-        header_metric_names = []
-        for product in self.display_products:
-            for metric in product.metrics:
-                header_metric_names += [metric.fully_qualified_metric_name]
-        header_metric_names = sorted(list(set(header_metric_names)))
-
-        header_alias_names = ["title", "doi"]
-
-        # make header row
-        header_list = ["tiid"] + header_alias_names + header_metric_names
-        ordered_fieldnames = OrderedDict([(col, None) for col in header_list])
-
-        # body rows
-        rows = []
-        for product in self.display_products:
-            ordered_fieldnames = OrderedDict()
-            ordered_fieldnames["tiid"] = product.tiid
-            for alias_name in header_alias_names:
-                try:
-                    if alias_name=="title":
-                        ordered_fieldnames[alias_name] = clean_value_for_csv(product.biblio.title)
-                    else:
-                        ordered_fieldnames[alias_name] = clean_value_for_csv(product.aliases.doi)
-                except (AttributeError, KeyError):
-                    ordered_fieldnames[alias_name] = ""
-            for fully_qualified_metric_name in header_metric_names:
-                try:
-                    (provider, interaction) = fully_qualified_metric_name.split(":")
-                    most_recent_snap = product.get_metric_by_name(provider, interaction).most_recent_snap
-                    value = most_recent_snap.raw_value_cleaned_for_export
-                    ordered_fieldnames[fully_qualified_metric_name] = clean_value_for_csv(value)
-                except (AttributeError, KeyError):
-                    ordered_fieldnames[fully_qualified_metric_name] = ""
-            rows += [ordered_fieldnames]
-        return(ordered_fieldnames, rows)
+        return "".join(self.iter_csv_of_products())
+
+    def iter_csv_of_products(self):
+        header_metric_names = csv_header_metric_names(self.display_products)
+        return iter_csv_lines(self.display_products, header_metric_names)
 
 
     def get_new_products(self, provider_name, product_seeds, analytics_credentials={}, add_even_if_removed=False):
@@ -665,6 +744,8 @@ class Profile(db.Model):
 
 
 def build_profile_dict(profile, hide_keys, embed):
+    set_percentiles(profile.display_products)
+    set_diff_windows(profile.display_products)
     markup = Markup(profile.url_slug, embed=embed)
 
     profile_dict = {
@@ -827,26 +908,53 @@ def create_profile_from_slug(url_slug, profile_request_dict, db):
     return profile
 
 
-def get_profile_stubs_from_url_slug(url_slug):
+# Named ways to load a profile, cheapest first.  Each is the list of product 
+# relationships to eager load along with the products, or None to not load 
+# products.  Anything not loaded up front still loads lazily if it is touched.
+LOADING_PROFILES = {
+    "about": None,  # just the profile row
+    "bare_products": [],  # products, without any of their rows
+    "stubs": ["alias_rows", "biblio_rows"],  # enough for titles, genres and hosts
+    "full": PRODUCT_RELATIONSHIPS
+}
 
-    # query_base = db.session.query(Profile).options(orm.lazyload('*'), orm.subqueryload(Profile.products))
-    # query_base = db.session.query(Profile).options(orm.noload('*'), subqueryload("products").subqueryload("alias_rows"))
-    query_base = Profile.query.options( orm.noload('*'), 
-                                        orm.subqueryload(Profile.products), 
-                                        orm.subqueryload(Profile.products, Product.biblio_rows), 
-                                        orm.subqueryload(Profile.products, Product.alias_rows))
+def profile_load_options(loading_profile="full"):
+    try:
+        product_relationships = LOADING_PROFILES[loading_profile]
+    except KeyError:
+        raise ValueError(u"unknown loading profile {loading_profile}".format(
+            loading_profile=loading_profile))
+
+    options = [orm.lazyload('*')]
+    if product_relationships is not None:
+        options += [orm.subqueryload(Profile.products), orm.lazyload("products.profile")]
+        for relationship_name in PRODUCT_RELATIONSHIPS:
+            path = "products." + relationship_name
+            if relationship_name in product_relationships:
+                options += [orm.subqueryload(path), orm.lazyload(path + ".item")]
+            else:
+                options += [orm.lazyload(path)]
+    return options
+
+
+def get_profile_stubs_from_url_slug(url_slug):
+    query_base = Profile.query.options(*profile_load_options("stubs"))
     profile = query_base.filter(func.lower(Profile.url_slug) == func.lower(url_slug)).first()
     return profile
 
 
-def get_profile_from_id(id, id_type="url_slug", show_secrets=False, include_products=True, include_product_relationships=True):
-    if include_products:
-        if include_product_relationships:
-            query_base = Profile.query
+def get_profile_from_id(id, id_type="url_slug", show_secrets=False, include_products=True, include_product_relationships=True, loading_profile=None):
+    # loading_profile is one of LOADING_PROFILES.  if it isn't given, 
+    # the include_ flags pick one.
+    if loading_profile is None:
+        if not include_products:
+            loading_profile = "about"
+        elif not include_product_relationships:
+            loading_profile = "bare_products"
         else:
-            query_base = db.session.query(Profile).options(orm.noload('*'), orm.subqueryload(Profile.products))
-    else:
-        query_base = db.session.query(Profile).options(orm.noload('*'))
+            loading_profile = "full"
+
+    query_base = Profile.query.options(*profile_load_options(loading_profile))
 
     if id_type == "id":
         try:
@@ -868,6 +976,66 @@ def get_profile_from_id(id, id_type="url_slug", show_secrets=False, include_prod
     return profile
 
 
+# profile columns that change without changing anything we send
+VALIDATOR_IGNORED_PROFILE_COLUMNS = [
+    "password_hash",
+    "last_viewed_profile",
+    "last_email_check",
+    "last_email_sent",
+    "next_refresh"
+]
+
+def get_profile_validators(id, id_type="url_slug"):
+    """
+    What responses built from a profile and its products depend on, as
+    (fingerprint, last_modified), from the profile row and a few
+    aggregate queries, without loading any products.  None if there's no
+    such profile.
+    """
+    columns = [column for column in Profile.__table__.columns
+                if column.name not in VALIDATOR_IGNORED_PROFILE_COLUMNS]
+    query_base = db.session.query(*columns)
+
+    if id_type == "id":
+        try:
+            profile_row = query_base.filter(Profile.id==int(id)).first()
+        except ValueError:
+            profile_row = None
+    elif id_type == "email":
+        profile_row = query_base.filter(func.lower(Profile.email) == func.lower(id)).first()
+    else:
+        profile_row = query_base.filter(func.lower(Profile.url_slug) == func.lower(id)).first()
+
+    if profile_row is None:
+        return None
+
+    products_row = db.session.query(
+        func.count(Product.tiid),
+        func.count(Product.removed),
+        func.max(Product.removed),
+        func.max(Product.last_modified),
+        func.max(Product.last_refresh_started),
+        func.max(Product.last_refresh_finished)
+    ).filter(Product.profile_id==profile_row.id).one()
+
+    max_interaction_id = db.session.query(
+        func.max(Interaction.interaction_id)
+    ).join(Product, Product.tiid==Interaction.tiid).filter(
+        Product.profile_id==profile_row.id).scalar()
+
+    # build_profile_dict sends the profile's drip_emails too
+    drip_emails_row = db.session.query(
+        func.count(DripEmail.id),
+        func.max(DripEmail.id),
+        func.max(DripEmail.date_sent)
+    ).filter(DripEmail.profile_id==profile_row.id).one()
+
+    fingerprint = list(profile_row) + list(products_row) + [max_interaction_id] + list(drip_emails_row)
+    timestamps = [t for t in [profile_row.last_refreshed] + list(products_row[2:]) + [drip_emails_row[2]] if t]
+    last_modified = max(timestamps) if timestamps else None
+    return (fingerprint, last_modified)
+
+
 
 def subscribe(profile, stripe_token, coupon=None, plan="base-yearly"):
     full_name = u"{first} {last}".format(first=profile.given_name, last=profile.surname)
@@ -3,6 +3,11 @@ import logging
 import shortuuid
 import datetime
 import numpy
+import os
+import glob
+import time
+import hashlib
+import tempfile
 
 from util import cached_property
 from util import dict_from_dir
@@ -11,10 +16,57 @@ from totalimpactwebapp import json_sqlalchemy
 from totalimpactwebapp import db
 from totalimpactwebapp import configs
 
+from totalimpactwebapp.refset_store import write_refset_store
+from totalimpactwebapp.refset_store import open_refset_store
+
+from sqlalchemy import Table, MetaData
+from sqlalchemy import func
+
 
 logger = logging.getLogger("ti.reference_set")
 reference_set_lists = None
 
+# which refsets reference_set_lists has, and when we last checked for newer ones
+reference_set_lists_version = None
+reference_set_lists_checked = 0
+
+# the refsets are shared between processes on a host through a file here
+REFSET_STORE_DIR = os.getenv("REFSET_STORE_DIR", tempfile.gettempdir())
+REFSET_STORE_CHECK_SECONDS = int(os.getenv("REFSET_STORE_CHECK_SECONDS", 60))
+
+
+# ProductLevelReferenceSets are shared by every product with the same
+# (year, genre, host, mendeley_discipline), since that's all they look at
+product_level_reference_sets = {}
+
+
+def get_product_level_reference_set(year=None, genre=None, host=None, mendeley_discipline=None):
+    reload_reference_set_lists_if_changed()
+
+    key = (year, genre, host, mendeley_discipline)
+    try:
+        return product_level_reference_sets[key]
+    except KeyError:
+        refset = ProductLevelReferenceSet()
+        refset.year = year
+        refset.genre = genre
+        refset.host = host
+        refset.mendeley_discipline = mendeley_discipline
+        product_level_reference_sets[key] = refset
+        return refset
+
+
+def is_percentile_lookup_value(raw_value):
+    return isinstance(raw_value, (int, long, float)) and not isinstance(raw_value, bool)
+
+
+def percentile_from_position(position, number_of_percentiles):
+    # position is how many percentiles are less than the value
+    percentile = min(position + 1, number_of_percentiles)
+    if percentile >= 100:
+        percentile = 99
+    return percentile
+
 
 class ProductLevelReferenceSet(object):
     def __init__(self):
@@ -22,6 +74,7 @@ class ProductLevelReferenceSet(object):
         global reference_set_lists
         if reference_set_lists is None:
             reference_set_lists = load_all_reference_set_lists()
+        self.lookup_lists = {}
 
 
     def get_specific_reference_set_list(self, mendeley_discipline, provider, interaction):
@@ -42,8 +95,12 @@ class ProductLevelReferenceSet(object):
 
 
     def get_percentile_lookup_list(self, provider, interaction):
-        global reference_set_lists
-        
+        # the same for every snap of a metric, so only worked out once
+        try:
+            return self.lookup_lists[(provider, interaction)]
+        except KeyError:
+            pass
+
         if self.genre=="article":
             if self.mendeley_discipline:
                 response = self.get_specific_reference_set_list(self.mendeley_discipline, provider, interaction)
@@ -58,9 +115,7 @@ class ProductLevelReferenceSet(object):
             # so don't use stored mendeley discipline because won't find the right refset, use None instead
             response = self.get_specific_reference_set_list(None, provider, interaction)
 
-        # logger.info(u"found get_percentile_lookup_list={percentile_list} for key {mendeley_discipline}".format(
-        #     percentile_list=response["percentile_list"], mendeley_discipline=response["mendeley_discipline"]))
-
+        self.lookup_lists[(provider, interaction)] = response
         return response
 
 
@@ -70,15 +125,32 @@ class ProductLevelReferenceSet(object):
         if not percentile_list_dict or not percentile_list_dict["percentile_list"]:
             return None
 
+        percentile_list = percentile_list_dict["percentile_list"]
+        if is_percentile_lookup_value(raw_value):
+            position = numpy.searchsorted(percentile_list.percentiles_array, raw_value, side="left")
+            percentile = percentile_from_position(int(position), len(percentile_list.percentiles))
+        else:
+            # as plain python numbers, which compare with anything
+            percentiles = numpy.asarray(percentile_list.percentiles).tolist()
+            percentile = self.get_percentile_by_walking(percentiles, raw_value)
+
+        return self.percentile_response(percentile_list_dict, percentile)
+
+
+    def get_percentile_by_walking(self, percentiles, raw_value):
+        # for values searchsorted can't compare, like None, strings or dicts
         percentile = 0
-        for p in percentile_list_dict["percentile_list"].percentiles:
+        for p in percentiles:
             percentile += 1
             if p >= raw_value:
                 break
 
         if percentile >= 100:
             percentile = 99
+        return percentile
+
 
+    def percentile_response(self, percentile_list_dict, percentile):
         lookup_mendeley_discipline = percentile_list_dict["mendeley_discipline"]
         if not lookup_mendeley_discipline or lookup_mendeley_discipline==u'ALL':
             lookup_mendeley_discipline = ""
@@ -94,13 +166,49 @@ class ProductLevelReferenceSet(object):
 
     def to_dict(self):
         attributes_to_ignore = [
-            "refset"
+            "refset",
+            "lookup_lists"
         ]
         ret = dict_from_dir(self, attributes_to_ignore)
         return ret
 
 
 
+def set_snap_percentiles(snaps):
+    """
+    Works out the percentiles of all of snaps at once, and gives each snap
+    its own with snap.set_percentile.  Snaps are grouped by the reference
+    set list they're looked up in, so there's one searchsorted per list for
+    all its values, instead of one lookup per snap.  Snaps need their refset
+    set first, like Product.percentile_snaps does.
+    """
+    groups = defaultdict(list)
+    for snap in snaps:
+        refset = getattr(snap, "refset", None)
+        if refset is None:
+            continue
+
+        percentile_list_dict = refset.get_percentile_lookup_list(snap.provider, snap.interaction)
+        if not percentile_list_dict or not percentile_list_dict["percentile_list"]:
+            snap.set_percentile(None)
+        elif not is_percentile_lookup_value(snap.raw_value):
+            snap.set_percentile(refset.get_percentile(snap.provider, snap.interaction, snap.raw_value))
+        else:
+            group_key = percentile_list_dict["percentile_list"].get_lookup_key()
+            groups[group_key].append((snap, percentile_list_dict))
+
+    for group_key, snaps_and_lists in groups.iteritems():
+        percentile_list = snaps_and_lists[0][1]["percentile_list"]
+        raw_values = numpy.array([snap.raw_value for (snap, percentile_list_dict) in snaps_and_lists], dtype=float)
+        positions = numpy.searchsorted(percentile_list.percentiles_array, raw_values, side="left")
+
+        number_of_percentiles = len(percentile_list.percentiles)
+        for ((snap, percentile_list_dict), position) in zip(snaps_and_lists, positions):
+            percentile = percentile_from_position(int(position), number_of_percentiles)
+            snap.set_percentile(snap.refset.percentile_response(percentile_list_dict, percentile))
+
+
+
 class ReferenceSetList(db.Model):
     refset_id = db.Column(db.Text, primary_key=True)
     genre = db.Column(db.Text)
@@ -145,6 +253,11 @@ class ReferenceSetList(db.Model):
             "interaction"
             ), metric_key))
 
+    @cached_property
+    def percentiles_array(self):
+        # sorted, for numpy.searchsorted
+        return numpy.array(self.percentiles, dtype=float)
+
     def get_lookup_key(self):
         return self.build_lookup_key(
             year=self.year, 
@@ -157,16 +270,57 @@ class ReferenceSetList(db.Model):
 
 
 
+def histogram_percentiles(values, counts, q=range(101)):
+    """
+    numpy.percentile of the list that has each of values in it counts times,
+    without making that list.  values must be sorted.
+    """
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    n = counts.sum()
+    cumulative_counts = numpy.cumsum(counts)
+
+    # linear interpolation between the closest ranks, like numpy.percentile
+    ranks = numpy.asarray(q, dtype=float) / 100.0 * (n - 1)
+    ranks_below = numpy.floor(ranks).astype(numpy.int64)
+    ranks_above = numpy.minimum(ranks_below + 1, n - 1)
+    weights_above = ranks - ranks_below
+
+    # the element at rank r is the first value whose cumulative count is past r
+    values = numpy.asarray(values, dtype=float)
+    below = values[numpy.searchsorted(cumulative_counts, ranks_below, side="right")]
+    above = values[numpy.searchsorted(cumulative_counts, ranks_above, side="right")]
+    return below * (1 - weights_above) + above * weights_above
+
+
+
 class RefsetBuilder(object):
+    """
+    Builds the reference sets from histograms: for each metric key, how many
+    products have each raw value.  Memory goes with the number of distinct
+    values rather than the number of products, and percentiles come straight
+    from the histogram.
+
+    Builders are picklable and can be merged, so workers can each build part
+    and merge them at the end.  Counts can be negative, to take back what
+    was recorded before (process_profile(profile, count=-1) on its old
+    state), so a builder can be kept up to date as snaps come in rather than
+    rebuilt from everything.
+    """
     def __init__(self):
         self.metric_counters = defaultdict(Counter)
         self.product_counter = Counter()
 
-    @cached_property
+    @property
     def metric_keys(self):
         return self.metric_counters.keys()
 
-    def record_metric(self, year=None, genre=None, host=None, mendeley_discipline=None, provider=None, interaction=None, raw_value=None):
+    def merge(self, other_builder):
+        for metric_key, counter in other_builder.metric_counters.iteritems():
+            self.metric_counters[metric_key].update(counter)
+        self.product_counter.update(other_builder.product_counter)
+        return self
+
+    def record_metric(self, year=None, genre=None, host=None, mendeley_discipline=None, provider=None, interaction=None, raw_value=None, count=1):
         metric_key_with_mendeley = ReferenceSetList.build_lookup_key(
             year=year, 
             genre=genre, 
@@ -175,7 +329,7 @@ class RefsetBuilder(object):
             provider=provider, 
             interaction=interaction)
 
-        self.metric_counters[metric_key_with_mendeley][raw_value] += 1
+        self.metric_counters[metric_key_with_mendeley][raw_value] += count
 
         if genre=="article":
             metric_key_all_mendeley = ReferenceSetList.build_lookup_key(
@@ -186,11 +340,11 @@ class RefsetBuilder(object):
                 provider=provider, 
                 interaction=interaction)
 
-            self.metric_counters[metric_key_all_mendeley][raw_value] += 1
+            self.metric_counters[metric_key_all_mendeley][raw_value] += count
 
 
 
-    def record_product(self, year=None, genre=None, host=None, mendeley_discipline=None):
+    def record_product(self, year=None, genre=None, host=None, mendeley_discipline=None, count=1):
         product_key_with_mendeley = ReferenceSetList.build_lookup_key(
             year=year, 
             genre=genre, 
@@ -198,7 +352,7 @@ class RefsetBuilder(object):
             mendeley_discipline=mendeley_discipline, 
             provider=None, 
             interaction=None)
-        self.product_counter[product_key_with_mendeley] += 1
+        self.product_counter[product_key_with_mendeley] += count
 
         if genre=="article":
             product_key_all_mendeley = ReferenceSetList.build_lookup_key(
@@ -208,7 +362,7 @@ class RefsetBuilder(object):
                 mendeley_discipline=u"ALL",
                 provider=None, 
                 interaction=None)
-            self.product_counter[product_key_all_mendeley] += 1
+            self.product_counter[product_key_all_mendeley] += count
 
 
     def product_key_from_metric_key(self, metric_key):
@@ -222,9 +376,14 @@ class RefsetBuilder(object):
             interaction=None)
         return product_key
 
+    def histogram(self, metric_key):
+        # raw value => count, leaving out anything taken back to zero
+        return dict([(raw_value, count) 
+            for (raw_value, count) in self.metric_counters[metric_key].iteritems() 
+            if count > 0])
+
     def percentiles_Ns(self, metric_key):
-        elements = list(self.metric_counters[metric_key].elements())
-        n_non_zero = len(elements)
+        n_non_zero = sum(self.histogram(metric_key).values())
 
         product_key = self.product_key_from_metric_key(metric_key)
         n_total = self.product_counter[product_key]
@@ -240,21 +399,19 @@ class RefsetBuilder(object):
 
 
     def percentiles(self, metric_key):
+        Ns = self.percentiles_Ns(metric_key)
+
         # if fewer than 10 points, don't save percentiles
-        if self.percentiles_Ns(metric_key)["n_total"] < 10:
+        if Ns["n_total"] < 10:
             return None
 
-        # expand the accumulations
-        elements = list(self.metric_counters[metric_key].elements())
-
         # add the zeros
-        n_total = self.percentiles_Ns(metric_key)["n_total"]
-        n_zero = self.percentiles_Ns(metric_key)["n_zero"]
+        histogram = self.histogram(metric_key)
+        if Ns["n_zero"] > 0:
+            histogram[0] = histogram.get(0, 0) + Ns["n_zero"]
 
-        if n_zero:
-            elements += [0 for i in range(n_zero)]
-
-        percentiles = numpy.percentile(elements, q=range(101))
+        values = sorted(histogram.keys())
+        percentiles = histogram_percentiles(values, [histogram[value] for value in values])
         percentiles = [int(round(p, 0)) for p in percentiles]
 
         return percentiles
@@ -303,7 +460,7 @@ class RefsetBuilder(object):
         return rows
 
 
-    def process_profile(self, profile):
+    def process_profile(self, profile, count=1):
         logger.info(u"build_refsets: on {url_slug}".format(url_slug=profile.url_slug))
 
         for product in profile.products_not_removed:
@@ -324,7 +481,8 @@ class RefsetBuilder(object):
                 year=year, 
                 genre=product.genre, 
                 host=product.host, 
-                mendeley_discipline=product.mendeley_discipline)
+                mendeley_discipline=product.mendeley_discipline,
+                count=count)
 
             for metric in product.metrics:
 
@@ -340,20 +498,70 @@ class RefsetBuilder(object):
                     mendeley_discipline=product.mendeley_discipline, 
                     provider=metric.provider, 
                     interaction=metric.interaction, 
-                    raw_value=raw_value)
+                    raw_value=raw_value,
+                    count=count)
 
 
-def load_all_reference_set_lists():
-    global reference_set_lists
+def get_reference_set_lists_version():
+    # changes whenever the refsets are rebuilt, since they're all new rows
+    (n, last_created) = db.session.query(
+        func.count(ReferenceSetList.refset_id),
+        func.max(ReferenceSetList.created)
+    ).one()
+    return hashlib.md5(u"{n}:{last_created}".format(
+        n=n, last_created=last_created)).hexdigest()[0:16]
+
+
+def refset_store_path(version):
+    return os.path.join(REFSET_STORE_DIR, u"refsets-{version}.bin".format(version=version))
 
-    #reset it
-    reference_set_lists = {}
 
+def load_reference_set_lists_from_database():
+    ret = {}
     for refset_list_obj in ReferenceSetList.query.all():
         # we want it to persist across sessions, and is read-only, so detached from session works great
         db.session.expunge(refset_list_obj)
         lookup_key = refset_list_obj.get_lookup_key()
-        reference_set_lists[lookup_key] = refset_list_obj
+        ret[lookup_key] = refset_list_obj
+    return ret
+
+
+def load_reference_set_lists_from_store(version):
+    # the first process on a host to want this version writes it for the rest
+    path = refset_store_path(version)
+    if not os.path.exists(path):
+        logger.info(u"writing refset store {path}".format(path=path))
+        write_refset_store(path, load_reference_set_lists_from_database().values())
+
+        # processes still using old ones keep their mappings after they're removed
+        for old_path in glob.glob(refset_store_path("*")):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    return open_refset_store(path)
+
+
+def load_all_reference_set_lists():
+    global reference_set_lists
+    global reference_set_lists_version
+    global reference_set_lists_checked
+
+    version = get_reference_set_lists_version()
+    try:
+        new_reference_set_lists = load_reference_set_lists_from_store(version)
+    except (IOError, OSError, ValueError), e:
+        logger.warning(u"couldn't use refset store, loading refsets from the database: {e}".format(
+            e=e))
+        new_reference_set_lists = load_reference_set_lists_from_database()
+
+    #reset it, and the product level refsets that cache lookups into it
+    reference_set_lists = new_reference_set_lists
+    reference_set_lists_version = version
+    reference_set_lists_checked = time.time()
+    product_level_reference_sets.clear()
 
     logger.info(u"just loaded reference sets, n={n}".format(
         n=len(reference_set_lists)))
@@ -361,27 +569,95 @@ def load_all_reference_set_lists():
     return reference_set_lists
 
 
+def reload_reference_set_lists_if_changed():
+    # looks for rebuilt refsets at most every REFSET_STORE_CHECK_SECONDS
+    global reference_set_lists_checked
+
+    if reference_set_lists is None:
+        load_all_reference_set_lists()
+        return
+    if reference_set_lists_version is None:
+        return  # set by hand, not loaded
+    if time.time() - reference_set_lists_checked < REFSET_STORE_CHECK_SECONDS:
+        return
+
+    reference_set_lists_checked = time.time()
+    if get_reference_set_lists_version() != reference_set_lists_version:
+        load_all_reference_set_lists()
+
 
-def save_all_reference_set_lists(refset_builder):
+
+def save_all_reference_set_lists(refset_builder, swap=True):
+    """
+    Replaces the reference_set_list table with refset_builder's refsets.
+
+    They're written to a staging table first, which is then renamed into
+    place in one transaction, so anything reading refsets during a rebuild
+    sees either all the old ones or all the new ones, never an empty table.
+    swap=False writes straight to the live table instead, for saving over
+    and over while debugging a build without making a table each time.
+    """
     if not refset_builder.product_counter:
         return None
 
-    logger.info(u"removing old refsets")
-    # as per http://stackoverflow.com/questions/16573802/flask-sqlalchemy-how-to-delete-all-rows-in-a-single-table
-    ReferenceSetList.query.delete()
-    db.session.commit()
+    table_name = ReferenceSetList.__table__.name
+    names = {
+        "table": table_name,
+        "staging": table_name + "_staging",
+        "old": table_name + "_old"
+    }
+    staging_table = Table(names["staging"], MetaData(),
+        *[column.copy() for column in ReferenceSetList.__table__.columns])
 
-    #add new refests
-    logger.info(u"adding new reference sets")
     refset_list_objects = refset_builder.export_histograms()
-    for refset_list_obj in refset_list_objects:
-        db.session.add(refset_list_obj)
+    rows = [dict([(column.name, getattr(refset_list_obj, column.name)) 
+                for column in ReferenceSetList.__table__.columns])
+            for refset_list_obj in refset_list_objects]
 
+    # end the session's transaction first, or a lock it holds from reading
+    # refsets would have the renames below waiting on it forever
     db.session.commit()
-    logger.info("done adding")
-
-
-
 
+    connection = db.engine.connect()
+    try:
+        if not swap:
+            logger.info(u"replacing reference sets in {table}".format(**names))
+            transaction = connection.begin()
+            try:
+                connection.execute(u"DELETE FROM {table}".format(**names))
+                if rows:
+                    connection.execute(ReferenceSetList.__table__.insert(), rows)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
 
+        else:
+            logger.info(u"adding new reference sets to {staging}".format(**names))
+            transaction = connection.begin()
+            try:
+                connection.execute(u"DROP TABLE IF EXISTS {staging}".format(**names))
+                connection.execute(u"CREATE TABLE {staging} (LIKE {table} INCLUDING ALL)".format(**names))
+                if rows:
+                    connection.execute(staging_table.insert(), rows)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+
+            logger.info(u"swapping {staging} in for {table}".format(**names))
+            transaction = connection.begin()
+            try:
+                connection.execute(u"ALTER TABLE {table} RENAME TO {old}".format(**names))
+                connection.execute(u"ALTER TABLE {staging} RENAME TO {table}".format(**names))
+                connection.execute(u"DROP TABLE {old}".format(**names))
+                # the copied primary key was named after the staging table
+                connection.execute(u"ALTER TABLE {table} RENAME CONSTRAINT {staging}_pkey TO {table}_pkey".format(**names))
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+    finally:
+        connection.close()
 
+    logger.info("done adding")
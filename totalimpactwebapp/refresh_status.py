@@ -1,4 +1,5 @@
 from totalimpactwebapp import db
+from totalimpactwebapp.response_cache import invalidate_cached_responses
 from util import cached_property
 from util import commit
 from util import dict_from_dir
@@ -12,6 +13,8 @@ def save_profile_refresh_status(profile, status_string):
     profile.refresh_status = status_string
     db.session.add(profile)
     commit(db)
+    # is_refreshing shows in cached responses, and ALL_DONE means new metrics
+    invalidate_cached_responses(profile.url_slug)
 
 class RefreshStatus(object):
     states = {
@@ -0,0 +1,108 @@
+"""
+Reference sets in one read-only binary file that every process on a host
+memory-maps, instead of each process holding its own copy of every
+ReferenceSetList.
+
+The file is:
+    MAGIC
+    index length, as a little-endian unsigned int
+    index, as json: [[lookup_key, offset, length, N], ...]
+    padding up to a multiple of 8 bytes
+    every refset's percentiles, one after the other, as little-endian int64s
+"""
+import os
+import mmap
+import json
+import struct
+import logging
+import numpy
+
+
+logger = logging.getLogger("ti.refset_store")
+
+MAGIC = "TIREFSET1"
+HEADER_FORMAT = "<I"
+PERCENTILE_DTYPE = numpy.dtype("<i8")
+
+
+class StoredReferenceSetList(object):
+    """
+    Stands in for a ReferenceSetList, with its percentiles a view into the
+    shared file rather than a list of its own.
+    """
+    def __init__(self, lookup_key, percentiles, N):
+        self.lookup_key = lookup_key
+        self.percentiles = percentiles
+        self.N = N
+
+    @property
+    def percentiles_array(self):
+        return self.percentiles
+
+    def get_lookup_key(self):
+        return self.lookup_key
+
+
+
+def write_refset_store(path, refset_lists):
+    """
+    Writes refset_lists (anything with get_lookup_key(), percentiles and N)
+    to path.  It's written to a temporary file and renamed into place, so
+    nobody opens a half-written store.
+    """
+    index = []
+    offset = 0
+    for refset_list in refset_lists:
+        if refset_list.percentiles is None:
+            length = 0
+        else:
+            length = len(refset_list.percentiles)
+        index.append([list(refset_list.get_lookup_key()), offset, length, refset_list.N])
+        offset += length
+
+    percentiles = numpy.zeros(offset, dtype=PERCENTILE_DTYPE)
+    for (refset_list, (lookup_key, start, length, N)) in zip(refset_lists, index):
+        if length:
+            percentiles[start:start+length] = refset_list.percentiles
+
+    index_json = json.dumps(index)
+    header = MAGIC + struct.pack(HEADER_FORMAT, len(index_json)) + index_json
+    padding = "\0" * (-len(header) % PERCENTILE_DTYPE.itemsize)
+
+    temp_path = u"{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(header)
+        f.write(padding)
+        f.write(percentiles.tostring())
+    os.rename(temp_path, path)
+
+
+def open_refset_store(path):
+    """
+    Maps the store at path read-only.  Returns lookup_key => StoredReferenceSetList.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapped[0:len(MAGIC)] != MAGIC:
+        raise ValueError(u"{path} isn't a refset store".format(path=path))
+
+    index_start = len(MAGIC) + struct.calcsize(HEADER_FORMAT)
+    (index_length, ) = struct.unpack(HEADER_FORMAT, mapped[len(MAGIC):index_start])
+    index = json.loads(mapped[index_start:index_start+index_length])
+
+    data_start = index_start + index_length
+    data_start += -data_start % PERCENTILE_DTYPE.itemsize
+    if data_start < len(mapped):
+        all_percentiles = numpy.frombuffer(mapped, dtype=PERCENTILE_DTYPE, offset=data_start)
+    else:
+        all_percentiles = numpy.zeros(0, dtype=PERCENTILE_DTYPE)
+
+    refset_lists = {}
+    for (lookup_key, start, length, N) in index:
+        lookup_key = tuple(lookup_key)
+        refset_lists[lookup_key] = StoredReferenceSetList(
+            lookup_key,
+            all_percentiles[start:start+length],
+            N)
+    return refset_lists
@@ -0,0 +1,90 @@
+import os
+import logging
+import datetime
+import pickle
+import redis
+
+from totalimpact import tiredis
+from totalimpactwebapp.product_markup import MARKUP_GENERATION_KEY
+
+
+logger = logging.getLogger("ti.response_cache")
+
+# entries don't need to expire to stay correct, they are keyed on generations
+# that are bumped whenever the profile changes.  this just clears out old ones.
+RESPONSE_CACHE_MAX_AGE = int(os.getenv("RESPONSE_CACHE_MAX_AGE", 60*60*24))
+
+response_cache_redis = tiredis.from_url(
+    os.getenv("REDIS_URL", "redis://127.0.0.1:6379"),
+    db=tiredis.REDIS_MAIN_DATABASE_NUMBER)
+
+
+
+def _generation_key(url_slug):
+    return u"response_cache_generation:{url_slug}".format(url_slug=url_slug.lower())
+
+
+def _entry_key(url_slug, generation, path):
+    return u"response_cache:{url_slug}:{generation}:{path}".format(
+        url_slug=url_slug.lower(),
+        generation=generation,
+        path=path)
+
+
+def get_generation(url_slug):
+    """
+    The profile's current generation, combined with the markup generation so
+    rebuilt refsets invalidate everything, and with the utc date because
+    responses hold diffs that move with time.  None if redis is unavailable.
+    """
+    try:
+        (profile_generation, markup_generation) = response_cache_redis.mget(
+            [_generation_key(url_slug), MARKUP_GENERATION_KEY])
+    except redis.RedisError, e:
+        logger.warning(u"couldn't get response cache generation for {url_slug}: {e}".format(
+            url_slug=url_slug, e=e))
+        return None
+    return u"{profile_generation}.{markup_generation}.{date}".format(
+        profile_generation=profile_generation or 0,
+        markup_generation=markup_generation or 0,
+        date=datetime.datetime.utcnow().date().isoformat())
+
+
+def get_cached_response(url_slug, generation, path):
+    # (body, etag, last_modified), or None
+    if generation is None:
+        return None
+    try:
+        entry = response_cache_redis.get(_entry_key(url_slug, generation, path))
+    except redis.RedisError, e:
+        logger.warning(u"couldn't get cached response for {path}: {e}".format(
+            path=path, e=e))
+        return None
+    if entry is None:
+        return None
+    return pickle.loads(entry)
+
+
+def save_cached_response(url_slug, generation, path, body, etag, last_modified):
+    # generation is the one read before the response was built, so if the
+    # profile changed while it was being built this lands where nobody looks.
+    if generation is None:
+        return
+    try:
+        response_cache_redis.set(
+            _entry_key(url_slug, generation, path),
+            pickle.dumps((body, etag, last_modified)),
+            ex=RESPONSE_CACHE_MAX_AGE)
+    except redis.RedisError, e:
+        logger.warning(u"couldn't save cached response for {path}: {e}".format(
+            path=path, e=e))
+
+
+def invalidate_cached_responses(url_slug):
+    if not url_slug:
+        return
+    try:
+        response_cache_redis.incr(_generation_key(url_slug))
+    except redis.RedisError, e:
+        logger.warning(u"couldn't invalidate cached responses for {url_slug}: {e}".format(
+            url_slug=url_slug, e=e))
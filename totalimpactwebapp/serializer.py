@@ -0,0 +1,174 @@
+import json
+import datetime
+
+from totalimpactwebapp.metric import Metric
+from totalimpactwebapp.award import Award
+from totalimpactwebapp.snap import Snap
+
+
+# What to serialize for each class, as attribute names or
+# (key in output, attribute name) pairs.  These are the objects there are
+# lots of in a profile, nested in every product's awards and metrics, so they
+# get an explicit list instead of everything dir() finds.  Anything not here
+# is serialized from its to_dict(), the way util.todict does it.
+SCHEMAS = {
+    Snap: [
+        ("collected_date", "last_collected_date"),
+        "provider",
+        "interaction",
+        ("value", "raw_value"),
+        "drilldown_url",
+        "percentile"
+    ],
+
+    Metric: [
+        "tiid",
+        "provider",
+        "interaction",
+        "product_create_date",
+        "window_start_min_days_ago",
+        "product_min_age_for_diff_minutes",
+        "assume_we_have_first_snap_by_minutes",
+        "most_recent_snap",
+        "oldest_snap",
+        "is_highly",
+        "fully_qualified_metric_name",
+        "is_account",
+        "can_diff",
+        "milestone_just_reached",
+        "diff_window_start_value",
+        "diff_window_start_date",
+        "diff_window_end_value",
+        "diff_window_end_date",
+        "current_value",
+        "is_int",
+        "diff_value",
+        "diff_value_unadjusted",
+        "diff_window_length_days",
+        "hide_badge",
+        "latest_nonzero_refresh_timestamp",
+        "engagement_type",
+        "audience",
+        "provider_name",
+        "display_count",
+        "display_provider",
+        "display_interaction",
+        "drilldown_url",
+        "percentile",
+        "percentile_value_string",
+        "display_order"
+    ],
+
+    Award: [
+        "engagement_type",
+        "audience",
+        "metrics",
+        "is_highly",
+        "top_metric_by_percentile",
+        "top_metric_by_count",
+        "top_metric_by_diff",
+        "metrics_with_diff",
+        "has_diff",
+        "is_highly_classname",
+        "highly_string",
+        "sort_score",
+        "display_audience",
+        "display_order"
+    ]
+}
+
+schema_pairs_by_class = {}
+
+
+def schema_for(cls):
+    # (key, attribute) pairs for cls or its nearest ancestor with a schema
+    try:
+        return schema_pairs_by_class[cls]
+    except KeyError:
+        pass
+
+    pairs = None
+    for ancestor in getattr(cls, "__mro__", [cls]):
+        if ancestor in SCHEMAS:
+            pairs = []
+            for field in SCHEMAS[ancestor]:
+                if isinstance(field, basestring):
+                    pairs.append((field, field))
+                else:
+                    pairs.append(field)
+            break
+
+    schema_pairs_by_class[cls] = pairs
+    return pairs
+
+
+def to_jsonable(obj):
+    """
+    Like util.todict, but objects with a schema only have those fields looked at.
+    """
+    if obj is None or isinstance(obj, (basestring, bool, int, long, float)):
+        return obj
+
+    elif isinstance(obj, dict):
+        return dict([(k, to_jsonable(v)) for (k, v) in obj.iteritems()])
+
+    elif type(obj) is datetime.datetime:
+        return obj.isoformat()
+
+    schema = schema_for(obj.__class__)
+    if schema is not None:
+        return dict([(key, to_jsonable(getattr(obj, attribute))) for (key, attribute) in schema])
+
+    elif hasattr(obj, "to_dict"):
+        return dict([
+            (key, to_jsonable(value))
+            for key, value in obj.to_dict().iteritems()
+            if key == "_tiid" or (not callable(value) and not key.startswith('_'))
+        ])
+
+    elif hasattr(obj, "_ast"):
+        return to_jsonable(obj._ast())
+
+    elif hasattr(obj, "__iter__"):
+        return [to_jsonable(v) for v in obj]
+
+    elif hasattr(obj, "__dict__"):
+        return dict([(key, to_jsonable(value))
+            for key, value in obj.__dict__.iteritems()
+            if not callable(value) and not key.startswith('_')])
+
+    return obj
+
+
+def dumps(obj, pretty=False):
+    # compact unless asked, indenting big responses costs time and bytes
+    if pretty:
+        return json.dumps(to_jsonable(obj), sort_keys=True, indent=4)
+    return json.dumps(to_jsonable(obj), separators=(",", ":"))
+
+
+def iter_dumps(obj):
+    """
+    Yields obj as compact json a piece at a time, one list item per piece,
+    so a long list is serialized as it is sent rather than all up front.
+    """
+    if isinstance(obj, dict):
+        yield "{"
+        for (i, (key, value)) in enumerate(obj.iteritems()):
+            if i:
+                yield ","
+            yield json.dumps(key) + ":"
+            for piece in iter_dumps(value):
+                yield piece
+        yield "}"
+
+    elif isinstance(obj, (list, tuple)) or hasattr(obj, "next"):
+        yield "["
+        for (i, item) in enumerate(obj):
+            if i:
+                yield ","
+            yield dumps(item)
+        yield "]"
+
+    else:
+        yield dumps(obj)
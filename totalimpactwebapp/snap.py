@@ -45,6 +45,10 @@ class Snap(db.Model):
     def set_refset(self, refset):
         self.refset = refset
 
+    def set_percentile(self, percentile):
+        # worked out ahead of time, see reference_set.set_snap_percentiles
+        self.precomputed_percentile = percentile
+
 
     @cached_property
     def raw_value_cleaned_for_export(self):
@@ -91,6 +95,8 @@ class Snap(db.Model):
 
     @cached_property
     def percentile(self):
+        if hasattr(self, "precomputed_percentile"):
+            return self.precomputed_percentile
         try:
             return self.refset.get_percentile(
                 self.provider,
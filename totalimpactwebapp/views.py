@@ -4,6 +4,7 @@ import json
 import logging
 import re
 import datetime
+import urllib
 import analytics
 import stripe
 from collections import defaultdict
@@ -14,6 +15,7 @@ from util import commit
 import util
 
 from flask import request, send_file, abort, make_response, g, redirect
+from flask import Response, stream_with_context
 from flask import render_template
 from flask import render_template_string
 from flask.ext.login import login_user, logout_user, current_user, login_required
@@ -43,14 +45,22 @@ from totalimpactwebapp.profile import unsubscribe
 from totalimpactwebapp.profile import build_profile_dict
 from totalimpactwebapp.profile import default_free_trial_days
 from totalimpactwebapp.profile import get_profile_summary_dict
+from totalimpactwebapp.profile import get_profile_validators
+from totalimpactwebapp.profile import iter_csv_of_profile_products
 
 from totalimpactwebapp.product import Product
 from totalimpactwebapp.product import get_product
+from totalimpactwebapp.product import get_product_validators
 from totalimpactwebapp.product import get_products_from_tiids
 from totalimpactwebapp.product import upload_file_and_commit
 from totalimpactwebapp.product import patch_biblio
+from totalimpactwebapp.product_summary import get_product_summaries
+from totalimpactwebapp.product_summary import mark_product_summaries_stale
+from totalimpactwebapp import serializer
 
 from totalimpactwebapp.product_markup import Markup
+from totalimpactwebapp.product_markup import get_markup_generation
+from totalimpactwebapp import response_cache
 
 from totalimpactwebapp.collection import Collection
 
@@ -105,23 +115,29 @@ VERSION = "cristhian" # version
 
 
 
-def json_resp_from_thing(thing, is_already_a_dict=False):
-    # @is_already_a_dict saves a bit of time if you've already converted to dict.
-    if not is_already_a_dict:
-        my_dict = util.todict(thing)
-
-    json_str = json.dumps(my_dict, sort_keys=True, indent=4)
+def json_resp_from_thing(thing, is_already_a_dict=False, stream=False, validators=None):
+    # @is_already_a_dict is ignored now, the serializer is quick on plain dicts.
+    # @stream sends big lists out item by item as they are serialized.
+    # @validators is (etag, last_modified) from check_validators; without
+    # them the response isn't cacheable at all.
+    # compact json unless ?pretty=true
+    pretty = request.args.get("pretty", "False").lower() in ["1", "true"]
 
     if request.path.endswith(".json") and (os.getenv("FLASK_DEBUG", False) == "True"):
         logger.info(u"rendering output through debug_api.html template")
         resp = make_response(render_template(
             'debug_api.html',
-            data=json_str))
+            data=serializer.dumps(thing, pretty=True)))
         resp.mimetype = "text/html"
         return views_helpers.bust_caches(resp)
 
-    resp = make_response(json_str, 200)
+    if stream and not pretty:
+        resp = Response(stream_with_context(serializer.iter_dumps(thing)), 200)
+    else:
+        resp = make_response(serializer.dumps(thing, pretty=pretty), 200)
     resp.mimetype = "application/json"
+    if validators:
+        return views_helpers.set_validators(resp, *validators)
     return views_helpers.bust_caches(resp)
 
 
@@ -141,7 +157,7 @@ def abort_json(status_code, msg):
     abort(resp)
 
 
-def get_user_for_response(id, request, include_products=True):
+def get_user_for_response(id, request, include_products=True, loading_profile=None):
     id_type = unicode(request.args.get("id_type", "url_slug"))
 
     try:
@@ -153,7 +169,8 @@ def get_user_for_response(id, request, include_products=True):
         id,
         id_type,
         show_secrets=logged_in,
-        include_products=include_products
+        include_products=include_products,
+        loading_profile=loading_profile
     )
 
     if retrieved_user is None:
@@ -166,6 +183,112 @@ def get_user_for_response(id, request, include_products=True):
     return retrieved_user
 
 
+def viewer_owns(id, id_type="url_slug"):
+    # whether the logged-in user, if any, is the profile id, without loading it
+    try:
+        return unicode(getattr(current_user, id_type)).lower() == unicode(id).lower()
+    except AttributeError:
+        return False
+
+
+def check_validators(validators, owner=False):
+    """
+    Turns (fingerprint, last_modified) from get_profile_validators or
+    get_product_validators into (etag, last_modified) for json_resp_from_thing.
+    If the client already has this version, aborts with a 304 right here,
+    before anything else is loaded.
+    """
+    if validators is None:
+        return None  # doesn't exist; the endpoint 404s the usual way
+
+    (fingerprint, last_modified) = validators
+    etag = views_helpers.make_etag(
+        fingerprint,
+        get_markup_generation(),
+        owner,  # owners see more
+        request.full_path
+    )
+    if views_helpers.is_not_modified(request, etag, last_modified):
+        abort(views_helpers.not_modified_resp(etag, last_modified))
+    return (etag, last_modified)
+
+
+def check_profile_validators(id):
+    id_type = unicode(request.args.get("id_type", "url_slug"))
+    return check_validators(
+        get_profile_validators(id, id_type),
+        owner=viewer_owns(id, id_type)
+    )
+
+
+# the query args that change what the cached endpoints send
+RESPONSE_CACHE_ARGS = ["id_type", "include", "pretty", "stubs"]
+
+def response_cache_path():
+    # the path and just the args that matter, so cache-busting args like
+    # ?_=<timestamp> don't each get their own entry
+    args = sorted([(k, v.encode("utf-8")) for k in RESPONSE_CACHE_ARGS for v in request.args.getlist(k)])
+    if not args:
+        return request.path
+    return request.path + "?" + urllib.urlencode(args)
+
+
+def get_response_from_cache(url_slug):
+    """
+    For public GETs of url_slug's profile data: the response from the
+    response cache if it's there (a 304 if the client has it already), else
+    None.  On a miss, notes in g what save_response_to_cache needs.
+    """
+    g.response_cache_generation = None
+    id_type = request.args.get("id_type", "url_slug")
+    if request.method != "GET" or id_type != "url_slug" or viewer_owns(url_slug):
+        return None
+
+    generation = response_cache.get_generation(url_slug)
+    cached = response_cache.get_cached_response(url_slug, generation, response_cache_path())
+    if cached is None:
+        g.response_cache_generation = generation
+        return None
+
+    (body, etag, last_modified) = cached
+    if etag and views_helpers.is_not_modified(request, etag, last_modified):
+        return views_helpers.not_modified_resp(etag, last_modified)
+
+    resp = make_response(body, 200)
+    resp.mimetype = "application/json"
+    if etag:
+        return views_helpers.set_validators(resp, etag, last_modified)
+    return views_helpers.bust_caches(resp)
+
+
+def save_response_to_cache(url_slug, resp):
+    generation = getattr(g, "response_cache_generation", None)
+    if generation is None:
+        return resp  # not cacheable, or redis is down
+    if resp.status_code != 200 or resp.is_streamed or resp.mimetype != "application/json":
+        return resp
+
+    (etag, is_weak) = resp.get_etag()
+    response_cache.save_cached_response(
+        url_slug,
+        generation,
+        response_cache_path(),
+        resp.data,
+        etag,
+        resp.last_modified
+    )
+    return resp
+
+
+def invalidate_cached_responses_for_product(product):
+    if product and product.profile:
+        response_cache.invalidate_cached_responses(product.profile.url_slug)
+
+
+def using_response_cache():
+    # whether get_response_from_cache decided this response will be cached
+    return getattr(g, "response_cache_generation", None) is not None
+
 
 
 def make_js_response(template_name, **kwargs):
@@ -409,8 +532,9 @@ def get_user_profile_dict(profile_id):
 @app.route("/profile/<profile_id>", methods=['GET'])
 @app.route("/profile/<profile_id>.json", methods=['GET'])
 def user_profile(profile_id):
+    validators = check_profile_validators(profile_id)
     resp = get_user_profile_dict(profile_id)
-    resp = json_resp_from_thing(resp)
+    resp = json_resp_from_thing(resp, validators=validators)
     return resp
 
 
@@ -459,13 +583,14 @@ def user_delete(profile_id):
         abort_json(401, "Need admin key to delete users")
 
     user = get_user_for_response(profile_id, request)
+    response_cache.invalidate_cached_responses(user.url_slug)
     delete_profile(user)
     return json_resp_from_thing({"user": "deleted"})
 
 
 @app.route("/profile/<profile_id>/subscription", methods=["DELETE", "POST"])
 def user_subscription(profile_id):
-    profile = get_user_for_response(profile_id, request)
+    profile = get_user_for_response(profile_id, request, include_products=False)
     abort_if_user_not_logged_in(profile)
 
     if request.method == "DELETE":
@@ -488,7 +613,7 @@ def user_subscription(profile_id):
 
 @app.route("/profile/<profile_id>/pinboard", methods=["GET", "POST"])
 def pinboard_endpoint(profile_id):
-    profile = get_user_for_response(profile_id, request)
+    profile = get_user_for_response(profile_id, request, include_products=False)
 
     if request.method == "GET":
         board = Pinboard.query.filter_by(profile_id=profile.id).first()
@@ -506,6 +631,7 @@ def pinboard_endpoint(profile_id):
         for (product_lable, tiid) in product_pins:
             current_user_must_own_tiid(tiid)
         resp = write_to_pinboard(profile.id, request.json["contents"])
+        response_cache.invalidate_cached_responses(profile.url_slug)
 
     return json_resp_from_thing(resp)
 
@@ -515,9 +641,11 @@ def pinboard_endpoint(profile_id):
 @app.route("/profile/<profile_id>.json", methods=['PATCH'])
 def patch_user_about(profile_id):
 
-    profile = get_user_for_response(profile_id, request)
+    profile = get_user_for_response(profile_id, request, include_products=False)
     abort_if_user_not_logged_in(profile)
 
+    # the url_slug may be changing, so the old one's cached responses have to go now
+    response_cache.invalidate_cached_responses(profile.url_slug)
     profile.patch(request.json["about"])
     commit(db)
 
@@ -530,7 +658,7 @@ def patch_user_about(profile_id):
 def refresh_status(profile_id):
     local_sleep(0.5) # client to webapp plus one trip to database
     id_type = request.args.get("id_type", "url_slug")  # url_slug is default    
-    profile_bare_products = get_profile_from_id(profile_id, id_type, include_product_relationships=False)
+    profile_bare_products = get_profile_from_id(profile_id, id_type, loading_profile="bare_products")
     if profile_bare_products:
         status = profile_bare_products.get_refresh_status()
     else:
@@ -550,31 +678,40 @@ def oa_badge(profile_id):
 @app.route("/profile/<profile_id>/key-metrics", methods=["GET", "POST"])
 @app.route("/profile/<profile_id>/key-metrics.json", methods=["GET", "POST"])
 def key_metrics(profile_id):
+    cached_resp = get_response_from_cache(profile_id)
+    if cached_resp:
+        return cached_resp
+
     resp = []
-    profile = get_user_for_response(profile_id, request)
+    profile = get_user_for_response(profile_id, request, include_products=False)
 
     if request.method == 'GET':
         board = Pinboard.query.filter_by(profile_id=profile.id).first()
         if board is None:
             board = pinboard.save_new_board(profile.id)
 
-        genre_cards = []
-        for genre in profile.genres:
-            this_genre_cards = genre.cards
-            genre_cards += this_genre_cards
+        # only the pinned cards are built, each from its genre's metric aggregates
+        genres = dict([(genre.name, genre) for genre in profile.genres])
 
         for card_address in board.contents["two"]:
             card_address_parts = card_address.split(".")
             genre_name = card_address_parts[1]
             card_type = card_address_parts[3]
-            genre_products = [p for p in profile.display_products if p.genre==genre_name]
+            try:
+                genre_products = genres[genre_name].products
+                aggregates = genres[genre_name].metric_aggregates
+            except KeyError:
+                genre_products = []
+                aggregates = None
             if card_type == "engagement":
                 engagement_type = card_address_parts[4]
-                card = GenreEngagementSumCard(genre_products, engagement_type, profile.url_slug)
+                card = GenreEngagementSumCard(genre_products, engagement_type, profile.url_slug,
+                    aggregates=aggregates)
             else:
                 provider = card_address_parts[4]
                 interaction = card_address_parts[5]
-                card = GenreMetricSumCard(genre_products, provider, interaction, profile.url_slug)
+                card = GenreMetricSumCard(genre_products, provider, interaction, profile.url_slug,
+                    aggregates=aggregates)
             if card.current_value:
                 resp.append(card)
 
@@ -585,14 +722,18 @@ def key_metrics(profile_id):
         resp = {
             "resp": pinboard.set_key_metrics(profile.id, card_addresses)
         }
+        response_cache.invalidate_cached_responses(profile.url_slug)
 
-    return json_resp_from_thing(resp)
+    return save_response_to_cache(profile_id, json_resp_from_thing(resp))
 
 
 
 @app.route("/profile/<profile_id>/key-products", methods=["GET", "POST"])
 @app.route("/profile/<profile_id>/key-products.json", methods=["GET", "POST"])
 def key_products(profile_id):
+    cached_resp = get_response_from_cache(profile_id)
+    if cached_resp:
+        return cached_resp
 
     # products are loaded individually below
     profile = get_user_for_response(profile_id, request, include_products=False)
@@ -625,17 +766,23 @@ def key_products(profile_id):
         products = request.json["contents"]
         id_tuples = [('product', p["_tiid"]) for p in products]
         resp = {"resp": pinboard.set_key_products(profile.id, id_tuples)}
+        response_cache.invalidate_cached_responses(profile.url_slug)
 
-    return json_resp_from_thing(resp)
+    return save_response_to_cache(profile_id, json_resp_from_thing(resp))
 
 
 
 @app.route("/profile/<url_slug>/countries")
 @app.route("/profile/<url_slug>/countries.json")
 def profile_countries(url_slug):
+    cached_resp = get_response_from_cache(url_slug)
+    if cached_resp:
+        return cached_resp
+
+    validators = check_profile_validators(url_slug)
     profile = get_user_for_response(url_slug, request)
     resp = profile.countries
-    return json_resp_from_thing(resp)
+    return save_response_to_cache(url_slug, json_resp_from_thing(resp, validators=validators))
 
 
 
@@ -654,6 +801,12 @@ def profile_products_get(url_slug):
     source = request.args.get("source", "webapp")
     timer = util.Timer()
 
+    cached_resp = get_response_from_cache(url_slug)
+    if cached_resp:
+        return cached_resp
+
+    validators = check_validators(get_profile_validators(url_slug), owner=viewer_owns(url_slug))
+
     load_times = {}
     just_stubs = request.args.get("stubs", "False").lower() in ["1", "true"]
     if just_stubs:
@@ -669,46 +822,22 @@ def profile_products_get(url_slug):
         load_times["product_list"] = timer.since_last_check()
 
     else:
-        profile = get_profile_from_id(url_slug)
+        profile = get_profile_from_id(url_slug, loading_profile="bare_products")
         if not profile:
             abort_json(404, "This profile does not exist.")
-
-        markup = Markup(url_slug, embed=False)
         load_times["profile"] = timer.elapsed()
 
-        product_list = profile.get_products_markup(
-            markup=markup,
-            show_keys=[
-                # for rendering biblio
-                "biblio",
-                "embed_markup",
-
-                "_tiid",
-                "tiid",
-                "markup",
-                "countries_str",
-
-                # for sorting
-                "year",
-                "title",
-                "awardedness_score",
-                "metrics_raw_sum",
-                "authors",
-
-                # misc
-                "genre",
-                "genre_icon"
-            ]
-        )
+        product_list = get_product_summaries(profile)
         load_times["product_list"] = timer.since_last_check()
 
-    product_dicts_list = util.todict(product_list)
     resp = {
         "a_load_times": load_times,
         "is_refreshing": profile.is_refreshing,
-        "list": product_dicts_list
+        "list": product_list
     }
-    return json_resp_from_thing(resp)
+    # streamed unless it's going in the response cache, which needs it whole
+    resp = json_resp_from_thing(resp, stream=not using_response_cache(), validators=validators)
+    return save_response_to_cache(url_slug, resp)
 
 
 
@@ -758,19 +887,24 @@ def profile_products_modify(id):
         else:
             abort(405)  # method not supported.  We shouldn't get here.
 
+    response_cache.invalidate_cached_responses(profile.url_slug)
     return json_resp_from_thing(resp)
 
 
 @app.route("/profile/<url_slug>/products/tweets", methods=["GET"])
 @app.route("/profile/<url_slug>/products/tweets.json", methods=["GET"])
 def get_profile_tweets(url_slug):
+    cached_resp = get_response_from_cache(url_slug)
+    if cached_resp:
+        return cached_resp
+
     profile = get_user_for_response(url_slug, request, include_products=False)
 
     tweets = get_product_tweets_for_profile(profile.id)
     resp = {
         "tweets": tweets
     }
-    return json_resp_from_thing(resp)
+    return save_response_to_cache(url_slug, json_resp_from_thing(resp))
 
 
 
@@ -778,10 +912,15 @@ def get_profile_tweets(url_slug):
 @app.route("/profile/<url_slug>/collection/<tagspace>/<tag>/products", methods=["GET"])
 @app.route("/profile/<url_slug>/collection/<tagspace>/<tag>/products.json", methods=["GET"])
 def get_products_for_collection(url_slug, tagspace, tag):
+    include = request.args.get("include", "").split(",")
+    if "tweets" in include:
+        validators = None  # tweets come and go without touching the profile
+    else:
+        validators = check_validators(get_profile_validators(url_slug), owner=viewer_owns(url_slug))
+
     collection = Collection(url_slug, tagspace, tag)
     resp = dict([(tiid, {}) for tiid in collection.tiids])
 
-    include = request.args.get("include", "").split(",")
     if "tweets" in include:
         for tiid, tweets_dict in collection.tweets_by_tiid.iteritems():
             resp[tiid].update(tweets_dict)
@@ -789,21 +928,23 @@ def get_products_for_collection(url_slug, tagspace, tag):
         for tiid, markup_dict in collection.markup_by_tiid.iteritems():
             resp[tiid].update(markup_dict)
 
-    return json_resp_from_thing(resp)
+    return json_resp_from_thing(resp, validators=validators)
 
 
 @app.route("/profile/<url_slug>/collection/<tagspace>/<tag>/summary-cards", methods=['GET'])
 @app.route("/profile/<url_slug>/<tagspace>/<tag>/summary-cards.json", methods=['GET'])
 def get_summary_cards_for_collection(url_slug, tagspace, tag):
+    validators = check_validators(get_profile_validators(url_slug), owner=viewer_owns(url_slug))
     collection = Collection(url_slug, tagspace, tag)
-    return json_resp_from_thing(collection.summary_cards)
+    return json_resp_from_thing(collection.summary_cards, validators=validators)
 
 
 @app.route("/profile/<url_slug>/collection/<tagspace>/<tag>/countries", methods=['GET'])
 @app.route("/profile/<url_slug>/<tagspace>/<tag>/countries.json", methods=['GET'])
 def get_countries_for_collection(url_slug, tagspace, tag):
+    validators = check_validators(get_profile_validators(url_slug), owner=viewer_owns(url_slug))
     collection = Collection(url_slug, tagspace, tag)
-    return json_resp_from_thing(collection.country_list)
+    return json_resp_from_thing(collection.country_list, validators=validators)
 
 
 @app.route("/product/<tiid>/pdf", methods=['GET'])
@@ -878,6 +1019,7 @@ def product_without_needing_profile(tiid):
     """
     local_sleep(1)
 
+    validators = check_validators(get_product_validators(tiid))
     product = get_product(tiid)
     if not product:
         return abort_json(404, "product not found")
@@ -892,7 +1034,7 @@ def product_without_needing_profile(tiid):
     product_dict["metrics"] = product.metrics
     product_dict["countries"] = product.countries
 
-    return json_resp_from_thing(product_dict)
+    return json_resp_from_thing(product_dict, validators=validators)
 
 
 
@@ -901,12 +1043,13 @@ def product_without_needing_profile(tiid):
 def product_from_tiid(url_slug, tiid):
     local_sleep(1)
 
+    validators = check_validators(get_product_validators(tiid))
     product = get_product(tiid)
     if not product:
         abort_json(404, "This product does not exist.")
 
     product_dict = product.to_dict()
-    return json_resp_from_thing(product_dict)
+    return json_resp_from_thing(product_dict, validators=validators)
 
 
 @app.route("/product/<tiid>/file", methods=['GET', 'POST'])
@@ -935,7 +1078,9 @@ def product_file(tiid):
         current_user_must_own_tiid(tiid)
         file_to_upload = request.files['file'].stream
         product = get_product(tiid)      
+        mark_product_summaries_stale([tiid])
         resp = upload_file_and_commit(product, file_to_upload, db)
+        invalidate_cached_responses_for_product(product)
 
         return json_resp_from_thing(resp)
 
@@ -943,11 +1088,10 @@ def product_file(tiid):
 
 @app.route("/profile/<profile_id>/products.csv", methods=["GET"])
 def profile_products_csv(profile_id):
-    profile = get_user_for_response(profile_id, request)
-
-    csv = profile.csv_of_products()
+    profile = get_user_for_response(profile_id, request, include_products=False)
 
-    resp = make_response(csv, 200)
+    # sent a line at a time as the rows are made, loading the products a chunk at a time
+    resp = Response(stream_with_context(iter_csv_of_profile_products(profile.id)), 200)
     resp.mimetype = "text/csv;charset=UTF-8"
     resp.headers.add("Content-Disposition",
                      "attachment; filename=impactstory-{profile_id}.csv".format(
@@ -966,6 +1110,9 @@ def product_biblio_modify(tiid):
 
     current_user_must_own_tiid(tiid)
     resp = patch_biblio(tiid, request.json)
+    mark_product_summaries_stale([tiid])
+    commit(db)
+    invalidate_cached_responses_for_product(resp["product"])
     local_sleep(1)
 
     return json_resp_from_thing({"msg": resp})
@@ -980,6 +1127,9 @@ def products_biblio_modify_multi(comma_separated_tiids):
     for tiid in comma_separated_tiids.split(","):
         current_user_must_own_tiid(tiid)
         resp.append(patch_biblio(tiid, request.json))
+        mark_product_summaries_stale([tiid])
+        commit(db)
+        invalidate_cached_responses_for_product(resp[-1]["product"])
         local_sleep(1)
 
     return json_resp_from_thing({"msg": resp})  # angular needs obj not array.
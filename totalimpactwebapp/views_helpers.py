@@ -6,6 +6,9 @@ now, until we understand better what organization we need.
 """
 import requests
 import re
+import hashlib
+import datetime
+from flask import make_response
 
 
 def remove_script_tags(str):
@@ -36,3 +39,42 @@ def bust_caches(resp):
 
 
 
+
+
+def start_of_utc_day(now=None):
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return datetime.datetime(now.year, now.month, now.day)
+
+
+def make_etag(*parts):
+    # responses include diffs ("new this week") that move with time, so
+    # etags change every utc day even when nothing else does
+    return hashlib.md5(repr((start_of_utc_day(), ) + parts)).hexdigest()
+
+
+def is_not_modified(request, etag, last_modified, now=None):
+    # If-None-Match wins when both are sent
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        # a copy from before today has yesterday's diffs, however old the data is
+        if request.if_modified_since < start_of_utc_day(now):
+            return False
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_validators(resp, etag, last_modified):
+    # clients may keep it, but have to check it's still good before using it
+    resp.set_etag(etag, weak=True)  # weak because compression changes the bytes
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.vary.add("Cookie")
+    return resp
+
+
+def not_modified_resp(etag, last_modified):
+    resp = make_response("", 304)
+    return set_validators(resp, etag, last_modified)
@@ -9,6 +9,7 @@ import stripe
 import emailer
 from unicode_helpers import to_unicode_or_bust
 import unicodedata
+import inspect
 
 from sqlalchemy.exc import IntegrityError, DataError, InvalidRequestError
 from sqlalchemy.orm.exc import FlushError
@@ -66,10 +67,17 @@ def jsonp(f):
 
 
 
+# one environment for everything, so each template is compiled once per process
+template_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(searchpath="totalimpactwebapp/templates"),
+    cache_size=400
+)
+
+def get_template(template_name):
+    return template_env.get_template(template_name)
+
 def jinja_render(template_name, context):
-    templateLoader = jinja2.FileSystemLoader(searchpath="totalimpactwebapp/templates")
-    templateEnv = jinja2.Environment(loader=templateLoader)
-    html_template = templateEnv.get_template(template_name)
+    html_template = get_template(template_name)
     return html_template.render(context)
 
 
@@ -132,6 +140,32 @@ def as_int_or_float_if_possible(input_value):
     return(value)
 
 
+# the attribute names dict_from_dir considers for each class, found once.
+# running dir() on every object was most of its cost.
+attribute_names_by_class = {}
+
+def attribute_names(obj):
+    cls = obj.__class__
+    try:
+        class_names = attribute_names_by_class[cls]
+    except KeyError:
+        class_names = set()
+        for k in dir(cls):
+            if k.startswith("_"):
+                continue
+            # hide sqlalchemy stuff
+            if k in ["query", "query_class", "metadata"]:
+                continue
+            # methods are never serialized, so don't bother getting them
+            if inspect.isroutine(getattr(cls, k, None)):
+                continue
+            class_names.add(k)
+        attribute_names_by_class[cls] = class_names
+
+    instance_names = [k for k in getattr(obj, "__dict__", {}) if not k.startswith("_")]
+    return sorted(class_names.union(instance_names))
+
+
 def dict_from_dir(obj, keys_to_ignore=None, keys_to_show="all"):
 
     if keys_to_ignore is None:
@@ -148,16 +182,8 @@ def dict_from_dir(obj, keys_to_ignore=None, keys_to_show="all"):
         return ret
 
 
-    for k in dir(obj):
-        pass
-
-        if k.startswith("_"):
-            pass
-        elif k in keys_to_ignore:
-            pass
-
-        # hide sqlalchemy stuff
-        elif k in ["query", "query_class", "metadata"]:
+    for k in attribute_names(obj):
+        if k in keys_to_ignore:
             pass
         else:
             value = getattr(obj, k)